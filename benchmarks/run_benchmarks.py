@@ -0,0 +1,373 @@
+"""
+:module: benchmarks/run_benchmarks.py
+:org: Pacific Northwest Seismic Network
+:license: GPLv3
+:purpose: End-to-end benchmark suite for the hot paths of the notebooks' helper
+    modules, run offline against the local stand-ins in `stand_ins.py`:
+
+    - `ws_client.WebServiceClient` requests (cold, over HTTP) and cache hits
+    - `MustangClient._parse_measurements_payload`
+    - `AvailabilityClient._parse_availability_geocsv`
+    - U-Net preprocessing, inference, and pick extraction (`ensemble_annotate`)
+      on synthetic MiniSEED station-days
+    - `obspy_compat2.to_pyrocko_events_and_picks` (skipped if pyrocko is missing)
+
+    Every benchmark runs at several input scales and reports the best and median
+    wall time, throughput, and peak memory. Peak memory is measured in a separate,
+    untimed run with `tracemalloc`, which tracks Python and NumPy allocations but
+    not PyTorch's own allocator; `rss_mb` is the process high-water mark after each
+    case.
+
+    Results can be saved as a named baseline in `benchmarks/baselines/` and later
+    runs compared against it; median times slower than the baseline by more than
+    the tolerance are flagged and make the run exit with status 1.
+
+    Usage:
+        python benchmarks/run_benchmarks.py --scales small medium --save-baseline main
+        python benchmarks/run_benchmarks.py --scales small medium --compare main
+"""
+import argparse
+import gc
+import json
+import logging
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import requests
+
+from stand_ins import ROOT, StandInServer, synthetic_catalog, synthetic_day
+
+sys.path.insert(0, str(ROOT/'notebooks'/'Nate'))
+sys.path.insert(0, str(ROOT/'notebooks'/'Amanda'))
+
+logger = logging.getLogger('run_benchmarks')
+
+BASELINE_DIR = Path(__file__).resolve().parent/'baselines'
+UNET_WEIGHTS = ROOT/'notebooks'/'Loic'/'UNet'/'model_weights_eq_only.pt'
+METRICS = ['max_range', 'num_gaps', 'sample_unique', 'sample_min', 'percent_availability']
+
+# Input scales per benchmark; each scale is a list of input sizes
+SCALES = {
+    'ws_request': {'small': [10], 'medium': [100], 'large': [1000]},
+    'ws_cache_hit': {'small': [20], 'medium': [200], 'large': [2000]},
+    'parse_measurements': {'small': [1000], 'medium': [10000], 'large': [100000]},
+    'parse_availability': {'small': [1000], 'medium': [10000], 'large': [100000]},
+    'unet_preprocess': {'small': [600], 'medium': [3600], 'large': [86400]},
+    'unet_inference': {'small': [600], 'medium': [3600], 'large': [86400]},
+    'unet_picks': {'small': [600], 'medium': [3600], 'large': [86400]},
+    'to_pyrocko': {'small': [100], 'medium': [1000], 'large': [10000]},
+}
+
+
+class Skip(Exception):
+    """Raised by a benchmark setup when its dependencies are unavailable"""
+
+
+def _measure(func, args, repeat):
+    """Time `repeat` calls of func(*args), then measure peak allocations in one more call
+
+    :return: wall times [s], tracemalloc peak [bytes]
+    :rtype: tuple
+    """
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        tick = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - tick)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return times, peak
+
+
+class Suite(object):
+    """Benchmark cases sharing one stand-in server and one scratch directory
+
+    :param workdir: scratch directory for synthetic MiniSEED files
+    :type workdir: str
+    :param repeat: timed repetitions per case, defaults to 3
+    :type repeat: int, optional
+    """
+    def __init__(self, workdir, repeat=3):
+        self.workdir = Path(workdir)
+        self.repeat = repeat
+        self.server = StandInServer()
+        self._streams = {}
+        self._chunks = {}
+        self._annotator = None
+
+    def __repr__(self):
+        rstr = f'{self.__class__.__name__} ({len(SCALES):d} benchmarks, '
+        rstr += f'repeat {self.repeat:d}, {self.server})'
+        return rstr
+
+    # --- ws_client ---
+    def _mustang(self, cache_size=20):
+        from ws_client import MustangClient
+        client = MustangClient(cache_size=cache_size)
+        client.base_url = self.server.base_url + '/mustang'
+        return client
+
+    def _mustang_options(self, n_stations, days=1):
+        return [dict(metric=METRICS, net='UW', sta=f'S{_s:03d}', loc='01', cha='EHZ',
+                     start='2025-02-01', end=str(pd.Timestamp('2025-02-01') + pd.Timedelta(days=days))[:10])
+                for _s in range(n_stations)]
+
+    def setup_ws_request(self, n):
+        client = self._mustang()
+        options = self._mustang_options(n)
+        for _o in options:
+            self.server.prepare(client._form_url(interface='measurements', format='text',
+                                                 **{_k: ','.join(_v) if isinstance(_v, list) else _v
+                                                    for _k, _v in _o.items()}))
+        return (options,), n, 'requests'
+
+    def bench_ws_request(self, options, client=None):
+        # A new client per call, so every query goes over HTTP
+        if client is None:
+            client = self._mustang(cache_size=len(options))
+        for _o in options:
+            client.request('measurements', format='text', **_o)
+
+    def setup_ws_cache_hit(self, n):
+        client = self._mustang(cache_size=n)
+        options = self._mustang_options(n)
+        self.bench_ws_request(options, client)
+        return (client, options), n, 'requests'
+
+    def bench_ws_cache_hit(self, client, options):
+        # Every query is cached: this times the cache lookup, not the network
+        self.bench_ws_request(options, client)
+
+    def setup_parse_measurements(self, n):
+        client = self._mustang()
+        days = max(n//(len(METRICS)*10), 1)
+        url = client._form_url(interface='measurements', format='text', metric=','.join(METRICS),
+                               net='UW', sta='MBW', loc='01', cha='EH1,EH2,EHZ,HH1,HH2,HHZ,HNE,HNN,HNZ,BHZ',
+                               start='2000-01-01',
+                               end=str(pd.Timestamp('2000-01-01') + pd.Timedelta(days=days))[:10])
+        payload = requests.get(url)
+        payload.raise_for_status()
+        rows = payload.text.count('\n') - 2*len(METRICS)
+        return (client, payload), rows, 'rows'
+
+    def bench_parse_measurements(self, client, payload):
+        client._parse_measurements_payload(payload, indexing='start')
+
+    def setup_parse_availability(self, n):
+        from ws_client import AvailabilityClient
+        client = AvailabilityClient()
+        client.base_url = self.server.base_url + '/fdsnws'
+        channels = max(n//(7*self.server.segments_per_day), 1)
+        url = client._form_url(interface='availability', format='geocsv', net='UW',
+                               sta=','.join(f'S{_s:03d}' for _s in range(channels)),
+                               loc='01', cha='EHZ', starttime='2025-02-01', endtime='2025-02-08')
+        payload = requests.get(url)
+        payload.raise_for_status()
+        rows = payload.text.count('\n') - 5
+        return (client, payload), rows, 'rows'
+
+    def bench_parse_availability(self, client, payload):
+        client._parse_availability_geocsv(payload)
+
+    # --- U-Net picking ---
+    def _stream(self, duration):
+        from obspy import read
+        if duration not in self._streams:
+            path = self.workdir/f'XX.SYN..HH.{int(duration)}s.mseed'
+            synthetic_day(path, duration=duration)
+            self._streams[duration] = read(str(path))
+        return self._streams[duration]
+
+    def _unet(self):
+        import torch
+        from ensemble_annotate import EnsembleAnnotator, UNet1D
+        if self._annotator is None:
+            torch.manual_seed(0)
+            self._annotator = EnsembleAnnotator(device='cpu')
+            if UNET_WEIGHTS.exists():
+                self._annotator.add_unet('unet', str(UNET_WEIGHTS))
+            else:
+                logger.warning(f'{UNET_WEIGHTS} not found, timing an untrained U-Net')
+                self._annotator.add_model('unet', UNet1D())
+        return self._annotator
+
+    def _preprocessed(self, duration):
+        from ensemble_annotate import preprocess
+        if duration not in self._chunks:
+            self._chunks[duration] = preprocess(self._stream(duration))
+        return self._chunks[duration]
+
+    def setup_unet_preprocess(self, duration):
+        from ensemble_annotate import preprocess
+        st = self._stream(duration)
+        return (preprocess, st), len(st)*st[0].stats.npts, 'samples'
+
+    def bench_unet_preprocess(self, preprocess, st):
+        preprocess(st)
+
+    def setup_unet_inference(self, duration):
+        annotator = self._unet()
+        chunks = self._preprocessed(duration)[0]
+        return (annotator, chunks), len(chunks), 'windows'
+
+    def bench_unet_inference(self, annotator, chunks):
+        annotator.predict(chunks)
+
+    def setup_unet_picks(self, duration):
+        from ensemble_annotate import find_picks
+        annotator = self._unet()
+        chunks, starttime, npts, _ = self._preprocessed(duration)
+        probs = annotator.predict(chunks)[0, :, :npts]
+        return (find_picks, probs, starttime, annotator.sampling_rate), probs.size, 'samples'
+
+    def bench_unet_picks(self, find_picks, probs, starttime, sampling_rate):
+        for _p in probs:
+            find_picks(_p, starttime, sampling_rate, threshold=0.1)
+
+    # --- pyrocko conversion ---
+    def setup_to_pyrocko(self, n):
+        try:
+            from obspy_compat2 import to_pyrocko_events_and_picks
+        except ImportError as e:
+            raise Skip(f'obspy_compat2 unavailable ({e})')
+        return (to_pyrocko_events_and_picks, synthetic_catalog(n)), n, 'events'
+
+    def bench_to_pyrocko(self, to_pyrocko_events_and_picks, catalog):
+        to_pyrocko_events_and_picks(catalog)
+
+    def run(self, names=None, scales=('small', 'medium')):
+        """Run the selected benchmarks at the selected scales
+
+        :param names: benchmark names, defaults to None (all benchmarks)
+        :type names: list of str, optional
+        :param scales: scale tiers to run, defaults to ('small', 'medium')
+        :type scales: tuple of str, optional
+        :return: one row per benchmark and input size
+        :rtype: pandas.DataFrame
+        """
+        rows = []
+        with self.server:
+            for name, tiers in SCALES.items():
+                if names is not None and name not in names:
+                    continue
+                for scale in scales:
+                    for size in tiers[scale]:
+                        row = {'benchmark': name, 'scale': scale, 'size': size}
+                        try:
+                            args, items, unit = getattr(self, f'setup_{name}')(size)
+                        except Skip as e:
+                            logger.warning(f'skipping {name}: {e}')
+                            rows.append(dict(row, status='skipped'))
+                            break
+                        times, peak = _measure(getattr(self, f'bench_{name}'), args, self.repeat)
+                        median = float(np.median(times))
+                        row.update(status='ok', items=items, unit=unit, best_s=min(times),
+                                   median_s=median, throughput=items/median if median > 0 else np.inf,
+                                   peak_mb=peak/2**20,
+                                   rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/2**10)
+                        logger.info(f'{name} [{scale} {size}]: {median:.4f} s, '
+                                    f'{row["throughput"]:.4g} {unit}/s, {row["peak_mb"]:.1f} MB')
+                        rows.append(row)
+        return pd.DataFrame(rows)
+
+
+def environment():
+    """Describe the machine and package versions results were measured with"""
+    info = {'python': platform.python_version(), 'platform': platform.platform(),
+            'processor': platform.processor(), 'cpu_count': os.cpu_count(),
+            'numpy': np.__version__, 'pandas': pd.__version__}
+    for module in ['obspy', 'torch', 'scipy']:
+        try:
+            info[module] = __import__(module).__version__
+        except ImportError:
+            info[module] = None
+    return info
+
+
+def save_results(df, path):
+    """Write results and the environment they were measured in to a JSON file"""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'environment': environment(),
+                   'results': json.loads(df.to_json(orient='records'))}, f, indent=1)
+
+
+def load_results(path):
+    """Read results written by `save_results`"""
+    with open(path, 'r') as f:
+        return pd.DataFrame(json.load(f)['results'])
+
+
+def compare(df, baseline, tolerance=0.25):
+    """Compare median times against a baseline
+
+    :param df: results of this run
+    :type df: pandas.DataFrame
+    :param baseline: baseline results
+    :type baseline: pandas.DataFrame
+    :param tolerance: allowed relative slowdown, defaults to 0.25
+    :type tolerance: float, optional
+    :return: ratio of median times (this run / baseline) per benchmark and size,
+        with a `regression` flag
+    :rtype: pandas.DataFrame
+    """
+    keys = ['benchmark', 'scale', 'size']
+    cols = keys + ['median_s', 'peak_mb']
+    ok = df[df.status == 'ok'][cols]
+    ok_base = baseline[baseline.status == 'ok'][cols]
+    out = ok.merge(ok_base, on=keys, suffixes=('', '_baseline'))
+    out['time_ratio'] = out.median_s/out.median_s_baseline
+    out['memory_ratio'] = out.peak_mb/out.peak_mb_baseline
+    out['regression'] = out.time_ratio > 1 + tolerance
+    return out
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the notebooks\' helper modules against local stand-ins')
+    parser.add_argument('--only', nargs='+', choices=list(SCALES), help='benchmarks to run')
+    parser.add_argument('--scales', nargs='+', default=['small', 'medium'],
+                        choices=['small', 'medium', 'large'], help='input scales to run')
+    parser.add_argument('--repeat', type=int, default=3, help='timed repetitions per case')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--save-baseline', metavar='NAME', help='save results as baselines/NAME.json')
+    parser.add_argument('--compare', metavar='NAME', help='compare against baselines/NAME.json')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='relative slowdown flagged as a regression')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(name)s %(levelname)s: %(message)s')
+
+    with tempfile.TemporaryDirectory() as workdir:
+        df = Suite(workdir, repeat=args.repeat).run(names=args.only, scales=args.scales)
+    with pd.option_context('display.width', 160, 'display.max_columns', 20):
+        print(df.to_string(index=False, float_format='{:.4g}'.format))
+    if args.output:
+        save_results(df, args.output)
+    if args.save_baseline:
+        save_results(df, BASELINE_DIR/f'{args.save_baseline}.json')
+    if args.compare:
+        out = compare(df, load_results(BASELINE_DIR/f'{args.compare}.json'), args.tolerance)
+        print(out.to_string(index=False, float_format='{:.3g}'.format))
+        if out.regression.any():
+            logger.error(f'{out.regression.sum():d} case(s) slower than baseline "{args.compare}" '
+                         f'by more than {args.tolerance:.0%}')
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
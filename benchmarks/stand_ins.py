@@ -0,0 +1,308 @@
+"""
+:module: benchmarks/stand_ins.py
+:org: Pacific Northwest Seismic Network
+:license: GPLv3
+:purpose: Local stand-ins for the live services and data the notebooks depend on,
+    so the benchmark suite runs offline and reproducibly:
+
+    - `StandInServer`, a local HTTP server answering MUSTANG measurements
+      (`format=text`) and fdsnws availability (`format=geocsv`) queries with
+      payloads in the real service formats. Metric values are recorded MUSTANG
+      values for UW.MBW (`notebooks/Nate/wave_qc_files/UW.MBW_MUSTANG_metrics.csv`),
+      repeated over the requested targets and days.
+    - `synthetic_day`, which writes a three-component MiniSEED file of noise with
+      impulsive P & S arrivals, standing in for a station-day from the archive.
+    - `synthetic_catalog`, an ObsPy Catalog of events with preferred origins and picks.
+"""
+import logging
+import threading
+import zlib
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qsl, urlparse
+
+import numpy as np
+import pandas as pd
+from obspy import Stream, Trace, UTCDateTime
+from obspy.core.event import (Catalog, Event, Origin, Pick, ResourceIdentifier,
+                              WaveformStreamID)
+
+logger = logging.getLogger('stand_ins')
+
+ROOT = Path(__file__).resolve().parent.parent
+MUSTANG_FIXTURE = ROOT/'notebooks'/'Nate'/'wave_qc_files'/'UW.MBW_MUSTANG_metrics.csv'
+
+GEOCSV_HEADER = ('#dataset: GeoCSV 2.0\n'
+                 '#delimiter: |\n'
+                 '#field_unit: unitless|unitless|unitless|unitless|unitless|hertz|ISO_8601|ISO_8601\n'
+                 '#field_type: string|string|string|string|string|float|datetime|datetime\n'
+                 'Network|Station|Location|Channel|Quality|SampleRate|Earliest|Latest\n')
+
+
+@lru_cache(maxsize=1)
+def _recorded_metrics():
+    """Recorded MUSTANG metric values, one array per metric"""
+    df = pd.read_csv(MUSTANG_FIXTURE)
+    return {_c: df[_c].values for _c in df.columns if _c not in ['start', 'target']}
+
+
+def _expand(value, default):
+    """Split a comma-delimited query value, substituting a default for wildcards"""
+    if value is None or '*' in value or '?' in value:
+        return list(default)
+    return value.split(',')
+
+
+def _days(query, default_days=7):
+    """Day start times covered by the start/end (or starttime/endtime) query parameters"""
+    start = UTCDateTime(query.get('start', query.get('starttime', '2025-01-01')))
+    if 'end' in query or 'endtime' in query:
+        end = UTCDateTime(query.get('end', query.get('endtime')))
+    else:
+        end = start + default_days*86400
+    start = UTCDateTime(start.date)
+    return [start + _d*86400 for _d in range(max(int(np.ceil((end - start)/86400)), 1))]
+
+
+def mustang_measurements_text(query):
+    """MUSTANG measurements payload in `format=text` for a query
+
+    One block per metric, each with a quoted title line, a quoted header line, and one
+    quoted row per target and day, as returned by service.iris.edu/mustang/measurements/1
+
+    :param query: query parameters (metric, net, sta, loc, cha, start, end)
+    :type query: dict
+    :return: payload text, or None if no metric is requested
+    :rtype: str or None
+    """
+    if 'metric' not in query:
+        return None
+    recorded = _recorded_metrics()
+    targets = [f'{_n}.{_s}.{_l}.{_c}.M'
+               for _n in _expand(query.get('net'), ['UW'])
+               for _s in _expand(query.get('sta'), ['MBW'])
+               for _l in _expand(query.get('loc'), ['01'])
+               for _c in _expand(query.get('cha'), ['EHZ'])]
+    days = _days(query)
+    lddate = (days[-1] + 2*86400).strftime('%Y/%m/%d %H:%M:%S.%f')
+    lines = []
+    for metric in query['metric'].split(','):
+        title = ' '.join(_w.capitalize() for _w in metric.split('_'))
+        values = recorded.get(metric)
+        if values is None:
+            values = np.arange(97, dtype=float)
+        lines.append(f'"{title} Metric"')
+        lines.append('"value","target","start","end","lddate"')
+        for _e, target in enumerate(targets):
+            for _d, day in enumerate(days):
+                value = values[(_e + _d) % len(values)]
+                lines.append(f'"{value}","{target}","{day.strftime("%Y/%m/%d %H:%M:%S.%f")}",'
+                             f'"{(day + 86400).strftime("%Y/%m/%d %H:%M:%S.%f")}","{lddate}"')
+    return '\n'.join(lines) + '\n'
+
+
+def availability_geocsv(query, segments_per_day=4):
+    """fdsnws availability payload in `format=geocsv` for a query
+
+    Each channel's time range is split into `segments_per_day` segments per day
+    separated by gaps of pseudo-random lengths, seeded by the channel code so
+    repeated queries return the same payload.
+
+    :param query: query parameters (net, sta, loc, cha, starttime, endtime)
+    :type query: dict
+    :param segments_per_day: number of continuous segments per channel and day, defaults to 4
+    :type segments_per_day: int, optional
+    :return: payload text
+    :rtype: str
+    """
+    days = _days(query)
+    t0, t1 = days[0].timestamp, days[-1].timestamp + 86400
+    n_seg = max(len(days)*segments_per_day, 1)
+    lines = [GEOCSV_HEADER]
+    for _n in _expand(query.get('net'), ['UW']):
+        for _s in _expand(query.get('sta'), ['MBW']):
+            for _l in _expand(query.get('loc'), ['01']):
+                for _c in _expand(query.get('cha'), ['EHZ']):
+                    rng = np.random.default_rng(zlib.crc32(f'{_n}.{_s}.{_l}.{_c}'.encode()))
+                    edges = np.linspace(t0, t1, n_seg + 1)
+                    gaps = rng.uniform(0, 0.1, n_seg)*(t1 - t0)/n_seg
+                    for _e in range(n_seg):
+                        start = UTCDateTime(edges[_e]).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+                        end = UTCDateTime(edges[_e + 1] - gaps[_e]).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+                        lines.append(f'{_n}|{_s}|{_l}|{_c}|M|100.0|{start}|{end}\n')
+    return ''.join(lines)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Route GET requests to the stand-in payload generators"""
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = dict(parse_qsl(url.query))
+        server = self.server
+        server.n_requests += 1
+        route = server.routes.get(url.path)
+        if route is None:
+            self.send_error(404, f'no stand-in for {url.path}')
+            return
+        body = server.payload(url.path, tuple(sorted(query.items())))
+        if body is None:
+            self.send_response(int(query.get('nodata', 404)))
+            self.end_headers()
+            return
+        data = body.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class StandInServer(object):
+    """Local HTTP stand-in for the IRIS MUSTANG and fdsnws availability webservices
+
+    Point a `ws_client` client at it by replacing the host in its `base_url`, e.g.
+    `client.base_url = server.base_url + '/mustang'`. Payloads are generated once
+    per distinct query and then served from memory, so timings measure the
+    client rather than the stand-in.
+
+    :param segments_per_day: availability segments per channel and day, defaults to 4
+    :type segments_per_day: int, optional
+    """
+    def __init__(self, segments_per_day=4):
+        self.segments_per_day = segments_per_day
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.n_requests = 0
+        self.httpd.routes = {
+            '/mustang/measurements/1/query': mustang_measurements_text,
+            '/fdsnws/availability/1/query': self._availability,
+            '/fdsnws/availability/1/extent': self._availability,
+        }
+        self.httpd.payload = lru_cache(maxsize=4096)(self._payload)
+        self.thread = None
+
+    def __repr__(self):
+        rstr = f'{self.__class__.__name__} ({self.base_url}, '
+        rstr += f'{self.n_requests:d} requests served)'
+        return rstr
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    @property
+    def n_requests(self):
+        return self.httpd.n_requests
+
+    def _availability(self, query):
+        return availability_geocsv(query, segments_per_day=self.segments_per_day)
+
+    def _payload(self, path, query):
+        return self.httpd.routes[path](dict(query))
+
+    def prepare(self, url):
+        """Generate and hold the payload for a query URL ahead of time
+
+        :param url: full query URL, as formed by a `ws_client` client
+        :type url: str
+        """
+        url = urlparse(url)
+        self.httpd.payload(url.path, tuple(sorted(parse_qsl(url.query))))
+
+    def start(self):
+        """Serve requests from a background thread"""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """Stop serving and release the port"""
+        if self.thread is not None:
+            self.httpd.shutdown()
+            self.thread.join()
+            self.thread = None
+        self.httpd.server_close()
+
+
+def synthetic_day(path, network='XX', station='SYN', location='', sampling_rate=100.,
+                  duration=86400., n_events=None, starttime=UTCDateTime('2022-12-20'), seed=0):
+    """Write a synthetic three-component (HHE, HHN, HHZ) MiniSEED file of
+    background noise with impulsive P (vertical) and S (horizontal) arrivals
+
+    :param path: output file path
+    :type path: str or pathlib.Path
+    :param duration: record length [s], defaults to 86400. (one day)
+    :type duration: float, optional
+    :param n_events: number of arrivals pairs, defaults to None (one every 10 minutes)
+    :type n_events: int, optional
+    :param seed: random seed, defaults to 0
+    :type seed: int, optional
+    :return: arrival times as (phase, UTCDateTime) pairs
+    :rtype: list of tuple
+    """
+    rng = np.random.default_rng(seed)
+    npts = int(duration*sampling_rate)
+    if n_events is None:
+        n_events = max(int(duration//600), 1)
+    data = rng.normal(0, 100, (3, npts))
+    # Decaying 5 Hz wavelets
+    t = np.arange(int(4*sampling_rate))/sampling_rate
+    wavelet = np.sin(2*np.pi*5*t)*np.exp(-t/0.5)
+    arrivals = []
+    for t_p in np.sort(rng.uniform(5, duration - 30, n_events)):
+        t_s = t_p + rng.uniform(3, 15)
+        amp = 10**rng.uniform(3, 4.5)
+        for comp, t_arr, scale in [(2, t_p, 1.), (0, t_s, 1.5), (1, t_s, 1.5)]:
+            i0 = int(t_arr*sampling_rate)
+            i1 = min(i0 + len(wavelet), npts)
+            data[comp, i0:i1] += amp*scale*wavelet[:i1 - i0]
+        arrivals += [('P', starttime + t_p), ('S', starttime + t_s)]
+    st = Stream()
+    for comp, channel in enumerate(['HHE', 'HHN', 'HHZ']):
+        header = {'network': network, 'station': station, 'location': location,
+                  'channel': channel, 'sampling_rate': sampling_rate, 'starttime': starttime}
+        st.append(Trace(data=data[comp].astype(np.int32), header=header))
+    st.write(str(path), format='MSEED', encoding='STEIM2', reclen=4096)
+    return arrivals
+
+
+def synthetic_catalog(n_events, n_picks=20, starttime=UTCDateTime('2022-12-20'), seed=0):
+    """An ObsPy Catalog of events with one preferred origin and `n_picks` picks each
+
+    :param n_events: number of events
+    :type n_events: int
+    :param n_picks: picks per event, defaults to 20
+    :type n_picks: int, optional
+    :return: catalog
+    :rtype: obspy.core.event.Catalog
+    """
+    rng = np.random.default_rng(seed)
+    cat = Catalog()
+    for _e in range(n_events):
+        t0 = starttime + rng.uniform(0, 86400)
+        origin = Origin(time=t0, latitude=40.5 + rng.normal(0, 0.1),
+                        longitude=-124.3 + rng.normal(0, 0.1), depth=rng.uniform(0, 30e3))
+        picks = []
+        for _p in range(n_picks):
+            wid = WaveformStreamID(network_code='XX', station_code=f'S{_p//2:03d}',
+                                   location_code='', channel_code='HHZ' if _p % 2 == 0 else 'HHE')
+            picks.append(Pick(time=t0 + rng.uniform(1, 30), waveform_id=wid,
+                              phase_hint='P' if _p % 2 == 0 else 'S',
+                              evaluation_mode='automatic'))
+        event = Event(resource_id=ResourceIdentifier(f'smi:local/event/{_e}'),
+                      origins=[origin], picks=picks)
+        event.preferred_origin_id = origin.resource_id
+        cat.append(event)
+    return cat
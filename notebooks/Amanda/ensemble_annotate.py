@@ -0,0 +1,323 @@
+"""
+Annotate continuous data with several phase-picking models at once.
+
+apply_unet.ipynb and seisbench.ipynb each read, merge, resample and normalize the
+same station-day before running a single model. Here a station-day is
+preprocessed once (merge, ENZ order, demean, resample, cut into 3001-sample
+chunks, demean each chunk) and the same chunks are sent to every registered
+model in batches. Only the cheap per-model steps (normalization and component
+order) are done per model, and models that share a normalization share the
+normalized batch.
+
+The output is one probability trace per model and phase, the combined
+traces (mean probability over models, and the number of models above the
+threshold), and picks for each model and for the ensemble.
+
+Example:
+    ens = EnsembleAnnotator()
+    ens.add_unet("unet_eq", "../Loic/UNet/model_weights_eq_only.pt")
+    ens.add_unet("unet_all", "../Loic/UNet/model_weights_alldata.pt")
+    ens.add_seisbench("PhaseNet", sbm.PhaseNet.from_pretrained("original"))
+    annotations, picks = ens.annotate(read("B047*"))
+"""
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from obspy import Stream, Trace, read
+from scipy.signal import find_peaks
+
+from stage_profiler import stage
+
+
+# U-Net Building Blocks (as in apply_unet.ipynb)
+class ConvBlock(nn.Module):
+    def __init__(self, in_channels, out_channels, kernel_size=3, padding=1):
+        super().__init__()
+        self.conv = nn.Sequential(
+            nn.Conv1d(in_channels, out_channels, kernel_size, padding=padding),
+            nn.ReLU(),
+            nn.Conv1d(out_channels, out_channels, kernel_size, padding=padding),
+            nn.ReLU()
+        )
+
+    def forward(self, x):
+        return self.conv(x)
+
+
+class UNet1D(nn.Module):
+    def __init__(self, in_channels=3, out_channels=3, features=[16, 32, 64, 128]):
+        super().__init__()
+        self.downs = nn.ModuleList()  # Encoder blocks (downsampling path)
+        self.ups = nn.ModuleList()    # Decoder blocks (upsampling path)
+        for feat in features:
+            self.downs.append(ConvBlock(in_channels, feat))
+            in_channels = feat
+        self.bottleneck = ConvBlock(features[-1], features[-1]*2)
+        for feat in features[::-1]:
+            self.ups.append(nn.ConvTranspose1d(feat*2, feat, kernel_size=2, stride=2))
+            self.ups.append(ConvBlock(feat*2, feat))
+        self.final_conv = nn.Conv1d(features[0], out_channels, kernel_size=1)
+
+    def forward(self, x):
+        skip_connections = []
+        for down in self.downs:
+            x = down(x)
+            skip_connections.append(x)
+            x = F.max_pool1d(x, kernel_size=2)
+        x = self.bottleneck(x)
+        skip_connections = skip_connections[::-1]
+        for idx in range(0, len(self.ups), 2):
+            x = self.ups[idx](x)
+            skip_conn = skip_connections[idx//2]
+            if x.shape[-1] != skip_conn.shape[-1]:
+                x = F.pad(x, (0, skip_conn.shape[-1] - x.shape[-1]))
+            x = torch.cat((skip_conn, x), dim=1)
+            x = self.ups[idx+1](x)
+        x = self.final_conv(x)
+        return F.softmax(x, dim=1)
+
+
+def ensure_ENZ_order(st):
+    """
+    Ensure a stream has channels in E, N, Z order.
+    Handles both E/N/Z and 1/2/Z naming conventions.
+    If only Z is present, creates dummy E and N traces filled with zeros.
+    """
+    comp_map = {}
+    for tr in st:
+        suffix = tr.stats.channel[-1].upper()
+        if suffix == "1":
+            comp_map["E"] = tr
+        elif suffix == "2":
+            comp_map["N"] = tr
+        else:
+            comp_map[suffix] = tr
+
+    if set(comp_map.keys()) == {"Z"}:
+        z_trace = comp_map["Z"]
+        e_trace = Trace(data=np.zeros(z_trace.stats.npts, dtype=np.float32), header=z_trace.stats.copy())
+        n_trace = Trace(data=np.zeros(z_trace.stats.npts, dtype=np.float32), header=z_trace.stats.copy())
+        e_trace.stats.channel = z_trace.stats.channel[:-1] + "E"
+        n_trace.stats.channel = z_trace.stats.channel[:-1] + "N"
+        return Stream(traces=[e_trace, n_trace, z_trace])
+
+    return Stream(traces=[comp_map[comp] for comp in ["E", "N", "Z"] if comp in comp_map])
+
+
+def preprocess(st, sampling_rate=100, chunk_size=3001):
+    """
+    Preprocess one station's stream once for all models, as in apply_unet.ipynb:
+    merge, ENZ order, demean, resample, cut into chunks and demean each chunk.
+    Returns the chunks (num_chunks, 3, chunk_size), the start time and the number
+    of samples before padding.
+    """
+    # Sample counts are passed lazily, so they are not summed while profiling is off
+    with stage("merge", items=lambda: sum(tr.stats.npts for tr in st)):
+        st = st.copy()
+        st.merge(fill_value="interpolate")
+    with stage("ensure_ENZ_order"):
+        st = ensure_ENZ_order(st)
+    if len(st) != 3:
+        raise ValueError(f"Expected E, N and Z components, got {[tr.stats.channel for tr in st]}")
+    with stage("resample", items=lambda: sum(tr.stats.npts for tr in st)):
+        st.detrend("demean")
+        for tr in st:
+            if tr.stats.sampling_rate != sampling_rate:
+                tr.resample(sampling_rate)
+
+    with stage("chunk", items=lambda: num_chunks):
+        # Put the components on a common time base
+        starttime = min(tr.stats.starttime for tr in st)
+        endtime = max(tr.stats.endtime for tr in st)
+        st.trim(starttime, endtime, pad=True, fill_value=0, nearest_sample=True)
+        npts = min(tr.stats.npts for tr in st)
+        data = np.stack([tr.data[:npts] for tr in st], axis=0).astype(np.float32)
+
+        # Pad with zeros at the end along the time axis and reshape to (num_chunks, 3, chunk_size)
+        remainder = npts % chunk_size
+        if remainder > 0:
+            data = np.pad(data, ((0, 0), (0, chunk_size - remainder)), mode="constant")
+        num_chunks = data.shape[1] // chunk_size
+        chunks = data.reshape(3, num_chunks, chunk_size).transpose(1, 0, 2)
+
+        # Demean each chunk along the time axis
+        chunks = chunks - chunks.mean(axis=2, keepdims=True)
+    return np.ascontiguousarray(chunks), starttime, npts, st[-1].stats
+
+
+def normalize(batch, norm="peak", per_component=True):
+    """
+    Normalize a batch of demeaned chunks (batch, 3, time) by the peak absolute
+    value or the standard deviation, per component or over all components.
+    """
+    dims = -1 if per_component else (-2, -1)
+    if norm == "peak":
+        scale = batch.abs().amax(dim=dims, keepdim=True)
+    elif norm == "std":
+        scale = batch.std(dim=dims, keepdim=True)
+    else:
+        raise ValueError(f"Unknown normalization '{norm}'")
+    return torch.where(scale > 0, batch / torch.where(scale > 0, scale, 1), torch.zeros_like(batch))
+
+
+def find_picks(probs, starttime, sampling_rate, threshold=0.1):
+    """
+    Picks at the peaks of a probability trace that exceed the threshold,
+    at least one second apart. Returns a list of (time, confidence) pairs.
+    """
+    peaks, _ = find_peaks(probs, height=threshold, distance=sampling_rate)
+    return [(starttime + peak_idx / sampling_rate, probs[peak_idx]) for peak_idx in peaks]
+
+
+class EnsembleAnnotator:
+    """
+    Run several phase-picking models on the same preprocessed chunks.
+
+    Args:
+        sampling_rate (float): Sampling rate the models were trained on [Hz]
+        chunk_size (int): Model input length in samples
+        batch_size (int): Chunks per forward pass
+        device (str or torch.device): Inference device
+    """
+    def __init__(self, sampling_rate=100, chunk_size=3001, batch_size=256, device="cpu"):
+        self.sampling_rate = sampling_rate
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+        self.device = torch.device(device)
+        self.models = {}
+
+    def add_model(self, name, model, labels="PSN", component_order="ENZ", norm="peak", per_component=True):
+        """
+        Register a model that maps (batch, 3, chunk_size) to class probabilities
+        (batch, len(labels), chunk_size).
+
+        Args:
+            name (str): Name used for the output traces and picks
+            model (torch.nn.Module): Trained model
+            labels (str): Output class order, e.g. "PSN" (U-Net) or "NPS"
+            component_order (str): Input component order, e.g. "ENZ" (U-Net) or "ZNE"
+            norm (str): "peak" or "std" normalization of each chunk
+            per_component (bool): Normalize each component separately
+        """
+        perm = ["ENZ".index(c) for c in component_order.upper().replace("1", "E").replace("2", "N")]
+        self.models[name] = {
+            "model": model.to(self.device).eval(),
+            "phases": [labels.index(phase) for phase in ["P", "S"]],
+            "perm": None if perm == [0, 1, 2] else torch.tensor(perm, device=self.device),
+            "norm": (norm, per_component),
+        }
+
+    def add_unet(self, name, path):
+        """Register a U-Net trained in make_unet_noseisbench.ipynb from its saved weights."""
+        model = UNet1D()
+        model.load_state_dict(torch.load(path, weights_only=True, map_location=self.device))
+        self.add_model(name, model, labels="PSN", component_order="ENZ", norm="peak", per_component=True)
+
+    def add_seisbench(self, name, model):
+        """Register a seisbench model (e.g., PhaseNet) using its own labels, component order and normalization."""
+        if getattr(model, "in_samples", self.chunk_size) != self.chunk_size:
+            raise ValueError(f"{name} expects {model.in_samples} samples, not {self.chunk_size}")
+        if getattr(model, "sampling_rate", self.sampling_rate) != self.sampling_rate:
+            raise ValueError(f"{name} expects {model.sampling_rate} Hz, not {self.sampling_rate} Hz")
+        self.add_model(name, model, labels=model.labels, component_order=model.component_order,
+                       norm=getattr(model, "norm", "std"), per_component=getattr(model, "norm_amp_per_comp", False))
+
+    @torch.inference_mode()
+    def predict(self, chunks):
+        """
+        Run every model on the chunks.
+
+        Returns:
+            np.ndarray: P and S probabilities (num_models, 2, num_chunks * chunk_size)
+        """
+        num_chunks = len(chunks)
+        probs = np.empty((len(self.models), 2, num_chunks, self.chunk_size), dtype=np.float32)
+        for b in range(0, num_chunks, self.batch_size):
+            batch = torch.from_numpy(chunks[b:b + self.batch_size]).to(self.device)
+            normalized = {}
+            for m, (name, spec) in enumerate(self.models.items()):
+                if spec["norm"] not in normalized:
+                    with stage("normalize", items=len(batch)):
+                        normalized[spec["norm"]] = normalize(batch, *spec["norm"])
+                x = normalized[spec["norm"]]
+                if spec["perm"] is not None:
+                    x = x.index_select(1, spec["perm"])
+                with stage(f"forward:{name}", items=len(batch)):
+                    pred = spec["model"](x)
+                    probs[m, :, b:b + len(batch)] = pred[:, spec["phases"]].cpu().numpy().transpose(1, 0, 2)
+        return probs.reshape(len(self.models), 2, -1)
+
+    def annotate(self, st, threshold=0.1, min_votes=None):
+        """
+        Preprocess a station's stream once and annotate it with every model.
+
+        Args:
+            st (obspy.Stream): Three-component (or Z only) data from one station
+            threshold (float): Probability threshold for picks and votes
+            min_votes (int, optional): Models that must exceed `threshold` for an
+                ensemble pick (defaults to a majority)
+
+        Returns:
+            tuple: (obspy.Stream of probability traces with channels "<model>_P",
+                "<model>_S", "mean_P", "mean_S", "vote_P", "vote_S";
+                pd.DataFrame of picks with columns model, phase, time, confidence)
+        """
+        if len(self.models) == 0:
+            raise ValueError("No models registered")
+        if min_votes is None:
+            min_votes = len(self.models) // 2 + 1
+        with stage("preprocess"):
+            chunks, starttime, npts, stats = preprocess(st, self.sampling_rate, self.chunk_size)
+        with stage("infer", items=len(chunks)):
+            probs = self.predict(chunks)[:, :, :npts]
+        with stage("pick", items=probs.size):
+            mean = probs.mean(axis=0)
+            votes = (probs >= threshold).sum(axis=0).astype(np.float32)
+
+            header = {"network": stats.network, "station": stats.station, "location": stats.location,
+                      "starttime": starttime, "sampling_rate": self.sampling_rate}
+            annotations = Stream()
+            rows = []
+            names = list(self.models) + ["mean", "vote"]
+            for name, trace in zip(names, list(probs) + [mean, votes]):
+                for phase_idx, phase in enumerate(["P", "S"]):
+                    annotations.append(Trace(data=trace[phase_idx], header=dict(header, channel=f"{name}_{phase}")))
+                    if name == "vote":
+                        continue
+                    if name == "mean":
+                        # Ensemble picks: peaks of the mean where enough models agree
+                        probs_phase = np.where(votes[phase_idx] >= min_votes, mean[phase_idx], 0)
+                        pick_name = "ensemble"
+                    else:
+                        probs_phase = trace[phase_idx]
+                        pick_name = name
+                    for time, confidence in find_picks(probs_phase, starttime, self.sampling_rate, threshold):
+                        rows.append([pick_name, phase, time, confidence])
+            picks = pd.DataFrame(rows, columns=["model", "phase", "time", "confidence"])
+        return annotations, picks
+
+
+def write_picks(picks, model, output_file):
+    """Write one model's picks in the phase, time, confidence format of apply_unet.ipynb."""
+    df = picks[picks["model"] == model].sort_values("time")
+    with stage("write", items=len(df)):
+        df = df.assign(confidence=df["confidence"].map(lambda c: f"{c:.3f}"))
+        df[["phase", "time", "confidence"]].to_csv(output_file, index=False)
+
+
+def pick_station_day(path, annotator, output_file, model="ensemble", threshold=0.1):
+    """
+    Read one station-day (a MiniSEED file or glob), annotate it and write one
+    model's picks: the read -> preprocess -> infer -> pick -> write pipeline,
+    with each step recorded as a stage when `stage_profiler` is enabled.
+
+    Returns:
+        pd.DataFrame: All picks from `EnsembleAnnotator.annotate`
+    """
+    with stage("read", items=lambda: sum(tr.stats.npts for tr in st)):
+        st = read(path)
+    _, picks = annotator.annotate(st, threshold=threshold)
+    write_picks(picks, model, output_file)
+    return picks
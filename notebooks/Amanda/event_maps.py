@@ -0,0 +1,364 @@
+"""
+Event and station maps with cached base layers.
+
+`MapRenderer` draws maps of a region with stations, background seismicity and
+events (optionally with a focal mechanism), e.g. one map per event for a review
+page (`render_events`):
+
+- the coastline resolution is picked from the size of the map region,
+- faults, stations and catalog events are clipped to the region before plotting,
+- all station labels are drawn with a single `fig.text` call,
+- the static base layer (coastline, borders and faults) is rendered once per
+  region/projection to a PNG in `cache_dir` and pasted into every later figure
+  with the same region/projection, so hundreds of event maps only render each
+  base layer once.
+
+Event maps are centered on a grid of `snap` degrees so that nearby events share
+the same region and base layer.
+
+Example:
+    renderer = MapRenderer(stations="station_file.txt", faults="gem_active_faults.gmt")
+    fig = renderer.event_map(40.525, -124.423, 17.91, 6.4, catalog=catalog)
+    fig.savefig("event.png")
+"""
+import hashlib
+import os
+import re
+
+import numpy as np
+import pandas as pd
+import pygmt
+
+# Coastline resolution by largest region side [deg], coarser above the last one
+COAST_RESOLUTIONS = [(1.0, "f"), (4.0, "h"), (15.0, "i"), (60.0, "l")]
+
+# Parsed fault files, keyed on (path, modification time)
+_SEGMENTS = {}
+
+
+def coast_resolution(region):
+    """
+    Pick a GMT coastline resolution suited to the region size.
+
+    Args:
+        region (list): [west, east, south, north] in degrees
+
+    Returns:
+        str: One of "f", "h", "i", "l", "c"
+    """
+    extent = max(region[1] - region[0], region[3] - region[2])
+    for max_extent, resolution in COAST_RESOLUTIONS:
+        if extent <= max_extent:
+            return resolution
+    return "c"
+
+
+def in_region(lon, lat, region, pad=0.0):
+    """
+    Boolean mask of points inside a (padded) region.
+    """
+    lon = np.asarray(lon, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+    return ((lon >= region[0] - pad) & (lon <= region[1] + pad) &
+            (lat >= region[2] - pad) & (lat <= region[3] + pad))
+
+
+def read_segments(path):
+    """
+    Read a GMT multi-segment line file (e.g. gem_active_faults.gmt).
+
+    The file is parsed once per process (and again if it changes on disk).
+
+    Args:
+        path (str): Path to the file, segments separated by lines starting with ">"
+
+    Returns:
+        tuple: (list of [npts, 2] lon/lat arrays, [nseg, 4] west/east/south/north bounds)
+    """
+    key = (os.path.abspath(path), os.path.getmtime(path))
+    if key not in _SEGMENTS:
+        segments, current = [], []
+        with open(path, "r") as f:
+            for line in f:
+                if line.startswith(">"):
+                    if current:
+                        segments.append(np.array(current, dtype=float))
+                    current = []
+                elif line.strip() and not line.startswith("#"):
+                    current.append(line.split()[:2])
+        if current:
+            segments.append(np.array(current, dtype=float))
+        bounds = np.array([[s[:, 0].min(), s[:, 0].max(), s[:, 1].min(), s[:, 1].max()]
+                           for s in segments]).reshape(-1, 4)
+        _SEGMENTS[key] = (segments, bounds)
+    return _SEGMENTS[key]
+
+
+def clip_segments(path, region):
+    """
+    Keep the segments of a GMT multi-segment file whose bounds overlap the region.
+
+    Segments crossing the map edge are kept whole, GMT clips them at the frame.
+
+    Args:
+        path (str): Path to the GMT multi-segment file
+        region (list): [west, east, south, north] in degrees
+
+    Returns:
+        list: [npts, 2] lon/lat arrays
+    """
+    segments, bounds = read_segments(path)
+    overlap = ((bounds[:, 1] >= region[0]) & (bounds[:, 0] <= region[1]) &
+               (bounds[:, 3] >= region[2]) & (bounds[:, 2] <= region[3]))
+    return [segments[i] for i in np.flatnonzero(overlap)]
+
+
+def write_segments(segments, path):
+    """
+    Write lon/lat segments as a GMT multi-segment file.
+    """
+    with open(path, "w") as f:
+        for s in segments:
+            f.write(">\n")
+            np.savetxt(f, s, fmt="%.6f")
+
+
+def map_width(projection):
+    """
+    Map width of a GMT projection string, e.g. "M10i" -> "10i".
+    """
+    match = re.search(r"(\d+(\.\d*)?[cip]?)$", projection)
+    if match is None:
+        raise ValueError(f"cannot read the map width from projection '{projection}'")
+    return match.group(1)
+
+
+def event_region(lat, lon, half_width=0.5, snap=0.25):
+    """
+    Square-ish map region around an event, centered on a grid of `snap` degrees
+    so that nearby events share a region (and a cached base layer).
+
+    Args:
+        lat (float): Event latitude [deg]
+        lon (float): Event longitude [deg]
+        half_width (float): Half of the region height [deg]; the width is scaled
+            by 1/cos(latitude) so the map is about square
+        snap (float): Grid spacing of region centers [deg]
+
+    Returns:
+        list: [west, east, south, north]
+    """
+    lat_c = round(lat / snap) * snap
+    lon_c = round(lon / snap) * snap
+    half_lon = half_width / np.cos(np.radians(lat_c))
+    return [round(float(lon_c - half_lon), 6), round(float(lon_c + half_lon), 6),
+            round(float(lat_c - half_width), 6), round(float(lat_c + half_width), 6)]
+
+
+class MapRenderer:
+    """
+    Render event and station maps on cached base layers.
+
+    Args:
+        stations (str or pd.DataFrame, optional): Station file ("Station, Latitude,
+            Longitude, Elevation", e.g. station_file.txt) or table with those columns
+        faults (str, optional): GMT multi-segment fault file (e.g. gem_active_faults.gmt)
+        cache_dir (str): Directory where rendered base layers are kept
+        dpi (int): Resolution of the cached base layers
+        coast (dict, optional): Keyword arguments for `fig.coast` (resolution is
+            chosen from the region unless given)
+        fault_pen (str): Pen used for faults
+    """
+    def __init__(self, stations=None, faults=None, cache_dir="map_cache", dpi=300,
+                 coast=None, fault_pen="1p,darkred"):
+        if isinstance(stations, str):
+            stations = pd.read_csv(stations, sep=r",\s*", engine="python")
+            stations.columns = [c.strip() for c in stations.columns]
+            stations["Station"] = stations["Station"].str.strip()
+        self.stations = stations
+        self.faults = faults
+        self.cache_dir = cache_dir
+        self.dpi = dpi
+        if coast is None:
+            coast = dict(shorelines="1/0.5p,black", water="lightblue", land="gray95", borders="a")
+        self.coast = coast
+        self.fault_pen = fault_pen
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _base_key(self, region, projection):
+        """Cache key of a base layer: everything that changes how it looks."""
+        faults = None
+        if self.faults is not None:
+            faults = (os.path.abspath(self.faults), os.path.getmtime(self.faults), self.fault_pen)
+        key = repr(([round(float(r), 6) for r in region], projection, sorted(self.coast.items()), faults, self.dpi))
+        return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+    def base_layer(self, region, projection):
+        """
+        Path to the rendered base layer (coastline, borders, faults) of a map,
+        rendering it only if it is not cached yet.
+
+        The layer is drawn without a frame and cropped to the map area, so it can be
+        placed exactly over a map with the same region and projection.
+
+        Args:
+            region (list): [west, east, south, north] in degrees
+            projection (str): Rectangular GMT projection, e.g. "M10i"
+
+        Returns:
+            str: Path to the PNG base layer
+        """
+        path = os.path.join(self.cache_dir, f"base_{self._base_key(region, projection)}.png")
+        if os.path.exists(path):
+            self.hits += 1
+            return path
+        self.misses += 1
+
+        fig = pygmt.Figure()
+        fig.basemap(region=region, projection=projection, frame="+n")
+        coast = {"resolution": coast_resolution(region), **self.coast}
+        fig.coast(**coast)
+        if self.faults is not None:
+            # Only the faults overlapping the region are handed to GMT
+            segments = clip_segments(self.faults, region)
+            if segments:
+                faults_file = path[:-len(".png")] + "_faults.gmt"
+                write_segments(segments, faults_file)
+                fig.plot(data=faults_file, pen=self.fault_pen)
+                os.remove(faults_file)
+        # Write to a temporary name first so an interrupted render is never reused
+        fig.savefig(path[:-len(".png")] + "_tmp.png", dpi=self.dpi, crop=True)
+        os.replace(path[:-len(".png")] + "_tmp.png", path)
+        return path
+
+    def figure(self, region, projection="M10i", frame="a", title=None):
+        """
+        New figure with the cached base layer and the map frame.
+
+        Args:
+            region (list): [west, east, south, north] in degrees
+            projection (str): Rectangular GMT projection, e.g. "M10i"
+            frame (str): Frame settings
+            title (str, optional): Map title
+
+        Returns:
+            pygmt.Figure: Figure ready for event, station and mechanism layers
+        """
+        base = self.base_layer(region, projection)
+        fig = pygmt.Figure()
+        fig.basemap(region=region, projection=projection, frame="+n")
+        fig.image(imagefile=base, position=f"x0/0+w{map_width(projection)}+jBL")
+        frame = [frame, f"+t{title}"] if title else frame
+        fig.basemap(frame=frame)
+        if self.faults is not None:
+            # The faults are part of the raster base layer; this invisible line only adds
+            # their legend entry
+            fig.plot(x=[region[0] - 1, region[0] - 1], y=[region[2] - 1, region[2] - 1],
+                     pen=self.fault_pen, label="Faults")
+        return fig
+
+    def plot_stations(self, fig, region, labels=True, style="t0.5c", fill="blue",
+                      font="14p,Helvetica,black", offset="0.3c/0.6c"):
+        """
+        Plot the stations inside the region, with all labels in one call.
+        """
+        if self.stations is None:
+            return
+        df = self.stations[in_region(self.stations["Longitude"], self.stations["Latitude"], region)]
+        if len(df) == 0:
+            return
+        fig.plot(x=df["Longitude"], y=df["Latitude"], style=style, fill=fill, pen="black",
+                 label="Stations")
+        if labels:
+            fig.text(x=df["Longitude"], y=df["Latitude"], text=df["Station"].tolist(),
+                     font=font, offset=offset)
+
+    def plot_catalog(self, fig, region, catalog, style="c0.2c", cmap="viridis", colorbar=True):
+        """
+        Plot the catalog events inside the region, colored by depth.
+
+        Args:
+            fig (pygmt.Figure): Figure to draw on
+            region (list): [west, east, south, north] in degrees
+            catalog (pd.DataFrame): Events with longitude, latitude and depth [km] columns
+            style (str): Symbol style
+            cmap (str): Depth color map
+            colorbar (bool): Add a depth color bar
+        """
+        df = catalog[in_region(catalog["longitude"], catalog["latitude"], region)]
+        if len(df) == 0:
+            return
+        zmin, zmax = df["depth"].min(), df["depth"].max()
+        if zmax <= zmin:
+            zmax = zmin + 1
+        pygmt.makecpt(cmap=cmap, series=[zmin, zmax])
+        fig.plot(x=df["longitude"], y=df["latitude"], style=style, fill=df["depth"], cmap=True)
+        if colorbar:
+            fig.colorbar(frame="xaf+lDepth (km)")
+
+    def event_map(self, lat, lon, depth=None, magnitude=None, catalog=None, focal_mech=None,
+                  region=None, projection="M6i", half_width=0.5, snap=0.25, title=None,
+                  labels=True):
+        """
+        Map of one event with nearby stations, catalog seismicity and (optionally)
+        its focal mechanism.
+
+        Args:
+            lat (float): Event latitude [deg]
+            lon (float): Event longitude [deg]
+            depth (float, optional): Event depth [km], for the focal mechanism
+            magnitude (float, optional): Event magnitude, for the focal mechanism
+            catalog (pd.DataFrame, optional): Background events (longitude, latitude, depth)
+            focal_mech (dict, optional): strike, dip and rake of the event
+            region (list, optional): Map region; defaults to `event_region(lat, lon, half_width, snap)`
+            projection (str): Rectangular GMT projection
+            half_width (float): Half of the region height [deg] when the region is not given
+            snap (float): Grid spacing of region centers [deg] when the region is not given
+            title (str, optional): Map title
+            labels (bool): Label the stations
+
+        Returns:
+            pygmt.Figure: The event map
+        """
+        if region is None:
+            region = event_region(lat, lon, half_width, snap)
+        fig = self.figure(region, projection, title=title)
+        self.plot_stations(fig, region, labels=labels)
+        if catalog is not None:
+            self.plot_catalog(fig, region, catalog)
+        fig.plot(x=[lon], y=[lat], style="a1.0c", fill="red", pen="black", label="Event")
+        if focal_mech is not None:
+            spec = dict(focal_mech)
+            if magnitude is not None:
+                spec.setdefault("magnitude", magnitude)
+            fig.meca(spec=spec, scale="2c", longitude=lon, latitude=lat,
+                     depth=depth if depth is not None else 0,
+                     compressionfill="lightorange")
+        return fig
+
+    def render_events(self, events, output_dir, catalog=None, fmt="png", **kwargs):
+        """
+        Write one event map per event, e.g. for a per-event review page.
+
+        Args:
+            events (pd.DataFrame): Events with event_id, latitude, longitude, depth
+                and magnitude columns
+            output_dir (str): Directory for the maps, named "{event_id}.{fmt}"
+            catalog (pd.DataFrame, optional): Background events (longitude, latitude, depth)
+            fmt (str): Image format
+            **kwargs: Passed to `event_map`
+
+        Returns:
+            list: Paths of the written maps, in event order
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        paths = []
+        for event in events.itertuples(index=False):
+            fig = self.event_map(event.latitude, event.longitude, event.depth, event.magnitude,
+                                 catalog=catalog, title=str(event.event_id), **kwargs)
+            path = os.path.join(output_dir, f"{event.event_id}.{fmt}")
+            fig.savefig(path)
+            paths.append(path)
+        return paths
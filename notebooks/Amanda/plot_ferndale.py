@@ -11,9 +11,7 @@ Plot the Ferndale earthquake
 import pygmt
 import pandas as pd
 
-# Load station data
-df = pd.read_csv("./station_file.txt", 
-                 delimiter=', ')
+from event_maps import MapRenderer
 
 # Ferndale earthquake info (USGS event ID: nc73798970)
 eq_lat = 40.52500   
@@ -25,49 +23,24 @@ eq_mag = 6.4
 # Approximate for this event (strike-slip): 150, 90, 0
 focal_mech  = {"strike": 252, "dip": 89, "rake": 7, "magnitude": 6.4}
 
-# Initialize map
-fig = pygmt.Figure()
-
 # Region around northern CA (adjust as needed)
 region = [-124.75, -123, 39.25, 41.25]
 
-# Base map
-fig.basemap(region=region, 
-            projection="M10i", 
-            frame=["a", "+t2022 Ferndale Earthquake"]
-            )
-fig.coast(shorelines="1/0.5p,black", 
-          water="lightblue", 
-          land="gray95", 
-          borders="a", 
-          resolution="f")
+# Base map (coastline and faults clipped to the region), rendered once and cached in map_cache/
+renderer = MapRenderer(stations="./station_file.txt",
+                       faults="./gem_active_faults.gmt")
+fig = renderer.figure(region,
+                      projection="M10i",
+                      title="2022 Ferndale Earthquake")
 
-# Plot stations
-fig.plot(x=df["Longitude"], 
-         y=df["Latitude"], 
-         style="t0.5c", 
-         fill="blue", 
-         pen="black", 
-         label="Stations")
+# Plot stations, with all station names in one call
+renderer.plot_stations(fig, region)
 
-# Add station names
-for _, row in df.iterrows():
-    fig.text(x=row["Longitude"], 
-             y=row["Latitude"], 
-             text=row["Station"], 
-             font="14p,Helvetica,black", 
-             offset="0.3c/0.6c")
-    
 # Read earthquake
 cols = ["Date","Time","Lat","Lon","Depth","Mag","Magt","Nst","Gap","Clo","RMS","SRC","Event ID"]
-df = pd.read_csv("./ncedc.eqs", delim_whitespace=True, skiprows=13, names=cols)
-pygmt.makecpt(cmap="viridis", series=[df["Depth"].min(), df["Depth"].max()])
-fig.plot(x=df["Lon"], 
-         y=df["Lat"], 
-         style="c0.2c", 
-         fill=df["Depth"], 
-         cmap=True) 
-fig.colorbar(frame="xaf+lDepth (km)")
+df = pd.read_csv("./ncedc.eqs", sep=r"\s+", skiprows=13, names=cols)
+catalog = df.rename(columns={"Lat": "latitude", "Lon": "longitude", "Depth": "depth"})
+renderer.plot_catalog(fig, region, catalog)
 
 # Plot earthquake location
 fig.plot(x=[eq_lon], 
@@ -88,11 +61,6 @@ fig.meca(spec=focal_mech,
          offset="+p1p,darkblue+s0.25c",
          compressionfill="lightorange")
 
-# Plot Faults
-fig.plot(data="./gem_active_faults.gmt", 
-         pen="1p,darkred", 
-         label="Faults")
-
 # Add legend
 pygmt.config(FONT_ANNOT_PRIMARY="25p,Helvetica,black")
 fig.legend(position="JTR+o-6c", box=True)
@@ -0,0 +1,291 @@
+"""
+Per-stage timing for the picking pipeline (read -> preprocess -> infer -> pick -> write).
+
+Wrap a stage in `with stage("name"):` or decorate a function with `@profiled("name")`.
+Each stage records wall time, CPU time, peak memory allocated during the stage and
+the number of items it processed (samples, chunks, picks...). Stages can be nested;
+a nested stage is reported as "outer/inner".
+
+Profiling is off by default. While it is off, `stage` returns a shared no-op
+context manager and `profiled` functions call straight through, so the hooks
+can stay in the pipeline code. Item counts that take work to compute should be
+passed as callables (`items=lambda: ...`): they are only evaluated when the stage
+is recorded, at the end of the `with` block, so they can also use results of it.
+If the block raises, the callable is not called; the stage is recorded with no
+item count and the exception's type name as `error`, and the exception propagates.
+
+Notes:
+    CPU time is process CPU time, so it includes PyTorch's worker threads and can
+    exceed the wall time. Peak memory comes from `tracemalloc`, which sees Python
+    and NumPy allocations but not PyTorch's own allocator, and slows down
+    allocation-heavy code; it can be turned off with `enable(memory=False)`.
+
+Example:
+    import stage_profiler
+    stage_profiler.enable()
+    annotations, picks = ens.annotate(read("B047*"))
+    print(stage_profiler.summary())
+    stage_profiler.write_chrome_trace("annotate_trace.json")  # open in chrome://tracing or Perfetto
+"""
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+import pandas as pd
+
+
+class _NullStage:
+    """No-op stand-in returned by `stage` while profiling is off (shared, so it keeps no state)."""
+    __slots__ = ()
+
+    @property
+    def items(self):
+        return None
+
+    @items.setter
+    def items(self, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    """One running stage. `items` can also be set inside the `with` block."""
+    def __init__(self, profiler, name, items):
+        self.profiler = profiler
+        self.name = name
+        self.items = items
+
+    def __enter__(self):
+        self.profiler._push(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.profiler._pop(self, exc_type)
+        return False
+
+
+class StageProfiler:
+    """
+    Collect per-stage wall time, CPU time, peak allocation and item counts.
+
+    Args:
+        enabled (bool): Record stages (otherwise hooks are no-ops)
+        memory (bool): Track peak allocation per stage with tracemalloc
+    """
+    def __init__(self, enabled=False, memory=True):
+        self.enabled = enabled
+        self.memory = memory
+        self.records = []
+        self._local = threading.local()
+        self._t0 = time.perf_counter()
+        self._started_tracemalloc = False
+
+    def enable(self, memory=None):
+        """Start recording stages (optionally changing whether memory is tracked)."""
+        if memory is not None:
+            self.memory = memory
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        self.enabled = True
+
+    def disable(self):
+        """Stop recording stages; records collected so far are kept."""
+        self.enabled = False
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    def reset(self):
+        """Drop all records and restart the trace clock."""
+        self.records = []
+        self._t0 = time.perf_counter()
+
+    def stage(self, name, items=None):
+        """
+        Context manager timing one stage.
+
+        Args:
+            name (str): Stage name
+            items (int or callable, optional): Number of items processed, or a function
+                without arguments returning it, called at the end of the stage only
+                while profiling is on
+        """
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name, items)
+
+    def profiled(self, name=None, items=None):
+        """
+        Decorator timing every call of a function as a stage.
+
+        Args:
+            name (str, optional): Stage name, defaults to the function name
+            items (callable, optional): Maps the function's return value to an item count
+        """
+        def decorator(func):
+            stage_name = name or func.__name__
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with self.stage(stage_name) as s:
+                    result = func(*args, **kwargs)
+                    if items is not None:
+                        s.items = items(result)
+                return result
+            return wrapper
+        return decorator
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _push(self, s):
+        stack = self._stack()
+        s.path = "/".join([parent.name for parent in stack] + [s.name])
+        s.depth = len(stack)
+        s.tracing = self.memory and tracemalloc.is_tracing()
+        if s.tracing:
+            # tracemalloc keeps a single peak: hand the peak so far to the enclosing
+            # stage before resetting it for this one
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, peak)
+            tracemalloc.reset_peak()
+            s.base = current
+            s.peak = current
+        stack.append(s)
+        s.cpu = time.process_time()
+        s.start = time.perf_counter()
+
+    def _pop(self, s, exc_type=None):
+        end = time.perf_counter()
+        cpu = time.process_time() - s.cpu
+        stack = self._stack()
+        stack.pop()
+        peak = None
+        if s.tracing and tracemalloc.is_tracing():
+            s.peak = max(s.peak, tracemalloc.get_traced_memory()[1])
+            peak = s.peak - s.base
+            if stack and getattr(stack[-1], "tracing", False):
+                stack[-1].peak = max(stack[-1].peak, s.peak)
+            tracemalloc.reset_peak()
+        # A stage that raised has no item count: its `items` callable may rely on
+        # results that were never produced, and must not mask the original error
+        if exc_type is None:
+            items = s.items() if callable(s.items) else s.items
+            error = None
+        else:
+            items = None
+            error = exc_type.__name__
+        self.records.append({"stage": s.path, "name": s.name, "depth": s.depth,
+                             "start": s.start - self._t0, "wall": end - s.start, "cpu": cpu,
+                             "peak": peak, "items": items, "error": error,
+                             "thread": threading.get_ident()})
+
+    def summary(self):
+        """
+        Per-stage totals over all calls.
+
+        Returns:
+            pd.DataFrame: One row per stage path with calls, errors (calls that raised),
+                wall_s, cpu_s, peak_mb (largest peak of any call), items, items_per_s and
+                pct (share of the total wall time of top-level stages)
+        """
+        columns = ["calls", "errors", "wall_s", "cpu_s", "peak_mb", "items", "items_per_s", "pct"]
+        if not self.records:
+            return pd.DataFrame(columns=columns, index=pd.Index([], name="stage"))
+        df = pd.DataFrame(self.records)
+        df["peak_mb"] = df["peak"].astype(float) / 2**20
+        df["items"] = df["items"].astype(float)
+        grouped = df.groupby("stage", sort=False)
+        out = pd.DataFrame({
+            "calls": grouped.size(),
+            "errors": grouped["error"].count(),
+            "wall_s": grouped["wall"].sum(),
+            "cpu_s": grouped["cpu"].sum(),
+            "peak_mb": grouped["peak_mb"].max(),
+            "items": grouped["items"].sum(min_count=1),
+        })
+        out["items_per_s"] = out["items"] / out["wall_s"]
+        total = df.loc[df["depth"] == 0, "wall"].sum()
+        out["pct"] = 100 * out["wall_s"] / total if total > 0 else float("nan")
+        # Order stages by when they first ran, so nested stages follow their parent
+        return out.loc[df.sort_values("start").drop_duplicates("stage")["stage"]][columns]
+
+    def chrome_trace(self):
+        """
+        The records as Chrome trace events (for chrome://tracing or ui.perfetto.dev).
+
+        Returns:
+            dict: {"traceEvents": [...]} with one complete ("X") event per stage call
+        """
+        pid = os.getpid()
+        events = []
+        for r in self.records:
+            args = {"cpu_s": r["cpu"], "items": r["items"]}
+            if r["peak"] is not None:
+                args["peak_mb"] = r["peak"] / 2**20
+            if r["error"] is not None:
+                args["error"] = r["error"]
+            events.append({"name": r["name"], "cat": r["stage"], "ph": "X",
+                           "ts": r["start"] * 1e6, "dur": r["wall"] * 1e6,
+                           "pid": pid, "tid": r["thread"], "args": args})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write_chrome_trace(self, path):
+        """Write the records as a Chrome trace JSON file."""
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f)
+
+
+# Shared profiler used by the pipeline hooks
+profiler = StageProfiler()
+
+
+def stage(name, items=None):
+    """Context manager timing a stage with the shared profiler (no-op while disabled)."""
+    if not profiler.enabled:
+        return _NULL_STAGE
+    return _Stage(profiler, name, items)
+
+
+def profiled(name=None, items=None):
+    """Decorator timing a function as a stage with the shared profiler."""
+    return profiler.profiled(name, items)
+
+
+def enable(memory=True):
+    """Turn on the shared profiler, starting from empty records."""
+    profiler.reset()
+    profiler.enable(memory=memory)
+
+
+def disable():
+    """Turn off the shared profiler (records are kept)."""
+    profiler.disable()
+
+
+def summary():
+    """Summary table of the shared profiler."""
+    return profiler.summary()
+
+
+def write_chrome_trace(path):
+    """Write the shared profiler's records as a Chrome trace JSON file."""
+    profiler.write_chrome_trace(path)
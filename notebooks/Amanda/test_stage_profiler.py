@@ -0,0 +1,50 @@
+"""
+Tests for `stage_profiler`: stages that raise must re-raise the original exception
+without evaluating their lazy item counts.
+"""
+import pytest
+
+from stage_profiler import StageProfiler
+
+
+@pytest.fixture
+def profiler():
+    return StageProfiler(enabled=True, memory=False)
+
+
+def test_lazy_items_after_stage():
+    prof = StageProfiler(enabled=True, memory=False)
+    with prof.stage("read", items=lambda: len(st)):
+        st = [1, 2, 3]
+    assert prof.records[0]["items"] == 3
+    assert prof.records[0]["error"] is None
+
+
+def test_raising_stage_keeps_original_exception(profiler):
+    calls = []
+
+    def count():
+        calls.append(1)
+        return len(st)
+
+    with pytest.raises(FileNotFoundError) as info:
+        with profiler.stage("read", items=count):
+            raise FileNotFoundError("/nonexistent/*.mseed")
+            st = []  # noqa: F841 (never reached, like the results the items callable uses)
+    assert str(info.value) == "/nonexistent/*.mseed"
+    assert info.value.__context__ is None
+    assert calls == []
+    record = profiler.records[0]
+    assert record["items"] is None
+    assert record["error"] == "FileNotFoundError"
+
+
+def test_raising_nested_stage_is_recorded(profiler):
+    with pytest.raises(ValueError):
+        with profiler.stage("annotate"):
+            with profiler.stage("merge", items=lambda: 1 / 0):
+                raise ValueError("bad merge")
+    summary = profiler.summary()
+    assert summary.loc["annotate/merge", "errors"] == 1
+    assert summary.loc["annotate", "errors"] == 1
+    assert profiler.chrome_trace()["traceEvents"][0]["args"]["error"] == "ValueError"
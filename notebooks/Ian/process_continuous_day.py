@@ -0,0 +1,1267 @@
+## Processing of one day of picks with GENIE (detection, association and location),
+## as in tutorial_run_genie.
+##
+## load_shared_state loads everything that does not depend on the day processed
+## (settings, region, stations, templates, travel times, trained models, the sampling
+## grid and fixed time steps) into a dict whose keys are the variable names used in
+## tutorial_run_genie, and process_day(state, date, day_select, offset_select) runs the
+## per-day steps with it:
+##
+## load_day_picks -> set_adjacencies -> detect_sources -> associate_sources ->
+## locate_sources -> compute_magnitudes -> save_day
+##
+## The notebook calls the same functions (so the notebook and scheduled runs can not
+## drift apart), and schedule_continuous_days runs process_day for many days over a pool
+## of workers, each loading the shared state once.
+##
+## Random draws (the template grids used, and the query points used to refine sources)
+## are seeded from (day_select, offset_select), so re-running a day gives the same result.
+
+import os
+import time
+
+import yaml
+import h5py
+import numpy as np
+import torch
+import networkx as nx
+from torch.autograd import Variable
+from torch_cluster import knn
+from torch_geometric.data import Data
+from scipy.signal import find_peaks
+from scipy.spatial import cKDTree
+from scipy.spatial import ConvexHull
+from scipy.stats import chi2
+from sklearn.cluster import SpectralClustering
+from obspy.core import UTCDateTime
+
+from utils import *
+from module import *
+from process_utils import *
+
+def load_shared_state(path_to_file, device = None):
+	## Load everything tutorial_run_genie sets up before the per-day processing.
+	## None of it depends on the day processed. device defaults to process_config['device'].
+
+	seperator = '\\' if '\\' in path_to_file else '/'
+	if path_to_file[-1] != seperator:
+		path_to_file += seperator
+
+	with open(path_to_file + 'process_config.yaml', 'r') as file:
+		process_config = yaml.safe_load(file)
+
+	with open(path_to_file + 'config.yaml', 'r') as file:
+		config = yaml.safe_load(file)
+
+	if device is None:
+		device = process_config['device']
+	device = torch.device(device)
+	if (device.type == 'cuda')*(torch.cuda.is_available() == False):
+		print('No cuda available, using cpu')
+		device = torch.device('cpu')
+	torch.set_grad_enabled(False)
+
+	## Processing settings (see process_config.yaml)
+	s = dict(path_to_file = path_to_file, seperator = seperator, process_config = process_config, config = config, device = device)
+	for key in ['n_ver_load', 'n_step_load', 'n_save_ver', 'n_ver_picks', 'template_ver', 'vel_model_ver', 'process_days_ver', 'offset_increment',
+			'n_rand_query', 'n_query_grid', 'thresh', 'thresh_assoc', 'break_win', 'spr_picks', 'use_quality_check', 'max_relative_error', 'min_time_buffer',
+			'cost_value', 'compute_magnitudes', 'min_log_amplitude_val', 'use_topography', 'process_known_events', 'load_prebuilt_sampling_grid',
+			'use_expanded_competitive_assignment', 'use_differential_evolution_location', 'min_required_picks', 'min_required_sta', 'use_only_one_grid', 'step_size']:
+		s[key] = process_config[key]
+	s['dx_depth'] = 50.0 ## This is not longer used (unless particle swarm location is used)
+
+	## Model settings (see config.yaml)
+	for key in ['k_sta_edges', 'k_spc_edges', 'k_time_edges', 'name_of_project', 'use_physics_informed', 'use_phase_types', 'use_subgraph']:
+		s[key] = config[key]
+	s['max_deg_offset'] = config['max_deg_offset'] if s['use_subgraph'] == True else None
+	s['k_nearest_pairs'] = config['k_nearest_pairs'] if s['use_subgraph'] == True else None
+
+	name_of_project = s['name_of_project']
+	n_ver_load, n_step_load = s['n_ver_load'], s['n_step_load']
+
+	# Load region
+	z = np.load(path_to_file + '%s_region.npz'%name_of_project)
+	lat_range, lon_range, depth_range, deg_pad = z['lat_range'], z['lon_range'], z['depth_range'], z['deg_pad']
+	z.close()
+
+	# Load templates
+	z = np.load(path_to_file + 'Grids/%s_seismic_network_templates_ver_%d.npz'%(name_of_project, s['template_ver']))
+	x_grids = z['x_grids']
+	z.close()
+
+	# Load stations
+	z = np.load(path_to_file + '%s_stations.npz'%name_of_project)
+	locs, stas, mn, rbest = z['locs'], z['stas'], z['mn'], z['rbest']
+	z.close()
+
+	z = np.load(path_to_file + 'GNN_TrainedModels/' + name_of_project + '_' + 'trained_gnn_model_step_%d_ver_%d_losses.npz'%(n_step_load, n_ver_load))
+	training_params = z['training_params']
+	graph_params = z['graph_params']
+	pred_params = z['pred_params']
+	z.close()
+
+	lat_range_extend = [lat_range[0] - deg_pad, lat_range[1] + deg_pad]
+	lon_range_extend = [lon_range[0] - deg_pad, lon_range[1] + deg_pad]
+
+	scale_x = np.array([lat_range[1] - lat_range[0], lon_range[1] - lon_range[0], depth_range[1] - depth_range[0]]).reshape(1,-1)
+	offset_x = np.array([lat_range[0], lon_range[0], depth_range[0]]).reshape(1,-1)
+	scale_x_extend = np.array([lat_range_extend[1] - lat_range_extend[0], lon_range_extend[1] - lon_range_extend[0], depth_range[1] - depth_range[0]]).reshape(1,-1)
+	offset_x_extend = np.array([lat_range_extend[0], lon_range_extend[0], depth_range[0]]).reshape(1,-1)
+
+	rbest_cuda = torch.Tensor(rbest).to(device)
+	mn_cuda = torch.Tensor(mn).to(device)
+
+	if config['use_spherical'] == True:
+
+		earth_radius = 6371e3
+		ftrns1 = lambda x: (rbest @ (lla2ecef(x, e = 0.0, a = earth_radius) - mn).T).T # just subtract mean
+		ftrns2 = lambda x: ecef2lla((rbest.T @ x.T).T + mn, e = 0.0, a = earth_radius) # just subtract mean
+
+		ftrns1_diff = lambda x: (rbest_cuda @ (lla2ecef_diff(x, e = 0.0, a = earth_radius, device = device) - mn_cuda).T).T # just subtract mean
+		ftrns2_diff = lambda x: ecef2lla_diff((rbest_cuda.T @ x.T).T + mn_cuda, e = 0.0, a = earth_radius, device = device) # just subtract mean
+
+	else:
+
+		earth_radius = 6378137.0
+		ftrns1 = lambda x: (rbest @ (lla2ecef(x) - mn).T).T # just subtract mean
+		ftrns2 = lambda x: ecef2lla((rbest.T @ x.T).T + mn) # just subtract mean
+
+		ftrns1_diff = lambda x: (rbest_cuda @ (lla2ecef_diff(x, device = device) - mn_cuda).T).T # just subtract mean
+		ftrns2_diff = lambda x: ecef2lla_diff((rbest_cuda.T @ x.T).T + mn_cuda, device = device) # just subtract mean
+
+	trv_pairwise, trv_pairwise1, X = None, None, None
+	if config['train_travel_time_neural_network'] == False:
+
+		## Load travel times
+		z = np.load(path_to_file + '1D_Velocity_Models_Regional/%s_1d_velocity_model_ver_%d.npz'%(name_of_project, s['vel_model_ver']))
+		Tp = z['Tp_interp']
+		Ts = z['Ts_interp']
+		locs_ref = z['locs_ref']
+		X = z['X']
+		z.close()
+
+		x1 = np.unique(X[:,0])
+		x2 = np.unique(X[:,1])
+		x3 = np.unique(X[:,2])
+		assert(len(x1)*len(x2)*len(x3) == X.shape[0])
+
+		## Load fixed grid for velocity models
+		Xmin = X.min(0)
+		Dx = [np.diff(x1[0:2]),np.diff(x2[0:2]),np.diff(x3[0:2])]
+		Mn = np.array([len(x3), len(x1)*len(x3), 1])
+		N = np.array([len(x1), len(x2), len(x3)])
+		X0 = np.array([locs_ref[0,0], locs_ref[0,1], 0.0]).reshape(1,-1)
+
+		trv = interp_1D_velocity_model_to_3D_travel_times(X, locs_ref, Xmin, X0, Dx, Mn, Tp, Ts, N, ftrns1, ftrns2, device = device)
+
+	else:
+
+		trv = load_travel_time_neural_network(path_to_file, ftrns1_diff, ftrns2_diff, s['vel_model_ver'], use_physics_informed = s['use_physics_informed'], device = device)
+		trv_pairwise = load_travel_time_neural_network(path_to_file, ftrns1_diff, ftrns2_diff, s['vel_model_ver'], method = 'direct', use_physics_informed = s['use_physics_informed'], device = device)
+		trv_pairwise1 = load_travel_time_neural_network(path_to_file, ftrns1_diff, ftrns2_diff, s['vel_model_ver'], method = 'direct', return_model = True, use_physics_informed = s['use_physics_informed'], device = device)
+
+	if (s['use_differential_evolution_location'] == False)*(config['train_travel_time_neural_network'] == False):
+		hull = ConvexHull(X)
+		hull = hull.points[hull.vertices]
+	else:
+		hull = []
+
+	## Check if knn is working on cuda
+	check_len = knn(torch.rand(10,3).to(device), torch.rand(10,3).to(device), k = 5).numel()
+	if check_len != 100: # If it's less than 2 * 10 * 5, there's an issue
+		raise SystemError('Issue with knn on cuda for some versions of pytorch geometric and cuda')
+
+	check_len = knn(10.0*torch.rand(200,3).to(device), 10.0*torch.rand(100,3).to(device), k = 15).numel()
+	if check_len != 3000: # If it's less than 2 * 100 * 15, there's an issue
+		raise SystemError('Issue with knn on cuda for some versions of pytorch geometric and cuda')
+
+	x_grids, x_grids_edges, x_grids_trv, x_grids_trv_pointers_p, x_grids_trv_pointers_s, x_grids_trv_refs, max_t = load_templates_region(trv, locs, x_grids, ftrns1, training_params, graph_params, pred_params, device = device)
+	x_grids_cart_torch = [torch.Tensor(ftrns1(x_grids[i])).to(device) for i in range(len(x_grids))]
+	assert (max([abs(len(x_grids_trv_refs[0]) - len(x_grids_trv_refs[j])) for j in range(len(x_grids_trv_refs))]) == 0)
+
+	## Every template uses the same trained weights, so only read the file once
+	state_dict = torch.load(path_to_file + 'GNN_TrainedModels/%s_trained_gnn_model_step_%d_ver_%d.h5'%(name_of_project, n_step_load, n_ver_load), map_location = device)
+	mz_list = []
+	for i in range(len(x_grids)):
+		mz_slice = GCN_Detection_Network_extended(ftrns1_diff, ftrns2_diff, device = device).to(device)
+		mz_slice.load_state_dict(state_dict)
+		mz_slice.eval()
+		mz_list.append(mz_slice)
+
+	day_len = 3600*24
+	n_resolution = 9 ## The discretization of the source time function output
+	t_win = np.round(np.copy(np.array([2*pred_params[2]]))[0], 2) ## Set window size to the source kernel width (i.e., prediction window is of length +/- src_t_kernel, or [-src_t_kernel + t0, t0 + src_t_kernel])
+	dt_win = np.diff(np.linspace(-t_win/2.0, t_win/2.0, n_resolution))[0]
+	assert(t_win == pred_params[0])
+
+	step_size = s['step_size']
+	if step_size == 'full':
+		step = n_resolution*dt_win
+		n_overlap = 1.0
+	elif step_size == 'partial':
+		step = (n_resolution/3)*dt_win
+		n_overlap = 3.0
+	elif step_size == 'half':
+		step = int(np.floor((n_resolution/2)))*dt_win
+		n_overlap = 2.0
+
+	# pred_params = [t_win, kernel_sig_t, src_t_kernel, src_x_kernel, src_depth_kernel]
+	tc_win = pred_params[2]*1.25 # Temporal window (s) to link events in Local Marching
+	sp_win = pred_params[3]*1.25 # Distance (m) to link events in Local Marching
+	d_win = pred_params[3]*1.25/110e3 ## Converting km to degrees, roughly
+	d_win_depth = pred_params[4]*1.25  ## proportional to depth kernel
+	src_t_kernel = pred_params[2] ## temporal source kernel size
+
+	## Make topography surface
+	surface_profile = None
+	if (s['use_topography'] == True)*(os.path.isfile(path_to_file + 'Grids' + seperator + '%s_surface_elevation.npz'%name_of_project) == True):
+		surface_profile = np.load(path_to_file + 'Grids' + seperator + '%s_surface_elevation.npz'%name_of_project)['surface_profile']
+	elif s['use_topography'] == True: ## If no surface profile saved, then interpolate a regular grid based on saved station elevations
+		n_surface = 100 ## Default resolution of surface
+		x1_surface, x2_surface = np.linspace(lat_range_extend[0], lat_range_extend[1], n_surface), np.linspace(lon_range_extend[0], lon_range_extend[1], n_surface)
+		x11_surface, x12_surface = np.meshgrid(x1_surface, x2_surface)
+		surface_profile = np.concatenate((x11_surface.reshape(-1,1), x12_surface.reshape(-1,1), np.zeros((len(x11_surface.reshape(-1)),1))), axis = 1)
+		tree_sta = cKDTree(ftrns1(locs))
+		surface_profile[:,2] = locs[tree_sta.query(ftrns1(surface_profile))[1],2]
+		## Average the profile
+		edges_surface = knn(torch.Tensor(ftrns1(surface_profile)), torch.Tensor(ftrns1(surface_profile)), k = 15).flip(0).contiguous()
+		surface_profile[:,2] = scatter(torch.Tensor(surface_profile[edges_surface[0].cpu().detach().numpy(),2].reshape(-1,1)), edges_surface[1], dim = 0, reduce = 'mean').cpu().detach().numpy().reshape(-1)
+
+	tsteps = np.arange(0, day_len, step)
+	tsteps_abs = np.arange(-t_win/2.0, day_len + t_win/2.0 + dt_win, dt_win) ## Fixed solution grid
+	tree_tsteps = cKDTree(tsteps_abs.reshape(-1,1))
+	print('\nDoing adaptive time steps (%0.2f win, %0.2f step, %0.2f overlap), to avoid issue of repeating time samples'%(dt_win, step, n_overlap))
+
+	## Load (or build, and save for all later workers and runs) the sampling grid
+	n_ver_sampling_grid = 1
+	file_sampling_grid = path_to_file + 'Grids' + seperator + 'prebuilt_sampling_grid_ver_%d.npz'%n_ver_sampling_grid
+	if (s['load_prebuilt_sampling_grid'] == True)*(os.path.isfile(file_sampling_grid) == True):
+		z = np.load(file_sampling_grid)
+		X_query = z['X_query']
+		z.close()
+	else:
+		X_query = kmeans_packing_sampling_points(scale_x, offset_x, 3, s['n_query_grid'], ftrns1, n_batch = 3000, n_steps = 3000, n_sim = 1)[0]
+		if s['load_prebuilt_sampling_grid'] == True:
+			np.savez_compressed(file_sampling_grid, X_query = X_query)
+	X_query_cart = torch.Tensor(ftrns1(np.copy(X_query))).to(device)
+
+	loaded_mag_model, mags = False, None
+	if s['compute_magnitudes'] == True:
+		try:
+			n_mag_ver = 1
+			mags_supp = np.load(path_to_file + 'trained_magnitude_model_ver_%d_supplemental.npz'%n_mag_ver)
+			mag_grid, k_grid = mags_supp['mag_grid'], int(mags_supp['k_grid'])
+			mags = Magnitude(torch.Tensor(locs).to(device), torch.Tensor(mag_grid).to(device), ftrns1_diff, ftrns2_diff, k = k_grid, device = device)
+			mags.load_state_dict(torch.load(path_to_file + 'trained_magnitude_model_ver_%d.hdf5'%n_mag_ver, map_location = device))
+			loaded_mag_model = True
+			print('Will compute magnitudes since a magnitude model was loaded')
+		except:
+			print('Will not compute magnitudes since no magnitude model was loaded')
+	else:
+		print('Will not compute magnitudes since compute_magnitudes = False')
+
+	## Window over which to "relocate" each event with denser sampling from GNN output
+	x1 = np.linspace(-d_win, d_win, 15)
+	x2 = np.linspace(-d_win, d_win, 15)
+	x3 = np.linspace(-d_win_depth, d_win_depth, 15)
+	x11, x12, x13 = np.meshgrid(x1, x2, x3)
+	X_offset = np.concatenate((x11.reshape(-1,1), x12.reshape(-1,1), x13.reshape(-1,1)), axis = 1)
+
+	x_src_query = locs.mean(0).reshape(1,-1) # arbitrary point to query source-arrival associations during initial processing pass
+	tq = torch.arange(-t_win/2.0, t_win/2.0 + dt_win, dt_win).reshape(-1,1).float().to(device)
+
+	use_updated_input = True
+	dt_embed_discretize = np.round(pred_params[1]/10.0, 2) ## Picks are discretized to this amount if using updated input to speed up input
+
+	s.update(name_of_project = name_of_project, lat_range = lat_range, lon_range = lon_range, depth_range = depth_range, deg_pad = deg_pad,
+		lat_range_extend = lat_range_extend, lon_range_extend = lon_range_extend, scale_x = scale_x, offset_x = offset_x,
+		scale_x_extend = scale_x_extend, offset_x_extend = offset_x_extend,
+		locs = locs, stas = stas, mn = mn, rbest = rbest, training_params = training_params, graph_params = graph_params, pred_params = pred_params,
+		ftrns1 = ftrns1, ftrns2 = ftrns2, ftrns1_diff = ftrns1_diff, ftrns2_diff = ftrns2_diff,
+		trv = trv, trv_pairwise = trv_pairwise, trv_pairwise1 = trv_pairwise1, hull = hull,
+		x_grids = x_grids, x_grids_edges = x_grids_edges, x_grids_trv = x_grids_trv, x_grids_trv_pointers_p = x_grids_trv_pointers_p,
+		x_grids_trv_pointers_s = x_grids_trv_pointers_s, x_grids_trv_refs = x_grids_trv_refs, max_t = max_t, x_grids_cart_torch = x_grids_cart_torch,
+		mz_list = mz_list, mags = mags, loaded_mag_model = loaded_mag_model, surface_profile = surface_profile,
+		day_len = day_len, n_resolution = n_resolution, t_win = t_win, dt_win = dt_win, step = step, n_overlap = n_overlap,
+		tc_win = tc_win, sp_win = sp_win, d_win = d_win, d_win_depth = d_win_depth, src_t_kernel = src_t_kernel,
+		tsteps = tsteps, tsteps_abs = tsteps_abs, tree_tsteps = tree_tsteps, X_query = X_query, X_query_cart = X_query_cart, X_offset = X_offset,
+		x_src_query = x_src_query, tq = tq, use_updated_input = use_updated_input, dt_embed_discretize = dt_embed_discretize)
+
+	return s
+
+def seed_day(day_select, offset_select):
+	## Random generator for one (day_select, offset_select) unit. Also seeds numpy's and
+	## torch's global generators, used inside the GENIE location routines.
+
+	seed = int(day_select) + 100000*int(offset_select)
+	np.random.seed(seed)
+	torch.manual_seed(seed)
+
+	return np.random.default_rng([int(day_select), int(offset_select)])
+
+def draw_grid_indices(state, rng):
+	## Draw the templates used for detection (x_grid_ind_list) and for refining sources
+	## and associations (x_grid_ind_list_1) for one day
+
+	n_grids = len(state['x_grids'])
+	x_grid_ind_list = np.sort(rng.choice(n_grids, size = 1, replace = False))
+	x_grid_ind_list_1 = np.sort(rng.choice(n_grids, size = n_grids, replace = False))
+	if state['use_only_one_grid'] == True:
+		x_grid_ind_list_1 = np.copy(x_grid_ind_list)
+
+	return x_grid_ind_list, x_grid_ind_list_1
+
+def load_day_picks(state, date):
+	## Load the picks of one day. Each row of P is (time, station index, amplitude, prob pick, phase type)
+
+	P, ind_use = load_picks(state['path_to_file'], date, spr_picks = state['spr_picks'], n_ver = state['n_ver_picks'])
+	if state['use_phase_types'] == False:
+		P[:,4] = 0 ## No phase types
+	print('\nUsing %d total picks (%d P and %d S waves) \n'%(len(P), len(np.where(P[:,4] == 0)[0]), len(np.where(P[:,4] == 1)[0])))
+
+	return P, ind_use
+
+def set_adjacencies(state, ind_use):
+	## Build the station-source graphs of every template for the stations with picks
+	## (ind_use) and set them on the models. Returns the source-station edges of each template.
+
+	trv, trv_pairwise, locs, ftrns1, ftrns2, device = state['trv'], state['trv_pairwise'], state['locs'], state['ftrns1'], state['ftrns2'], state['device']
+	x_grids, mz_list = state['x_grids'], state['mz_list']
+	locs_use = locs[ind_use]
+
+	A_src_in_sta_l = []
+	for i in range(len(x_grids)):
+
+		if state['use_subgraph'] == False:
+
+			A_sta_sta, A_src_src, A_prod_sta_sta, A_prod_src_src, A_src_in_prod, A_edges_time_p, A_edges_time_s, A_edges_ref = extract_inputs_adjacencies(trv, locs, ind_use, x_grids[i], state['x_grids_trv'][i], state['x_grids_trv_refs'][i], state['x_grids_trv_pointers_p'][i], state['x_grids_trv_pointers_s'][i], ftrns1, state['graph_params'], device = device)
+
+			A_src_in_sta = torch.Tensor(np.concatenate((np.tile(np.arange(len(ind_use)), len(x_grids[i])).reshape(1,-1), np.arange(len(x_grids[i])).repeat(len(ind_use), axis = 0).reshape(1,-1)), axis = 0)).long().to(device)
+			spatial_vals = torch.Tensor(((np.repeat(np.expand_dims(x_grids[i], axis = 1), len(ind_use), axis = 1) - np.repeat(np.expand_dims(locs[ind_use], axis = 0), x_grids[i].shape[0], axis = 0)).reshape(-1,3))/state['scale_x_extend']).to(device)
+			A_src_in_edges = Data(x = spatial_vals, edge_index = A_src_in_prod).to(device)
+			A_Lg_in_src = Data(x = spatial_vals, edge_index = torch.Tensor(np.ascontiguousarray(np.flip(A_src_in_prod.cpu().detach().numpy(), axis = 0))).long()).to(device)
+			trv_out = trv(torch.Tensor(locs[ind_use]).to(device), torch.Tensor(x_grids[i]).to(device)).detach().reshape(-1,2) ## Can replace trv_out with Trv_out
+			mz_list[i].set_adjacencies(A_prod_sta_sta, A_prod_src_src, A_src_in_edges, A_Lg_in_src, A_src_in_sta, A_src_src, torch.Tensor(A_edges_time_p).long().to(device), torch.Tensor(A_edges_time_s).long().to(device), torch.Tensor(A_edges_ref).to(device), trv_out, torch.Tensor(ftrns1(locs_use)).to(device), torch.Tensor(ftrns1(x_grids[i])).to(device))
+			A_src_in_sta_l.append(A_src_in_sta.cpu().detach().numpy())
+
+		else:
+
+			A_sta_sta, A_src_src, A_prod_sta_sta, A_prod_src_src, A_src_in_prod, A_src_in_sta = extract_inputs_adjacencies_subgraph(locs_use, x_grids[i], ftrns1, ftrns2, max_deg_offset = state['max_deg_offset'], k_nearest_pairs = state['k_nearest_pairs'], k_sta_edges = state['k_sta_edges'], k_spc_edges = state['k_spc_edges'], device = device)
+			A_edges_time_p, A_edges_time_s, dt_partition = compute_time_embedding_vectors(trv_pairwise, locs_use, x_grids[i], A_src_in_sta, state['max_t'], t_win = state['t_win'], device = device)
+			spatial_vals = torch.Tensor((x_grids[i][A_src_in_prod[1].cpu().detach().numpy()] - locs_use[A_src_in_sta[0][A_src_in_prod[0]].cpu().detach().numpy()])/state['scale_x_extend']).to(device)
+			A_src_in_prod = Data(x = spatial_vals, edge_index = A_src_in_prod)
+
+			flipped_edge = torch.Tensor(np.ascontiguousarray(np.flip(A_src_in_prod.edge_index.cpu().detach().numpy(), axis = 0))).long().to(device)
+			A_src_in_prod_flipped = Data(x = spatial_vals, edge_index = flipped_edge).to(device)
+			trv_out = trv_pairwise(torch.Tensor(locs_use[A_src_in_sta[0].cpu().detach().numpy()]).to(device), torch.Tensor(x_grids[i][A_src_in_sta[1].cpu().detach().numpy()]).to(device))
+			mz_list[i].set_adjacencies(A_prod_sta_sta, A_prod_src_src, A_src_in_prod, A_src_in_prod_flipped, A_src_in_sta, A_src_src, torch.Tensor(A_edges_time_p).long().to(device), torch.Tensor(A_edges_time_s).long().to(device), torch.Tensor(dt_partition).to(device), trv_out, torch.Tensor(ftrns1(locs_use)).to(device), torch.Tensor(ftrns1(x_grids[i])).to(device))
+			A_src_in_sta_l.append(A_src_in_sta.cpu().detach().numpy())
+
+	return A_src_in_sta_l
+
+def check_input_embedding(state, P, ind_use, A_src_in_sta_l, x_grid_ind, rng, n_random_check = 5):
+	## Check that the input embedding preserves all travel time indices (overflow can happen on GPU
+	## for very large spatial domains x number of stations when using scatter), using synthetic picks.
+	## Note, must also add check that overflow doesn't happen during the second scatter operation in extract_input_from_data
+
+	trv, trv_pairwise, locs, x_grids, pred_params, device = state['trv'], state['trv_pairwise'], state['locs'], state['x_grids'], state['pred_params'], state['device']
+	dt_embed_discretize = state['dt_embed_discretize']
+
+	for i in range(n_random_check):
+		## Simulate picks
+		src, src_origin = x_grids[0][rng.choice(len(x_grids[0]))].reshape(1,-1), rng.random()*(np.nanmax(P[:,0]) - np.nanmin(P[:,0])) + np.nanmin(P[:,0])
+		trv_out = trv(torch.Tensor(locs).to(device), torch.Tensor(src).to(device)).cpu().detach().numpy() + src_origin
+		ikeep = np.sort(rng.choice(len(ind_use), size = int(np.ceil(len(ind_use)*0.7)), replace = False))
+		ikeep1 = np.sort(rng.choice(len(ind_use), size = int(np.ceil(len(ind_use)*0.7)), replace = False))
+
+		P1 = np.concatenate((trv_out[0,ind_use[ikeep],0].reshape(-1,1), ind_use[ikeep].reshape(-1,1), np.zeros((len(ikeep),3))), axis = 1)
+		P1 = np.concatenate((P1, np.concatenate((trv_out[0,ind_use[ikeep1],1].reshape(-1,1), ind_use[ikeep1].reshape(-1,1), np.zeros((len(ikeep1),2)), np.ones((len(ikeep1),1))), axis = 1)), axis = 0)
+
+		## Note: if this fails, essentially dt_embed_discretize is too small (resulting in too many time steps x number stations (combined with max moveout, max_t) leading to too large of graphs in the scatter operation for extracting inputs (e.g., ~ 100 million nodes))
+		embed_p, embed_s, ind_unique_, abs_time_ref_, n_time_series_, n_sta_unique_ = extract_input_from_data(trv_pairwise, P1, np.array([src_origin]), ind_use, locs, x_grids[x_grid_ind], A_src_in_sta_l[x_grid_ind], trv_times = state['x_grids_trv'][x_grid_ind], max_t = state['max_t'], kernel_sig_t = pred_params[1], dt = dt_embed_discretize, return_embedding = True, device = device)
+
+		## Check positive points
+		vec_p_ = embed_p.reshape(n_sta_unique_, n_time_series_)
+		vec_s_ = embed_s.reshape(n_sta_unique_, n_time_series_)
+		tree_ = cKDTree(ind_unique_.reshape(-1,1))
+		ip_ = tree_.query(P1[:,1].reshape(-1,1))[1] ## Matched index to unique indices
+		ip1_, ip2_ = np.where(P1[:,4] == 0)[0], np.where(P1[:,4] == 1)[0]
+		t_p_, t_s_ = ((P1[ip1_,0] - abs_time_ref_[0])/dt_embed_discretize).astype('int'), ((P1[ip2_,0] - abs_time_ref_[0])/dt_embed_discretize).astype('int')
+		itp_, its_ = np.where((t_p_ >= 0)*(t_p_ < n_time_series_))[0], np.where((t_s_ >= 0)*(t_s_ < n_time_series_))[0]
+		val_p_, val_s_ = vec_p_[ip_[ip1_[itp_]], t_p_[itp_]].cpu().detach().numpy(), vec_s_[ip_[ip2_[its_]], t_s_[its_]].cpu().detach().numpy()
+		if len(val_p_) > 0: assert(val_p_.min() > 0.9)
+		if len(val_s_) > 0: assert(val_s_.min() > 0.9)
+		print('Min check val is %0.4f'%np.min(np.concatenate((val_p_, val_s_), axis = 0)))
+
+		## Check zero points
+		iselect_ = np.sort(rng.choice(len(P1), size = 10000))
+		iwhere_p_, iwhere_s_ = np.where(P1[iselect_,4] == 0)[0], np.where(P1[iselect_,4] == 1)[0]
+		t_rand_p_ = P1[iselect_[iwhere_p_],0] + 4.0*pred_params[1]*rng.choice([-1.0, 1.0], size = len(iwhere_p_))
+		t_rand_s_ = P1[iselect_[iwhere_s_],0] + 4.0*pred_params[1]*rng.choice([-1.0, 1.0], size = len(iwhere_s_))
+
+		ip_1_ = tree_.query(P1[iselect_[iwhere_p_],1].reshape(-1,1))[1] ## Matched index to unique indices
+		ip_2_ = tree_.query(P1[iselect_[iwhere_s_],1].reshape(-1,1))[1] ## Matched index to unique indices
+		ip1_, ip2_ = np.where(P1[iselect_[iwhere_p_],4] == 0)[0], np.where(P1[iselect_[iwhere_s_],4] == 1)[0]
+		t_p_, t_s_ = ((t_rand_p_[ip1_] - abs_time_ref_[0])/dt_embed_discretize).astype('int'), ((t_rand_s_[ip2_] - abs_time_ref_[0])/dt_embed_discretize).astype('int')
+		itp_, its_ = np.where((t_p_ >= 0)*(t_p_ < n_time_series_))[0], np.where((t_s_ >= 0)*(t_s_ < n_time_series_))[0]
+		val_p_, val_s_ = vec_p_[ip_1_[ip1_[itp_]], t_p_[itp_]].cpu().detach().numpy(), vec_s_[ip_2_[ip2_[its_]], t_s_[its_]].cpu().detach().numpy()
+		if len(val_p_) > 0: assert(val_p_.max() < 0.1)
+		if len(val_s_) > 0: assert(val_s_.max() < 0.1)
+		print('Max check val is %0.4f \n'%np.max(np.concatenate((val_p_, val_s_), axis = 0)))
+
+def detect_sources(state, P, ind_use, A_src_in_sta_l, x_grid_ind_list, rng, srcs_known = None, check_overflow = True):
+	## Detect candidate sources: pass the inputs over sliding windows to the GNN, stack the
+	## overlapping outputs on the sampling grid (X_query), find the peaks in time at each
+	## sampling point and merge nearby maxima in space with "local marching".
+	## If srcs_known is given (process_known_events), only the windows around those events are processed.
+	## Returns the sources (lat, lon, depth, origin time, likelihood) and the sparse stacked output.
+
+	locs, ftrns1, device = state['locs'], state['ftrns1'], state['device']
+	x_grids, x_grids_trv, mz_list, tree_tsteps, tsteps_abs = state['x_grids'], state['x_grids_trv'], state['mz_list'], state['tree_tsteps'], state['tsteps_abs']
+	t_win, dt_win, step, pred_params, max_t = state['t_win'], state['dt_win'], state['step'], state['pred_params'], state['max_t']
+	X_query, X_query_cart, tq = state['X_query'], state['X_query_cart'], state['tq']
+	min_required_picks = state['min_required_picks']
+	locs_use = locs[ind_use]
+	arrivals_tree = cKDTree(P[:,0][:,None])
+	n_scale_x_grid = len(x_grid_ind_list)
+	Out_2_sparse = np.zeros((0,3))
+
+	if (state['use_updated_input'] == True)*(check_overflow == True):
+		check_input_embedding(state, P, ind_use, A_src_in_sta_l, x_grid_ind_list[0], rng)
+
+	if srcs_known is None: # Process continuous days
+		times_need_l = np.copy(state['tsteps'])
+	else:  # Process around times of known events
+		tsteps = state['tsteps']
+		srcs_known_times = np.copy(srcs_known[:,3])
+		tree_srcs_known_times = cKDTree(tsteps.reshape(-1,1))
+		ip_nearest_srcs_known_times = tree_srcs_known_times.query(srcs_known_times.reshape(-1,1))[1]
+		srcs_known_times = tsteps[ip_nearest_srcs_known_times]
+		times_need_l = np.unique((srcs_known_times.reshape(-1,1) + np.arange(-pred_params[0]*3, pred_params[0]*3 + step, step).reshape(1,-1)).reshape(-1))
+
+	## Skip windows with fewer than min_pick_window picks
+	min_pick_window = min_required_picks if min_required_picks != False else 1
+	lp = arrivals_tree.query_ball_point(times_need_l.reshape(-1,1) + max_t/2.0, r = t_win + max_t/2.0)
+	times_need_l = times_need_l[np.array([len(lp[j]) >= min_pick_window for j in range(len(lp))], dtype = bool)]
+	if len(times_need_l) == 0:
+		print('No windows with > %d picks (min_pick_window)'%min_pick_window)
+		return np.zeros((0,5)), Out_2_sparse
+
+	n_batch = 1
+	times_need = [times_need_l[j*n_batch:(j + 1)*n_batch] for j in range(int(np.ceil(len(times_need_l)/n_batch)))]
+	assert(len(np.hstack(times_need)) == len(np.unique(np.hstack(times_need))))
+	print('Processing %d inputs in %d batches'%(len(times_need_l), len(times_need)))
+
+	Out_2 = np.zeros((X_query_cart.shape[0], len(tsteps_abs)))
+
+	for n in range(len(times_need)):
+
+		tsteps_slice = times_need[n]
+		tsteps_slice_indices = tree_tsteps.query(tsteps_slice.reshape(-1,1))[1]
+
+		for x_grid_ind in x_grid_ind_list:
+
+			if state['use_updated_input'] == False:
+
+				[Inpts, Masks], [lp_times, lp_stations, lp_phases, lp_meta] = extract_inputs_from_data_fixed_grids_with_phase_type(state['trv'], locs, ind_use, P, P[:,4], arrivals_tree, tsteps_slice, x_grids[x_grid_ind], x_grids_trv[x_grid_ind], state['lat_range_extend'], state['lon_range_extend'], state['depth_range'], max_t, state['training_params'], state['graph_params'], pred_params, ftrns1, state['ftrns2'])
+
+			else:
+
+				[Inpts, Masks], [lp_times, lp_stations, lp_phases, lp_meta] = extract_input_from_data(state['trv_pairwise'], P, tsteps_slice, ind_use, locs, x_grids[x_grid_ind], A_src_in_sta_l[x_grid_ind], trv_times = x_grids_trv[x_grid_ind], max_t = max_t, kernel_sig_t = pred_params[1], dt = state['dt_embed_discretize'], device = device)
+
+			if state['use_phase_types'] == False:
+				for i in range(len(Inpts)):
+					Inpts[i][:,2::] = 0.0 ## Phase type informed features zeroed out
+					Masks[i][:,2::] = 0.0
+
+			for i0 in range(len(tsteps_slice)):
+
+				if len(lp_times[i0]) == 0:
+					continue ## It will fail if len(lp_times[i0]) == 0!
+
+				ip_need = tree_tsteps.query(tsteps_abs[tsteps_slice_indices[i0]] + np.arange(-t_win/2.0, t_win/2.0 + dt_win, dt_win).reshape(-1,1))
+
+				out = mz_list[x_grid_ind].forward_fixed_source(torch.Tensor(Inpts[i0]).to(device), torch.Tensor(Masks[i0]).to(device), torch.Tensor(lp_times[i0]).to(device), torch.Tensor(lp_stations[i0]).long().to(device), torch.Tensor(lp_phases[i0].reshape(-1,1)).float().to(device), torch.Tensor(ftrns1(locs_use)).to(device), state['x_grids_cart_torch'][x_grid_ind], X_query_cart, tq)
+
+				if state['step_size'] == 'half': ## In this case, must drop last index (so all points are stacked over equally; this is hard-coded for an output size of 9 steps)
+					Out_2[:,ip_need[1][0:-1]] += out[1][:,0:-1,0].cpu().detach().numpy()/state['n_overlap']/n_scale_x_grid
+				else:
+					Out_2[:,ip_need[1]] += out[1][:,:,0].cpu().detach().numpy()/state['n_overlap']/n_scale_x_grid
+
+				if ((np.mod(i0, 50) == 0) + ((np.mod(i0, 5) == 0)))*(out[1].max().item() > 0.3):
+					print('%d %d %0.2f'%(n, i0, out[1].max().item()))
+
+	iz1, iz2 = np.where(Out_2 > 0.01) # Zeros out all values less than this
+	Out_2_sparse = np.concatenate((iz1.reshape(-1,1), iz2.reshape(-1,1), Out_2[iz1,iz2].reshape(-1,1)), axis = 1)
+
+	xq = np.copy(X_query)
+	ts = np.copy(tsteps_abs)
+	assert(np.diff(ts)[0] == dt_win)
+
+	print('Begin peak finding')
+	srcs_init = []
+	for i in range(Out_2.shape[0]):
+		ip = find_peaks(Out_2[i,:], height = state['thresh'], distance = int(state['src_t_kernel']/dt_win)) ## Note: should add prominence as thresh/2.0, which might help detect nearby events.
+		if len(ip[0]) > 0:
+			val = np.concatenate((xq[i,:].reshape(1,-1)*np.ones((len(ip[0]),3)), ts[ip[0]].reshape(-1,1), ip[1]['peak_heights'].reshape(-1,1)), axis = 1)
+			srcs_init.append(val)
+
+	if len(srcs_init) == 0:
+		print('No sources detected')
+		return np.zeros((0,5)), Out_2_sparse
+
+	srcs_init = np.vstack(srcs_init)
+	srcs_init = srcs_init[np.argsort(srcs_init[:,3]),:]
+
+	## Split into groups of sources seperated by more than break_win in time, so can run Local Marching without memory issues
+	ibreak = np.where(np.diff(srcs_init[:,3]) >= state['break_win'])[0]
+	srcs_groups_l = np.split(srcs_init, ibreak + 1, axis = 0)
+
+	print('Begin local marching')
+	srcs_l = []
+	for i in range(len(srcs_groups_l)):
+		if len(srcs_groups_l[i]) == 1:
+			srcs_l.append(srcs_groups_l[i])
+		else:
+			mp = LocalMarching(device = device)
+			srcs_out = mp(srcs_groups_l[i], ftrns1, tc_win = state['tc_win'], sp_win = state['sp_win'], scale_depth = 0.2)
+			if len(srcs_out) > 0:
+				srcs_l.append(srcs_out)
+
+	if len(srcs_l) == 0:
+		print('No sources detected')
+		return np.zeros((0,5)), Out_2_sparse
+
+	srcs = np.vstack(srcs_l)
+	srcs = srcs[np.argsort(srcs[:,3])]
+	print('Detected %d number of initial local maxima'%srcs.shape[0])
+
+	return srcs, Out_2_sparse
+
+def associate_sources(state, P, ind_use, srcs, A_src_in_sta_l, x_grid_ind_list_1, rng):
+	## Refine each candidate source with denser sampling around it, predict its
+	## source-arrival associations, merge nearby refined sources, and assign picks to
+	## sources with competitive assignment. Returns a dict with the retained sources
+	## (srcs_refined) and their associated picks (Picks_P, Picks_S, and Picks_P_perm,
+	## Picks_S_perm with station indices into locs_use).
+
+	locs, ftrns1, device, trv, tq = state['locs'], state['ftrns1'], state['device'], state['trv'], state['tq']
+	x_grids, x_grids_trv, mz_list = state['x_grids'], state['x_grids_trv'], state['mz_list']
+	lat_range, lon_range, depth_range, X_offset = state['lat_range'], state['lon_range'], state['depth_range'], state['X_offset']
+	pred_params, max_t, thresh_assoc = state['pred_params'], state['max_t'], state['thresh_assoc']
+	tc_win, sp_win, scale_depth_clustering = state['tc_win'], state['sp_win'], 0.2
+	locs_use = locs[ind_use]
+	locs_use_cart_torch = torch.Tensor(ftrns1(locs_use)).to(device)
+	n_scale_x_grid_1 = len(x_grid_ind_list_1)
+
+	perm_vec = -1*np.ones(locs.shape[0])
+	perm_vec[ind_use] = np.arange(len(ind_use))
+	tree_picks = cKDTree(P[:,0:2]) # based on absolute indices
+
+	empty = dict(srcs_refined = np.zeros((0,5)), Picks_P = [], Picks_S = [], Picks_P_perm = [], Picks_S_perm = [])
+	if len(srcs) == 0:
+		return empty
+
+	def extract_inputs(x_grid_ind, src_times):
+
+		if state['use_updated_input'] == False:
+			[Inpts, Masks], [lp_times, lp_stations, lp_phases, lp_meta] = extract_inputs_from_data_fixed_grids_with_phase_type(trv, locs, ind_use, P, P[:,4], cKDTree(P[:,0][:,None]), src_times, x_grids[x_grid_ind], x_grids_trv[x_grid_ind], state['lat_range_extend'], state['lon_range_extend'], depth_range, max_t, state['training_params'], state['graph_params'], pred_params, ftrns1, state['ftrns2'])
+		else:
+			[Inpts, Masks], [lp_times, lp_stations, lp_phases, lp_meta] = extract_input_from_data(state['trv_pairwise'], P, src_times, ind_use, locs, x_grids[x_grid_ind], A_src_in_sta_l[x_grid_ind], trv_times = x_grids_trv[x_grid_ind], max_t = max_t, kernel_sig_t = pred_params[1], dt = state['dt_embed_discretize'], device = device)
+
+		if state['use_phase_types'] == False:
+			for i in range(len(Inpts)):
+				Inpts[i][:,2::] = 0.0 ## Phase type informed features zeroed out
+				Masks[i][:,2::] = 0.0
+
+		return Inpts, Masks, lp_times, lp_stations, lp_phases, lp_meta
+
+	## This section is memory intensive if lots of sources are detected.
+	## Can "loop" over segements of sources, to keep the cost for manegable.
+	n_segment = 1
+	srcs_list = [np.arange(i, min(i + n_segment, srcs.shape[0])) for i in range(0, srcs.shape[0], n_segment)]
+
+	print('Begin sources refined')
+	srcs_refined_l = []
+	Out_p_save_l = []
+	Out_s_save_l = []
+	Save_picks = []
+	lp_meta_l = []
+
+	for n in range(len(srcs_list)):
+
+		Out_refined = []
+		X_query_1_list = []
+		X_query_1_cart_list = []
+
+		srcs_slice = srcs[srcs_list[n]]
+
+		for i in range(srcs_slice.shape[0]):
+			X_query_1 = srcs_slice[i,0:3] + (rng.random((state['n_rand_query'],3))*(X_offset.max(0, keepdims = True) - X_offset.min(0, keepdims = True)) + X_offset.min(0, keepdims = True))
+			inside = np.where((X_query_1[:,0] > lat_range[0])*(X_query_1[:,0] < lat_range[1])*(X_query_1[:,1] > lon_range[0])*(X_query_1[:,1] < lon_range[1])*(X_query_1[:,2] > depth_range[0])*(X_query_1[:,2] < depth_range[1]))[0]
+			X_query_1 = X_query_1[inside]
+			X_query_1_list.append(X_query_1)
+			X_query_1_cart_list.append(torch.Tensor(ftrns1(np.copy(X_query_1))).to(device))
+			Out_refined.append(np.zeros((X_query_1.shape[0], len(tq))))
+
+		for x_grid_ind in x_grid_ind_list_1:
+
+			Inpts, Masks, lp_times, lp_stations, lp_phases, lp_meta = extract_inputs(x_grid_ind, srcs_slice[:,3])
+
+			for i in range(srcs_slice.shape[0]):
+
+				if (len(lp_times[i]) == 0) + (len(X_query_1_list[i]) == 0):
+					continue ## It will fail if len(lp_times[i]) == 0!
+
+				out = mz_list[x_grid_ind].forward_fixed_source(torch.Tensor(Inpts[i]).to(device), torch.Tensor(Masks[i]).to(device), torch.Tensor(lp_times[i]).to(device), torch.Tensor(lp_stations[i]).long().to(device), torch.Tensor(lp_phases[i].reshape(-1,1)).float().to(device), locs_use_cart_torch, state['x_grids_cart_torch'][x_grid_ind], X_query_1_cart_list[i], tq)
+				Out_refined[i] += out[1][:,:,0].cpu().detach().numpy()/n_scale_x_grid_1
+
+		srcs_refined = []
+		for i in range(srcs_slice.shape[0]):
+
+			if len(X_query_1_list[i]) == 0: ## Keep the initial source if no query points fell inside the region
+				srcs_refined.append(srcs_slice[i].reshape(1,-1))
+				continue
+
+			ip_argmax = np.argmax(Out_refined[i].max(1))
+			ipt_argmax = np.argmax(Out_refined[i][ip_argmax,:])
+			srcs_refined.append(np.concatenate((X_query_1_list[i][ip_argmax].reshape(1,-1), np.array([srcs_slice[i,3] + tq[ipt_argmax,0].item(), Out_refined[i].max()]).reshape(1,-1)), axis = 1))
+
+		srcs_refined = np.vstack(srcs_refined)
+		srcs_refined = srcs_refined[np.argsort(srcs_refined[:,3])]
+
+		trv_out_srcs_slice = trv(torch.Tensor(locs_use).to(device), torch.Tensor(srcs_refined[:,0:3]).to(device)).detach()
+		srcs_refined_l.append(srcs_refined)
+
+		X_save = np.array([[lat_range[0], lon_range[0], 0.0]]) ## Depth is overwritten for each source
+
+		for inc, x_grid_ind in enumerate(x_grid_ind_list_1):
+
+			Inpts, Masks, lp_times, lp_stations, lp_phases, lp_meta = extract_inputs(x_grid_ind, srcs_refined[:,3])
+
+			if inc == 0:
+
+				Out_p_save = [np.zeros(len(lp_times[j])) for j in range(srcs_refined.shape[0])]
+				Out_s_save = [np.zeros(len(lp_times[j])) for j in range(srcs_refined.shape[0])]
+
+			for i in range(srcs_refined.shape[0]):
+
+				ipick, tpick = lp_stations[i].astype('int'), lp_times[i]
+
+				if inc == 0:
+
+					Save_picks.append(np.concatenate((tpick.reshape(-1,1), ipick.reshape(-1,1)), axis = 1))
+					lp_meta_l.append(lp_meta[i])
+
+				X_save[:,2] = srcs_refined[i,2]
+				X_save_cart = torch.Tensor(ftrns1(X_save)).to(device)
+
+				if len(lp_times[i]) == 0:
+					continue ## It will fail if len(lp_times[i]) == 0!
+
+				out = mz_list[x_grid_ind].forward_fixed(torch.Tensor(Inpts[i]).to(device), torch.Tensor(Masks[i]).to(device), torch.Tensor(lp_times[i]).to(device), torch.Tensor(lp_stations[i]).long().to(device), torch.Tensor(lp_phases[i].reshape(-1,1)).long().to(device), locs_use_cart_torch, state['x_grids_cart_torch'][x_grid_ind], X_save_cart, torch.Tensor(ftrns1(srcs_refined[i,0:3].reshape(1,-1))).to(device), tq, torch.zeros(1).to(device), trv_out_srcs_slice[[i],:,:])
+				Out_p_save[i] += out[2][0,:,0].cpu().detach().numpy()/n_scale_x_grid_1
+				Out_s_save[i] += out[3][0,:,0].cpu().detach().numpy()/n_scale_x_grid_1
+
+		for i in range(srcs_refined.shape[0]):
+			Out_p_save_l.append(Out_p_save[i])
+			Out_s_save_l.append(Out_s_save[i])
+
+	srcs_refined = np.vstack(srcs_refined_l)
+
+	## Merge refined sources that are now close enough to be grouped into one
+	mp = LocalMarching(device = device)
+	srcs_refined_1 = mp(srcs_refined, ftrns1, tc_win = tc_win, sp_win = sp_win, scale_depth = scale_depth_clustering)
+
+	tree_refined = cKDTree(ftrns1(srcs_refined))
+	ip_retained = tree_refined.query(ftrns1(srcs_refined_1))[1]
+
+	Out_p_save = [Out_p_save_l[i] for i in ip_retained]
+	Out_s_save = [Out_s_save_l[i] for i in ip_retained]
+	lp_meta_l = [lp_meta_l[i] for i in ip_retained]
+	Save_picks = [Save_picks[i] for i in ip_retained]
+	srcs_refined = srcs_refined[ip_retained]
+
+	print('Begin competetive assignment')
+	iargsort = np.argsort(srcs_refined[:,3])
+	srcs_refined = srcs_refined[iargsort]
+	Out_p_save = [Out_p_save[i] for i in iargsort]
+	Out_s_save = [Out_s_save[i] for i in iargsort]
+	Save_picks = [Save_picks[i] for i in iargsort]
+	lp_meta = [lp_meta_l[i] for i in iargsort]
+
+	Picks_P = []
+	Picks_S = []
+	Picks_P_perm = []
+	Picks_S_perm = []
+
+	if (state['use_expanded_competitive_assignment'] == False) or (len(srcs_refined) <= 1):
+
+		## Assign picks to each source individually
+		for i in range(srcs_refined.shape[0]):
+
+			ipick, tpick = Save_picks[i][:,1].astype('int'), Save_picks[i][:,0]
+
+			wp = np.zeros((1,len(tpick))); wp[0,:] = Out_p_save[i]
+			ws = np.zeros((1,len(tpick))); ws[0,:] = Out_s_save[i]
+			wp[wp <= thresh_assoc] = 0.0
+			ws[ws <= thresh_assoc] = 0.0
+			assignments, srcs_active = competitive_assignment([wp, ws], ipick, 1.5, force_n_sources = 1)
+
+			ip_picks = tree_picks.query(lp_meta[i][:,0:2]) # meta uses absolute indices
+			assert(abs(ip_picks[0]).max() == 0.0)
+			ip_picks = ip_picks[1]
+			assert(len(srcs_active) == 1)
+
+			p_assign = np.concatenate((P[ip_picks[assignments[0][0]],:], i*np.ones(len(assignments[0][0])).reshape(-1,1)), axis = 1)
+			s_assign = np.concatenate((P[ip_picks[assignments[0][1]],:], i*np.ones(len(assignments[0][1])).reshape(-1,1)), axis = 1)
+			p_assign_perm = np.copy(p_assign)
+			s_assign_perm = np.copy(s_assign)
+			p_assign_perm[:,1] = perm_vec[p_assign_perm[:,1].astype('int')]
+			s_assign_perm[:,1] = perm_vec[s_assign_perm[:,1].astype('int')]
+			Picks_P.append(p_assign)
+			Picks_S.append(s_assign)
+			Picks_P_perm.append(p_assign_perm)
+			Picks_S_perm.append(s_assign_perm)
+
+		return dict(srcs_refined = srcs_refined, Picks_P = Picks_P, Picks_S = Picks_S, Picks_P_perm = Picks_P_perm, Picks_S_perm = Picks_S_perm)
+
+	## Expanded competitive assignment: runs over disjoint sets of "nearby" sources (sources
+	## with shared arrival associations), rather than individually for each source.
+	all_picks = np.vstack(lp_meta)
+	unique_picks = np.unique(all_picks, axis = 0)
+	ip_sort_unique = np.lexsort((unique_picks[:,1], unique_picks[:,0])) # sort by time
+	unique_picks = unique_picks[ip_sort_unique]
+	len_unique_picks = len(unique_picks)
+	tree_picks_unique_select = cKDTree(unique_picks[:,0:2])
+
+	matched_src_arrival_indices = []
+	matched_src_arrival_indices_p = []
+	matched_src_arrival_indices_s = []
+
+	min_picks = 4
+
+	for i in range(len(lp_meta)):
+
+		if len(lp_meta[i]) == 0:
+			continue
+
+		matched_arv_indices_val = tree_picks_unique_select.query(lp_meta[i][:,0:2])
+		assert(matched_arv_indices_val[0].max() == 0)
+		matched_arv_indices = matched_arv_indices_val[1]
+
+		ifind_p = np.where(Out_p_save[i] > thresh_assoc)[0]
+		ifind_s = np.where(Out_s_save[i] > thresh_assoc)[0]
+
+		# Check for minimum number of picks, otherwise, skip source
+		if (len(ifind_p) + len(ifind_s)) >= min_picks:
+
+			## Concatenate both p and s likelihoods and edges for all of ifind, so that the dense matrices
+			## extracted for each disconnected component are the same size.
+			## First row is arrival indices, second row are src indices
+			ifind = np.unique(np.concatenate((ifind_p, ifind_s), axis = 0))
+			matched_src_arrival_indices_p.append(np.concatenate((matched_arv_indices[ifind].reshape(1,-1), i*np.ones(len(ifind)).reshape(1,-1), Out_p_save[i][ifind].reshape(1,-1)), axis = 0))
+			matched_src_arrival_indices_s.append(np.concatenate((matched_arv_indices[ifind].reshape(1,-1), i*np.ones(len(ifind)).reshape(1,-1), Out_s_save[i][ifind].reshape(1,-1)), axis = 0))
+			matched_src_arrival_indices.append(np.concatenate((matched_arv_indices[ifind].reshape(1,-1), i*np.ones(len(ifind)).reshape(1,-1), np.concatenate((Out_p_save[i][ifind].reshape(1,-1), Out_s_save[i][ifind].reshape(1,-1)), axis = 0).max(0, keepdims = True)), axis = 0))
+
+	if len(matched_src_arrival_indices) == 0:
+		print('No sources with at least %d associated picks'%min_picks)
+		return empty
+
+	matched_src_arrival_indices = np.hstack(matched_src_arrival_indices)
+	matched_src_arrival_indices_p = np.hstack(matched_src_arrival_indices_p)
+	matched_src_arrival_indices_s = np.hstack(matched_src_arrival_indices_s)
+
+	## Convert to linear graph, find disconected components, apply CA
+	## w_edges: first row are unique arrival indices, second row are unique src indices (offset by len(unique_picks))
+	w_edges = np.concatenate((matched_src_arrival_indices[0,:][None,:], matched_src_arrival_indices[1,:][None,:] + len_unique_picks, matched_src_arrival_indices[2,:].reshape(1,-1)), axis = 0)
+	wp_edges = np.concatenate((matched_src_arrival_indices_p[0,:][None,:], matched_src_arrival_indices_p[1,:][None,:] + len_unique_picks, matched_src_arrival_indices_p[2,:].reshape(1,-1)), axis = 0)
+	ws_edges = np.concatenate((matched_src_arrival_indices_s[0,:][None,:], matched_src_arrival_indices_s[1,:][None,:] + len_unique_picks, matched_src_arrival_indices_s[2,:].reshape(1,-1)), axis = 0)
+	assert(np.abs(wp_edges[0:2,:] - ws_edges[0:2,:]).max() == 0)
+
+	G_nx = nx.Graph()
+	G_nx.add_weighted_edges_from(w_edges.T)
+	G_nx.add_weighted_edges_from(w_edges[np.array([1,0,2]),:].T)
+
+	Gp_nx = nx.Graph()
+	Gp_nx.add_weighted_edges_from(wp_edges.T)
+	Gp_nx.add_weighted_edges_from(wp_edges[np.array([1,0,2]),:].T)
+
+	Gs_nx = nx.Graph()
+	Gs_nx.add_weighted_edges_from(ws_edges.T)
+	Gs_nx.add_weighted_edges_from(ws_edges[np.array([1,0,2]),:].T)
+
+	def component_slices(component):
+		## Source-arrival weights and the arrival and source indices of one disconnected component
+
+		adj_matrix = nx.adjacency_matrix(G_nx.subgraph(component), nodelist = component).toarray()
+		adj_matrix_p = nx.adjacency_matrix(Gp_nx.subgraph(component), nodelist = component).toarray()
+		adj_matrix_s = nx.adjacency_matrix(Gs_nx.subgraph(component), nodelist = component).toarray()
+
+		ifind_src_inds = np.where(component > (len_unique_picks - 1))[0]
+		ifind_arv_inds = np.delete(np.arange(len(component)), ifind_src_inds, axis = 0)
+		arv_ind_slice = np.sort(component[ifind_arv_inds])
+		arv_src_slice = np.sort(component[ifind_src_inds]) - len_unique_picks
+		len_arv_slice = len(arv_ind_slice)
+
+		return adj_matrix[len_arv_slice::,0:len_arv_slice], adj_matrix_p[len_arv_slice::,0:len_arv_slice], adj_matrix_s[len_arv_slice::,0:len_arv_slice], arv_ind_slice, arv_src_slice
+
+	## Split disconnected components with more than max_sources sources
+	max_sources = 15 ## per competitive assignment run
+	max_splits = 30
+	num_splits = 0
+	while True:
+
+		remove_edges_from = []
+
+		discon_components = list(nx.connected_components(G_nx))
+		discon_components = [np.sort(np.array(list(discon_components[i])).astype('int')) for i in range(len(discon_components))]
+
+		len_discon = np.array([len(np.where(discon_components[j] > (len_unique_picks - 1))[0]) for j in range(len(discon_components))])
+		print('Number discon components: %d \n'%(len(len_discon)))
+		print('Number large discon components: %d \n'%(len(np.where(len_discon > max_sources)[0])))
+		print('Largest discon component: %d \n'%(max(len_discon)))
+
+		if (len(np.where(len_discon > max_sources)[0]) == 0) or (num_splits > max_splits):
+			break
+
+		print('Beginning split step %d'%num_splits)
+
+		for i in range(len(discon_components)):
+
+			if len_discon[i] <= max_sources:
+				continue
+
+			## Create a source-source index graph, based on how much they "share" arrivals. Then split the
+			## sources in two groups, and remove the arrival attachments to the group they are not assigned to.
+			w_slice, wp_slice, ws_slice, arv_ind_slice, arv_src_slice = component_slices(discon_components[i])
+			ipick = unique_picks[arv_ind_slice,1].astype('int')
+
+			isource, iarv = np.where(w_slice > thresh_assoc)
+			tree_src_ind = cKDTree(isource.reshape(-1,1)) ## all sources should appear here
+			lp_src_ind = tree_src_ind.query_ball_point(np.arange(len(arv_src_slice)).reshape(-1,1), r = 0)
+			assert(len(np.sort(np.unique(isource))) == len(arv_src_slice))
+
+			w_src_adj = np.zeros((len(arv_src_slice), len(arv_src_slice)))
+			for j in range(len(arv_src_slice)):
+				for k in range(len(arv_src_slice)):
+					if j == k:
+						continue
+					if (len(lp_src_ind[j]) > 0)*(len(lp_src_ind[k]) > 0):
+						w_src_adj[j,k] = len(list(set(iarv[lp_src_ind[j]]).intersection(iarv[lp_src_ind[k]])))
+
+			## Simply split sources into groups of two (need to make sure this rarely cuts off indidual sources)
+			clusters = SpectralClustering(n_clusters = 2, affinity = 'precomputed', random_state = int(rng.integers(2**31))).fit_predict(w_src_adj)
+			i1, i2 = np.where(clusters == 0)[0], np.where(clusters == 1)[0]
+
+			min_time1, min_time2 = srcs_refined[arv_src_slice[i1],3].min(), srcs_refined[arv_src_slice[i2],3].min()
+			if min_time1 > min_time2:
+				i1, i2 = np.copy(i2), np.copy(i1)
+
+			## Find all sources that "link" across the two groups. Use these as reference sources.
+			cutset_left = []
+			cutset_right = []
+			for j in range(len(i1)):
+				cutset_right.append(i2[np.where(w_src_adj[i1[j],i2] > 0)[0]])
+			for j in range(len(i2)):
+				cutset_left.append(i1[np.where(w_src_adj[i2[j],i1] > 0)[0]])
+
+			cutset_left = np.unique(np.hstack(cutset_left)).astype('int')
+			cutset_right = np.unique(np.hstack(cutset_right)).astype('int')
+			cutset = np.unique(np.concatenate((cutset_left, cutset_right), axis = 0))
+
+			## Take the max arrival-source weights across the linking sources of each group, use CA to assign
+			## the picks to either group, and remove the arrival attachments of the group they are not assigned to.
+			unique_src_inds = np.sort(np.unique(cutset.reshape(-1,1))).astype('int')
+			arv_indices_sliced = np.where(w_slice[unique_src_inds,:].max(0) > thresh_assoc)[0]
+
+			arv_weights_p = np.concatenate((wp_slice[cutset_left.reshape(-1,1), arv_indices_sliced.reshape(1,-1)].max(0).reshape(1,-1), wp_slice[cutset_right.reshape(-1,1), arv_indices_sliced.reshape(1,-1)].max(0).reshape(1,-1)), axis = 0)
+			arv_weights_s = np.concatenate((ws_slice[cutset_left.reshape(-1,1), arv_indices_sliced.reshape(1,-1)].max(0).reshape(1,-1), ws_slice[cutset_right.reshape(-1,1), arv_indices_sliced.reshape(1,-1)].max(0).reshape(1,-1)), axis = 0)
+
+			assignment_picks, srcs_active_picks = competitive_assignment_split([arv_weights_p, arv_weights_s], ipick[arv_indices_sliced], 0.0)
+			node_all_arrivals = arv_ind_slice[arv_indices_sliced]
+
+			assign_picks_1 = np.unique(np.hstack(assignment_picks[0])) if len(assignment_picks) > 0 else np.array([])
+			assign_picks_2 = np.unique(np.hstack(assignment_picks[1])) if len(assignment_picks) > 1 else np.array([])
+
+			## Cut these arrivals from the sources in each group
+			for node_src, assign_picks in [(arv_src_slice[cutset_left] + len_unique_picks, assign_picks_1), (arv_src_slice[cutset_right] + len_unique_picks, assign_picks_2)]:
+				node_arrival_del = np.delete(node_all_arrivals, assign_picks.astype('int'), axis = 0)
+				remove_edges_from.append(np.concatenate((np.repeat(node_arrival_del, len(node_src), axis = 0).reshape(1,-1), np.tile(node_src, len(node_arrival_del)).reshape(1,-1)), axis = 0))
+
+			print('%d %d %d'%(len(arv_ind_slice), sum(clusters == 0), sum(clusters == 1)))
+
+		if len(remove_edges_from) > 0:
+			remove_edges_from = np.hstack(remove_edges_from)
+			remove_edges_from = np.concatenate((remove_edges_from, np.flip(remove_edges_from, axis = 0)), axis = 1)
+
+			G_nx.remove_edges_from(remove_edges_from.T)
+			Gp_nx.remove_edges_from(remove_edges_from.T)
+			Gs_nx.remove_edges_from(remove_edges_from.T)
+
+		num_splits = num_splits + 1
+
+	## Competitive assignment over each disconnected component
+	srcs_retained = []
+	cnt_src = 0
+
+	for i in range(len(discon_components)):
+
+		w_slice, wp_slice, ws_slice, arv_ind_slice, arv_src_slice = component_slices(discon_components[i])
+		ipick = unique_picks[arv_ind_slice,1].astype('int')
+
+		if (len(ipick) == 0) or (len(arv_src_slice) == 0):
+			continue
+
+		wp_slice[wp_slice <= thresh_assoc] = 0.0
+		ws_slice[ws_slice <= thresh_assoc] = 0.0
+		assignments, srcs_active = competitive_assignment([wp_slice, ws_slice], ipick, state['cost_value'])
+
+		for j in range(len(srcs_active)):
+
+			srcs_retained.append(srcs_refined[arv_src_slice[srcs_active[j]]].reshape(1,-1))
+
+			wp_val = wp_slice[srcs_active[j], assignments[j][0]]
+			ws_val = ws_slice[srcs_active[j], assignments[j][1]]
+
+			p_assign = np.concatenate((unique_picks[arv_ind_slice[assignments[j][0]],:], cnt_src*np.ones(len(assignments[j][0])).reshape(-1,1), wp_val.reshape(-1,1)), axis = 1)
+			s_assign = np.concatenate((unique_picks[arv_ind_slice[assignments[j][1]],:], cnt_src*np.ones(len(assignments[j][1])).reshape(-1,1), ws_val.reshape(-1,1)), axis = 1)
+			p_assign_perm = np.copy(p_assign)
+			s_assign_perm = np.copy(s_assign)
+			p_assign_perm[:,1] = perm_vec[p_assign_perm[:,1].astype('int')]
+			s_assign_perm[:,1] = perm_vec[s_assign_perm[:,1].astype('int')]
+			Picks_P.append(p_assign)
+			Picks_S.append(s_assign)
+			Picks_P_perm.append(p_assign_perm)
+			Picks_S_perm.append(s_assign_perm)
+
+			cnt_src += 1
+
+		print('%d : %d of %d'%(i, len(srcs_active), len(arv_src_slice)))
+
+	if len(srcs_retained) == 0:
+		print('No events left after competitive assignment (e.g., cost is too high w.r.t. amount of available picks)')
+		return empty
+
+	return dict(srcs_refined = np.vstack(srcs_retained), Picks_P = Picks_P, Picks_S = Picks_S, Picks_P_perm = Picks_P_perm, Picks_S_perm = Picks_S_perm)
+
+def locate_sources(state, ind_use, events):
+	## Locate the sources of associate_sources with travel times of their associated picks
+	## (optionally removing picks with large relative residuals and re-locating), estimate
+	## location uncertainties, and only keep events with the minimum required number of
+	## picks and stations. Adds srcs_trv (lat, lon, depth, origin time), srcs_sigma,
+	## del_arv_p, del_arv_s, cnt_p and cnt_s to events, and returns it.
+
+	trv, trv_pairwise1, ftrns1, ftrns2, device = state['trv'], state['trv_pairwise1'], state['ftrns1'], state['ftrns2'], state['device']
+	lat_range_extend, lon_range_extend, depth_range = state['lat_range_extend'], state['lon_range_extend'], state['depth_range']
+	min_required_picks, min_required_sta = state['min_required_picks'], state['min_required_sta']
+	max_relative_error, min_time_buffer = state['max_relative_error'], state['min_time_buffer']
+	locs_use = state['locs'][ind_use]
+	srcs_refined, Picks_P, Picks_S, Picks_P_perm, Picks_S_perm = events['srcs_refined'], events['Picks_P'], events['Picks_S'], events['Picks_P_perm'], events['Picks_S_perm']
+
+	def locate(locs_use_slice, arv_p, ind_p_perm_slice, arv_s, ind_s_perm_slice):
+
+		if state['use_differential_evolution_location'] == True:
+			xmle, logprob = differential_evolution_location(trv, locs_use_slice, arv_p, ind_p_perm_slice, arv_s, ind_s_perm_slice, lat_range_extend, lon_range_extend, depth_range, surface_profile = state['surface_profile'], device = device)
+		else:
+			xmle, logprob, Swarm = MLE_particle_swarm_location_one_mean_stable_depth_with_hull(trv, locs_use_slice, arv_p, ind_p_perm_slice, arv_s, ind_s_perm_slice, lat_range_extend, lon_range_extend, depth_range, state['dx_depth'], state['hull'], ftrns1, ftrns2)
+
+		return xmle
+
+	def residuals(locs_use_slice, xmle, origin, arv_p, ind_p_perm_slice, arv_s, ind_s_perm_slice):
+
+		pred_out = trv(torch.Tensor(locs_use_slice).to(device), torch.Tensor(xmle[0,0:3].reshape(1,-1)).to(device)).cpu().detach().numpy() + origin
+		return pred_out, pred_out[0,ind_p_perm_slice,0] - arv_p, pred_out[0,ind_s_perm_slice,1] - arv_s
+
+	def median_shift(res_p, res_s):
+
+		mean_shift = 0.0
+		if len(res_p) > 0:
+			mean_shift += np.median(res_p)*(len(res_p)/(len(res_p) + len(res_s)))
+		if len(res_s) > 0:
+			mean_shift += np.median(res_s)*(len(res_s)/(len(res_p) + len(res_s)))
+		return mean_shift
+
+	def slice_stations(ind_p, ind_s):
+
+		ind_unique_arrivals = np.sort(np.unique(np.concatenate((ind_p, ind_s), axis = 0)).astype('int'))
+		perm_vec_arrivals = -1*np.ones(locs_use.shape[0]).astype('int')
+		perm_vec_arrivals[ind_unique_arrivals] = np.arange(len(ind_unique_arrivals))
+		ind_p_perm_slice = perm_vec_arrivals[ind_p]
+		ind_s_perm_slice = perm_vec_arrivals[ind_s]
+		if len(ind_p_perm_slice) > 0:
+			assert(ind_p_perm_slice.min() > -1)
+		if len(ind_s_perm_slice) > 0:
+			assert(ind_s_perm_slice.min() > -1)
+		return ind_unique_arrivals, locs_use[ind_unique_arrivals], ind_p_perm_slice, ind_s_perm_slice
+
+	srcs_trv, srcs_sigma = [], []
+	del_arv_p, del_arv_s = [], []
+	torch.set_grad_enabled(True)
+	for i in range(srcs_refined.shape[0]):
+
+		arv_p, ind_p, arv_s, ind_s = Picks_P_perm[i][:,0], Picks_P_perm[i][:,1].astype('int'), Picks_S_perm[i][:,0], Picks_S_perm[i][:,1].astype('int')
+		ind_unique_arrivals, locs_use_slice, ind_p_perm_slice, ind_s_perm_slice = slice_stations(ind_p, ind_s)
+
+		n_del_p, n_del_s = 0, 0
+		xmle = np.nan*np.ones((1,3))
+		if len(ind_unique_arrivals) > 0:
+			xmle = locate(locs_use_slice, arv_p, ind_p_perm_slice, arv_s, ind_s_perm_slice)
+
+		if (np.isnan(xmle).sum() == 0)*(state['use_quality_check'] == True):
+
+			## Remove associated picks with both a relative error > max_relative_error and a residual > min_time_buffer
+			origin = srcs_refined[i,3] - median_shift(*residuals(locs_use_slice, xmle, srcs_refined[i,3], arv_p, ind_p_perm_slice, arv_s, ind_s_perm_slice)[1:])
+			pred_out, res_p, res_s = residuals(locs_use_slice, xmle, origin, arv_p, ind_p_perm_slice, arv_s, ind_s_perm_slice)
+			tval_p = pred_out[0,ind_p_perm_slice,0] - origin
+			tval_s = pred_out[0,ind_s_perm_slice,1] - origin
+			tval_p[tval_p <= 0] = 0.01
+			tval_s[tval_s <= 0] = 0.01
+			idel_p = np.where((np.abs(res_p/tval_p) > max_relative_error)*(np.abs(res_p) > min_time_buffer))[0]
+			idel_s = np.where((np.abs(res_s/tval_s) > max_relative_error)*(np.abs(res_s) > min_time_buffer))[0]
+			n_del_p, n_del_s = len(idel_p), len(idel_s)
+
+			if len(idel_p) > 0:
+				arv_p = np.delete(arv_p, idel_p, axis = 0)
+				ind_p = np.delete(ind_p, idel_p, axis = 0)
+				Picks_P[i] = np.delete(Picks_P[i], idel_p, axis = 0)
+				Picks_P_perm[i] = np.delete(Picks_P_perm[i], idel_p, axis = 0)
+
+			if len(idel_s) > 0:
+				arv_s = np.delete(arv_s, idel_s, axis = 0)
+				ind_s = np.delete(ind_s, idel_s, axis = 0)
+				Picks_S[i] = np.delete(Picks_S[i], idel_s, axis = 0)
+				Picks_S_perm[i] = np.delete(Picks_S_perm[i], idel_s, axis = 0)
+
+			if (n_del_p + n_del_s) > 0: ## If arrivals have been removed, re-locate
+
+				ind_unique_arrivals, locs_use_slice, ind_p_perm_slice, ind_s_perm_slice = slice_stations(ind_p, ind_s)
+				too_few = len(ind_unique_arrivals) == 0
+				if (min_required_picks is not False)*(min_required_sta is not False):
+					too_few = too_few or ((len(arv_p) + len(arv_s)) < min_required_picks) or (len(ind_unique_arrivals) < min_required_sta)
+				xmle = np.nan*np.ones((1,3)) if too_few else locate(locs_use_slice, arv_p, ind_p_perm_slice, arv_s, ind_s_perm_slice)
+
+		del_arv_p.append(n_del_p)
+		del_arv_s.append(n_del_s)
+
+		if np.isnan(xmle).sum() > 0:
+			srcs_trv.append(np.nan*np.ones((1, 4)))
+			srcs_sigma.append(np.nan)
+			continue
+
+		origin = srcs_refined[i,3] - median_shift(*residuals(locs_use_slice, xmle, srcs_refined[i,3], arv_p, ind_p_perm_slice, arv_s, ind_s_perm_slice)[1:])
+
+		## Estimate uncertainties from the travel time partial derivatives
+		scale_val1 = 100.0*np.linalg.norm(ftrns1(xmle[0,0:3].reshape(1,-1)) - ftrns1(xmle[0,0:3].reshape(1,-1) + np.array([0.01, 0, 0]).reshape(1,-1)), axis = 1)[0]
+		scale_val2 = 100.0*np.linalg.norm(ftrns1(xmle[0,0:3].reshape(1,-1)) - ftrns1(xmle[0,0:3].reshape(1,-1) + np.array([0.0, 0.01, 0]).reshape(1,-1)), axis = 1)[0]
+		scale_val = 0.5*(scale_val1 + scale_val2)
+
+		scale_partials = (1/60.0)*np.array([1.0, 1.0, scale_val]).reshape(1,-1)
+		src_input_p = Variable(torch.Tensor(xmle[0,0:3].reshape(1,-1)).repeat(len(ind_p_perm_slice),1).to(device), requires_grad = True)
+		src_input_s = Variable(torch.Tensor(xmle[0,0:3].reshape(1,-1)).repeat(len(ind_s_perm_slice),1).to(device), requires_grad = True)
+		trv_out_p = trv_pairwise1(torch.Tensor(locs_use_slice[ind_p_perm_slice]).to(device), src_input_p, method = 'direct')[:,0]
+		trv_out_s = trv_pairwise1(torch.Tensor(locs_use_slice[ind_s_perm_slice]).to(device), src_input_s, method = 'direct')[:,1]
+		d_p = scale_partials*torch.autograd.grad(inputs = src_input_p, outputs = trv_out_p, grad_outputs = torch.ones(len(trv_out_p)).to(device), retain_graph = True, create_graph = True, allow_unused = True)[0].cpu().detach().numpy()
+		d_s = scale_partials*torch.autograd.grad(inputs = src_input_s, outputs = trv_out_s, grad_outputs = torch.ones(len(trv_out_s)).to(device), retain_graph = True, create_graph = True, allow_unused = True)[0].cpu().detach().numpy()
+
+		d_grad = np.concatenate((d_p, d_s), axis = 0)
+		sig_d = 0.15 ## Assumed pick uncertainty (seconds)
+		chi_pdf = chi2(df = 3).pdf(0.99)
+
+		var_cart = (d_grad/scale_partials)/np.array([scale_val1, scale_val2, 1.0]).reshape(1,-1)
+		var_cart = np.linalg.pinv(var_cart.T@var_cart)*(sig_d**2)
+		var_cart = var_cart*chi_pdf
+		sigma_cart = np.linalg.norm(np.diag(var_cart)**(0.5))
+
+		## Append the final location and origin time
+		srcs_trv.append(np.concatenate((xmle, np.array([origin]).reshape(1,-1)), axis = 1))
+		srcs_sigma.append(sigma_cart)
+
+	torch.set_grad_enabled(False)
+
+	srcs_trv = np.vstack(srcs_trv) if len(srcs_trv) > 0 else np.zeros((0,4))
+	srcs_sigma = np.array(srcs_sigma, dtype = float)
+	del_arv_p = np.array(del_arv_p, dtype = int)
+	del_arv_s = np.array(del_arv_s, dtype = int)
+	assert(len(srcs_trv) == len(srcs_sigma) == len(del_arv_p) == len(del_arv_s) == len(Picks_P) == len(Picks_S) == len(srcs_refined))
+
+	## Only keep events with minimum number of picks and observing stations
+	cnt_p = np.array([len(Picks_P[i]) for i in range(len(srcs_refined))], dtype = float)
+	cnt_s = np.array([len(Picks_S[i]) for i in range(len(srcs_refined))], dtype = float)
+	ikeep = np.arange(len(srcs_refined))
+	if (min_required_picks is not False)*(min_required_sta is not False):
+		n_sta = np.array([len(np.unique(np.concatenate((Picks_P[j][:,1], Picks_S[j][:,1]), axis = 0))) for j in range(len(srcs_refined))])
+		ikeep = np.where(((cnt_p + cnt_s) >= min_required_picks)*(n_sta >= min_required_sta))[0]
+		if len(ikeep) == 0:
+			print('No events left after minimum pick requirements')
+
+	events = dict(srcs_refined = srcs_refined[ikeep], srcs_trv = srcs_trv[ikeep], srcs_sigma = srcs_sigma[ikeep],
+		del_arv_p = del_arv_p[ikeep], del_arv_s = del_arv_s[ikeep], cnt_p = cnt_p[ikeep], cnt_s = cnt_s[ikeep],
+		Picks_P = [Picks_P[j] for j in ikeep], Picks_S = [Picks_S[j] for j in ikeep],
+		Picks_P_perm = [Picks_P_perm[j] for j in ikeep], Picks_S_perm = [Picks_S_perm[j] for j in ikeep])
+	print('Detected %d events'%len(events['srcs_trv']))
+
+	return events
+
+def compute_magnitudes(state, events):
+	## Magnitudes from the pick amplitudes with the trained magnitude model (if one was
+	## loaded; otherwise NaN), at the travel time location (or the GNN location if not located)
+
+	n_events = len(events['srcs_trv'])
+	if (state['loaded_mag_model'] == False) or (n_events == 0):
+		return np.nan*np.ones(n_events)
+
+	Mag, device = state['mags'], state['device']
+	srcs = np.where(np.isnan(events['srcs_trv'][:,0:1]), events['srcs_refined'][:,0:3], events['srcs_trv'][:,0:3])
+	mag_pred = []
+	for i in range(n_events):
+
+		Picks_P, Picks_S = events['Picks_P'][i], events['Picks_S'][i]
+		ind_p, log_amp_p = Picks_P[:,1].astype('int'), np.log10(Picks_P[:,2])
+		ind_s, log_amp_s = Picks_S[:,1].astype('int'), np.log10(Picks_S[:,2])
+
+		mag_p = Mag(torch.Tensor(ind_p).long().to(device), torch.Tensor(srcs[i,0:3].reshape(1,-1)).to(device), torch.Tensor(log_amp_p).to(device), torch.zeros(len(ind_p)).long().to(device))
+		mag_s = Mag(torch.Tensor(ind_s).long().to(device), torch.Tensor(srcs[i,0:3].reshape(1,-1)).to(device), torch.Tensor(log_amp_s).to(device), torch.ones(len(ind_s)).long().to(device))
+		mag_pred.append(np.median(np.concatenate((mag_p.cpu().detach().numpy().reshape(-1), mag_s.cpu().detach().numpy().reshape(-1)), axis = 0)))
+
+	return np.hstack(mag_pred)
+
+def match_known_events(state, srcs_known, events, temporal_win_match = 8.0, spatial_win_match = 30e3):
+	## Match known (e.g., USGS) events to the GNN locations (matches1) and the travel time
+	## locations (matches2); rows are (known event index, detected event index)
+
+	ftrns1, ftrns2 = state['ftrns1'], state['ftrns2']
+	srcs_trv = events['srcs_trv']
+	ifind_not_nan = np.where(np.isnan(srcs_trv[:,0]) == 0)[0]
+
+	matches1 = maximize_bipartite_assignment(srcs_known, events['srcs_refined'], ftrns1, ftrns2, temporal_win = temporal_win_match, spatial_win = spatial_win_match, verbose = False)[0]
+	if len(ifind_not_nan) > 0:
+		matches2 = maximize_bipartite_assignment(srcs_known, srcs_trv[ifind_not_nan], ftrns1, ftrns2, temporal_win = temporal_win_match, spatial_win = spatial_win_match, verbose = False)[0]
+		matches2[:,1] = ifind_not_nan[matches2[:,1]]
+	else:
+		matches2 = np.nan*np.zeros((0,2))
+
+	return matches1, matches2
+
+def save_day(state, date, P, ind_use, events, mag_pred, x_grid_ind_list, x_grid_ind_list_1, srcs_known = None, matches = None, Out_2_sparse = None):
+	## Write the catalog of one day (sources, locations and associated picks) to
+	## Catalog/<year>/<project>_results_<continuous_days or known_events>_<date>_ver_<n_save_ver>.hdf5.
+	## Out_2_sparse (the continuous space-time output) is only saved if given, since it is memory intensive.
+	## Returns the path of the saved file.
+
+	trv, locs, device, seperator = state['trv'], state['locs'], state['device'], state['seperator']
+	locs_use = locs[ind_use]
+	srcs_refined, srcs_trv = events['srcs_refined'], events['srcs_trv']
+	Picks_P, Picks_S, Picks_P_perm, Picks_S_perm = events['Picks_P'], events['Picks_S'], events['Picks_P_perm'], events['Picks_S_perm']
+
+	perm_vec = -1*np.ones(locs.shape[0])
+	perm_vec[ind_use] = np.arange(len(ind_use))
+	P_perm = np.copy(P)
+	P_perm[:,1] = perm_vec[P_perm[:,1].astype('int')]
+
+	## Predicted arrival times of the GNN locations (trv_out1) and travel time locations (trv_out2)
+	trv_out1 = np.zeros((len(srcs_refined), locs_use.shape[0], 2))
+	trv_out1_all = np.zeros((len(srcs_refined), locs.shape[0], 2))
+	if len(srcs_refined) > 0:
+		trv_out1 = trv(torch.Tensor(locs_use).to(device), torch.Tensor(srcs_refined[:,0:3]).to(device)).cpu().detach().numpy() + srcs_refined[:,3].reshape(-1,1,1)
+		trv_out1_all = trv(torch.Tensor(locs).to(device), torch.Tensor(srcs_refined[:,0:3]).to(device)).cpu().detach().numpy() + srcs_refined[:,3].reshape(-1,1,1)
+
+	trv_out2 = np.nan*np.zeros((srcs_trv.shape[0], locs_use.shape[0], 2))
+	trv_out2_all = np.nan*np.zeros((srcs_trv.shape[0], locs.shape[0], 2))
+	ifind_not_nan = np.where(np.isnan(srcs_trv[:,0]) == 0)[0]
+	if len(ifind_not_nan) > 0:
+		trv_out2[ifind_not_nan,:,:] = trv(torch.Tensor(locs_use).to(device), torch.Tensor(srcs_trv[ifind_not_nan,0:3]).to(device)).cpu().detach().numpy() + srcs_trv[ifind_not_nan,3].reshape(-1,1,1)
+		trv_out2_all[ifind_not_nan,:,:] = trv(torch.Tensor(locs).to(device), torch.Tensor(srcs_trv[ifind_not_nan,0:3]).to(device)).cpu().detach().numpy() + srcs_trv[ifind_not_nan,3].reshape(-1,1,1)
+
+	file_name_ext = 'known_events' if state['process_known_events'] == True else 'continuous_days'
+	path_save = state['path_to_file'] + 'Catalog' + seperator + '%d'%date[0] + seperator
+	os.makedirs(path_save, exist_ok = True)
+	ext_save = path_save + '%s_results_%s_%d_%d_%d_ver_%d.hdf5'%(state['name_of_project'], file_name_ext, date[0], date[1], date[2], state['n_save_ver'])
+
+	julday = int((UTCDateTime(date[0], date[1], date[2]) - UTCDateTime(date[0], 1, 1))/(state['day_len'])) + 1
+
+	## Note: the solution is in srcs or srcs_trv (lat, lon, depth, origin time)
+	## (the GNN prediction location and travel-time based location based on the GNN prediction associations)
+	## The associated picks for each event are in Picks/{n}_Picks_P and Picks/{n}_Picks_S for each source index n
+	file_save = h5py.File(ext_save, 'w')
+	file_save['P'] = P
+	file_save['P_perm'] = P_perm
+	file_save['srcs'] = srcs_refined ## These are the direct locations predicted by the GNN (usually has some spatial bias due to locations of source nodes)
+	file_save['srcs_trv'] = srcs_trv ## These are the travel time located sources using associated picks (usually the most accurate!)
+	file_save['srcs_w'] = srcs_refined[:,4] ## The detection likelihood value for each source (e.g., > thresh, and usually < 1).
+	file_save['srcs_sigma'] = events['srcs_sigma'] ## The location uncertainty of each source
+	file_save['locs'] = locs
+	file_save['locs_use'] = locs_use
+	file_save['ind_use'] = ind_use
+	file_save['date'] = np.array([date[0], date[1], date[2], julday])
+	file_save['cnt_p'] = events['cnt_p'] ## Number of P picks per event
+	file_save['cnt_s'] = events['cnt_s'] ## Number of S picks per event
+	file_save['del_arv_p'] = events['del_arv_p'] ## Number of deleted P picks during quality check
+	file_save['del_arv_s'] = events['del_arv_s'] ## Number of deleted S picks during quality check
+	file_save['tsteps_abs'] = state['tsteps_abs']
+	file_save['X_query'] = state['X_query']
+	file_save['mag_r'] = mag_pred
+	file_save['mag_trv'] = mag_pred
+	file_save['x_grid_ind_list'] = x_grid_ind_list
+	file_save['x_grid_ind_list_1'] = x_grid_ind_list_1
+	file_save['trv_out1'] = trv_out1
+	file_save['trv_out2'] = trv_out2
+	file_save['trv_out1_all'] = trv_out1_all
+	file_save['trv_out2_all'] = trv_out2_all
+
+	if (srcs_known is not None) and (len(srcs_known) > 0):
+		file_save['srcs_known'] = srcs_known
+		if matches is not None:
+			file_save['izmatch1'] = matches[0]
+			file_save['izmatch2'] = matches[1]
+
+	if Out_2_sparse is not None: # This is the continuous space-time output, it can be useful for visualization/debugging, but is memory itensive
+		file_save['Out'] = Out_2_sparse
+
+	for j in range(len(Picks_P)):
+		file_save['Picks/%d_Picks_P'%j] = Picks_P[j]
+		file_save['Picks/%d_Picks_S'%j] = Picks_S[j]
+		file_save['Picks/%d_Picks_P_perm'%j] = Picks_P_perm[j]
+		file_save['Picks/%d_Picks_S_perm'%j] = Picks_S_perm[j]
+
+	file_save.close()
+	print('Finished saving file %d %d %d (%d events)'%(date[0], date[1], date[2], len(srcs_trv)))
+
+	return ext_save
+
+def process_day(state, date, day_select, offset_select):
+	## Detect, associate and locate the events of one day, and save the catalog file.
+	## Returns the path of the saved file (or None if no sources were detected).
+
+	st = time.time()
+	date = np.array([int(date[0]), int(date[1]), int(date[2])])
+
+	rng = seed_day(day_select, offset_select)
+	x_grid_ind_list, x_grid_ind_list_1 = draw_grid_indices(state, rng)
+
+	P, ind_use = load_day_picks(state, date)
+
+	srcs_known = None
+	if state['process_known_events'] == True:
+		t0 = UTCDateTime(date[0], date[1], date[2])
+		srcs_known = download_catalog(state['lat_range'], state['lon_range'], 0.1, t0, t0 + state['day_len'], t0 = t0, client = 'USGS')[0]
+		print('Downloaded %d known events'%len(srcs_known))
+
+	A_src_in_sta_l = set_adjacencies(state, ind_use)
+	srcs, Out_2_sparse = detect_sources(state, P, ind_use, A_src_in_sta_l, x_grid_ind_list, rng, srcs_known = srcs_known)
+	if len(srcs) == 0:
+		print('No sources detected on %d/%d/%d'%(date[0], date[1], date[2]))
+		return None
+
+	events = associate_sources(state, P, ind_use, srcs, A_src_in_sta_l, x_grid_ind_list_1, rng)
+	events = locate_sources(state, ind_use, events)
+	mag_pred = compute_magnitudes(state, events)
+
+	matches = None
+	if (srcs_known is not None) and (len(srcs_known) > 0) and (len(events['srcs_trv']) > 0):
+		matches = match_known_events(state, srcs_known, events)
+
+	ext_save = save_day(state, date, P, ind_use, events, mag_pred, x_grid_ind_list, x_grid_ind_list_1, srcs_known = srcs_known, matches = matches)
+	print('Processed %d/%d/%d in %0.2f s'%(date[0], date[1], date[2], time.time() - st))
+
+	return ext_save
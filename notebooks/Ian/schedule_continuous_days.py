@@ -0,0 +1,213 @@
+## Parallel scheduler for processing many (day, offset) units with GENIE.
+##
+## tutorial_run_genie (and process_continuous_days.py) process one day per call,
+## selected by argvs[1] (day_select) and argvs[2] (offset_select), and re-load the
+## configs, stations, velocity model tables, templates, trained models and the
+## prebuilt sampling grid every time. Here, the shared state is loaded once per
+## worker process (load_shared_state), the (day, offset) units are distributed over
+## a process pool, and finished units are written to a checkpoint file so a rerun
+## only processes the units that have not completed yet.
+##
+## Usage (from the GENIE project directory, e.g., ./Ferndale):
+##
+## python schedule_continuous_days.py --n_workers 16
+##
+## which runs process_continuous_day:process_day (the detection, association and
+## location steps of tutorial_run_genie) on each day. Any other function with the
+## signature process_fn(state, date, day_select, offset_select), returning the path
+## of the saved catalog file (or None), can be given as 'module:function'.
+
+import os
+import sys
+import time
+import argparse
+import importlib
+import traceback
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import yaml
+import numpy as np
+import torch
+
+_state = None
+_process_fn = None
+
+def read_process_days(path_to_file, name_of_project, process_days_ver):
+	## Read the %s_process_days_list_ver_%d.txt file (one yr, mo, dy per line,
+	## seperated by '/', ',' or ' ')
+
+	z = open(path_to_file + '%s_process_days_list_ver_%d.txt'%(name_of_project, process_days_ver), 'r')
+	lines = z.readlines()
+	z.close()
+
+	dates = []
+	for line in lines:
+		if len(line.strip()) == 0:
+			continue
+		if '/' in line:
+			date = line.split('/')
+		elif ',' in line:
+			date = line.split(',')
+		else:
+			date = line.split()
+		dates.append(np.array([int(date[0]), int(date[1]), int(date[2])]))
+
+	return dates
+
+def make_units(n_days, offset_increment, day_inds = None):
+	## Map line indices of the process days list to (day_select, offset_select) pairs,
+	## so that day_select + offset_select*offset_increment is the line index
+	## (the same convention as argvs[1] and argvs[2] of process_continuous_days.py)
+
+	if day_inds is None:
+		day_inds = np.arange(n_days)
+
+	return [(int(i % offset_increment), int(i // offset_increment)) for i in day_inds if i < n_days]
+
+class Checkpoint(object):
+	## Append-only record of completed units (one line per unit; written only by the
+	## scheduling process, and flushed to disk after each unit, so an interrupted run
+	## loses at most the units still in progress).
+
+	def __init__(self, file_name):
+
+		self.file_name = file_name
+		self.done = dict()
+
+		if os.path.isfile(file_name) == True:
+			z = open(file_name, 'r')
+			for line in z.readlines():
+				vals = line.split()
+				if len(vals) < 6: ## Partially written line (e.g., killed during a write)
+					continue
+				self.done[(int(vals[2]), int(vals[3]), int(vals[4]))] = line.strip()
+			z.close()
+
+	def __contains__(self, date):
+
+		return (int(date[0]), int(date[1]), int(date[2])) in self.done
+
+	def __len__(self):
+
+		return len(self.done)
+
+	def add(self, unit, date, elapsed, ext_save = None):
+
+		line = '%d %d %d %d %d %0.2f %s'%(unit[0], unit[1], date[0], date[1], date[2], elapsed, ext_save)
+		with open(self.file_name, 'a') as z:
+			z.write(line + '\n')
+			z.flush()
+			os.fsync(z.fileno())
+		self.done[(int(date[0]), int(date[1]), int(date[2]))] = line
+
+def resolve_process_fn(process_fn):
+	## process_fn can be a function, or a 'module:function' string (needed with the
+	## 'spawn' start method, where functions defined in a notebook cannot be pickled)
+
+	if isinstance(process_fn, str):
+		module_name, fn_name = process_fn.split(':')
+		process_fn = getattr(importlib.import_module(module_name), fn_name)
+
+	return process_fn
+
+def _init_worker(path_to_file, device, n_threads, process_fn):
+	## Runs once in each worker process
+
+	global _state, _process_fn
+
+	## Imported here rather than at module level, so that --path (added to sys.path
+	## before the pool starts, and inherited by the workers) can locate the module
+	from process_continuous_day import load_shared_state
+
+	torch.set_num_threads(n_threads) ## Avoid oversubscribing cores with n_workers*n_cores threads
+	st = time.time()
+	_state = load_shared_state(path_to_file, device = device)
+	_process_fn = resolve_process_fn(process_fn)
+	print('Worker %d loaded shared state (%0.2f s)'%(os.getpid(), time.time() - st))
+
+def _run_unit(unit, date):
+
+	st = time.time()
+	try:
+		ext_save = _process_fn(_state, date, unit[0], unit[1])
+		return unit, date, True, time.time() - st, ext_save
+	except:
+		return unit, date, False, time.time() - st, traceback.format_exc()
+
+def run_schedule(process_fn, path_to_file, units = None, n_workers = 4, n_threads = 1, device = 'cpu', checkpoint_file = None, start_method = None):
+	## Process all (day_select, offset_select) units (default: every day in the
+	## process days list) over a pool of n_workers processes, skipping days already
+	## recorded in the checkpoint file. Returns the list of failed units with tracebacks.
+
+	seperator = '\\' if '\\' in path_to_file else '/'
+	if path_to_file[-1] != seperator:
+		path_to_file += seperator
+
+	with open(path_to_file + 'process_config.yaml', 'r') as file:
+		process_config = yaml.safe_load(file)
+	with open(path_to_file + 'config.yaml', 'r') as file:
+		config = yaml.safe_load(file)
+
+	offset_increment = process_config['offset_increment']
+	dates = read_process_days(path_to_file, config['name_of_project'], process_config['process_days_ver'])
+	if units is None:
+		units = make_units(len(dates), offset_increment)
+
+	if checkpoint_file is None:
+		checkpoint_file = path_to_file + '%s_process_days_checkpoint_ver_%d.txt'%(config['name_of_project'], process_config['n_save_ver'])
+	checkpoint = Checkpoint(checkpoint_file)
+
+	units_run = []
+	for unit in units:
+		day_select_val = unit[0] + unit[1]*offset_increment
+		if (day_select_val < len(dates))*((dates[day_select_val] in checkpoint) == False):
+			units_run.append((unit, dates[day_select_val]))
+
+	print('Processing %d of %d units (%d already finished) on %d workers'%(len(units_run), len(units), len(units) - len(units_run), n_workers))
+	if len(units_run) == 0:
+		return []
+
+	if (start_method is None)*(torch.device(device).type == 'cuda'):
+		start_method = 'spawn' ## cuda can not be re-initialized in forked processes
+
+	failed = []
+	st = time.time()
+	with ProcessPoolExecutor(max_workers = min(n_workers, len(units_run)), mp_context = mp.get_context(start_method), initializer = _init_worker, initargs = (path_to_file, device, n_threads, process_fn)) as pool:
+
+		futures = [pool.submit(_run_unit, unit, date) for unit, date in units_run]
+		for cnt, future in enumerate(as_completed(futures)):
+			unit, date, success, elapsed, out = future.result()
+			if success == True:
+				checkpoint.add(unit, date, elapsed, ext_save = out)
+				print('Finished %d/%d/%d (day %d, offset %d) in %0.2f s [%d/%d, %0.2f s total]'%(date[0], date[1], date[2], unit[0], unit[1], elapsed, cnt + 1, len(units_run), time.time() - st))
+			else:
+				failed.append((unit, date, out))
+				print('Failed %d/%d/%d (day %d, offset %d)\n%s'%(date[0], date[1], date[2], unit[0], unit[1], out))
+
+	print('Finished %d units, %d failed (%0.2f s)'%(len(units_run) - len(failed), len(failed), time.time() - st))
+
+	return failed
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description = 'Process many days with GENIE over a pool of workers')
+	parser.add_argument('process_fn', nargs = '?', default = 'process_continuous_day:process_day', help = "per-day processing function, as 'module:function'")
+	parser.add_argument('--path', default = os.getcwd(), help = 'GENIE project directory')
+	parser.add_argument('--days', type = int, nargs = '*', default = None, help = 'line indices of the process days list (default: all)')
+	parser.add_argument('--n_workers', type = int, default = 4)
+	parser.add_argument('--n_threads', type = int, default = 1, help = 'torch threads per worker')
+	parser.add_argument('--device', default = 'cpu')
+	parser.add_argument('--checkpoint', default = None)
+	args = parser.parse_args()
+
+	sys.path.insert(0, args.path)
+	units = None
+	if args.days is not None:
+		with open(os.path.join(args.path, 'process_config.yaml'), 'r') as file:
+			offset_increment = yaml.safe_load(file)['offset_increment']
+		units = make_units(max(args.days) + 1, offset_increment, day_inds = args.days)
+
+	failed = run_schedule(args.process_fn, args.path, units = units, n_workers = args.n_workers, n_threads = args.n_threads, device = args.device, checkpoint_file = args.checkpoint)
+	if len(failed) > 0:
+		sys.exit(1)
@@ -0,0 +1,318 @@
+"""
+Sliding-window GNN inference over a real station network.
+
+The GNN notebooks only ever apply the models (`MLPNet` for origin regression,
+`BasicNet` / `best_node_reg.pt` for node signal regression) to isolated synthetic
+graphs. This module runs them continuously:
+
+1. `StationGraph` builds the station graph once from real coordinates
+   (e.g., `station_file.txt`): positions in model units, kNN edges and static
+   edge features (`edge_weight` and `edge_attr`).
+2. `StationGraph.batch` tiles that graph into a disjoint batch of any size,
+   cached per size, so no graph structure is rebuilt per window.
+3. `SlidingWindowPredictor` slides a window over continuous per-station features
+   (e.g., U-Net P probability traces), runs the model on many windows per forward
+   pass, and can be fed new samples incrementally to keep up with real time.
+"""
+import numpy as np
+import pandas as pd
+import torch
+from numpy.lib.stride_tricks import sliding_window_view
+
+from synthetic_graphs import knn_edges
+
+KM_PER_DEG = 111.19
+
+
+def read_station_file(path):
+    """
+    Read a station file with "Station, Latitude, Longitude, Elevation" columns.
+
+    Args:
+        path (str): Path to the station file (e.g., `Amanda/station_file.txt`)
+
+    Returns:
+        pd.DataFrame: One row per station
+    """
+    df = pd.read_csv(path, sep=r",\s*", engine="python")
+    df.columns = [c.strip() for c in df.columns]
+    df["Station"] = df["Station"].str.strip()
+    return df
+
+
+class StationGraph:
+    """
+    Static station graph with positions in model units and precomputed edges.
+
+    Station coordinates are projected to a local tangent plane [km] and rescaled
+    so the network fits in [0, extent]^2 (the coordinate frame of the synthetic
+    training data), preserving aspect ratio.
+
+    Args:
+        latitude (array-like): Station latitudes [deg]
+        longitude (array-like): Station longitudes [deg]
+        names (list, optional): Station names, in feature row order
+        k (int): Number of nearest neighbours for edge construction (6, as in GNN_node_regression_annotated)
+        extent (float): Size of the model coordinate box
+    """
+    def __init__(self, latitude, longitude, names=None, k=6, extent=6.0):
+        self.latitude = np.asarray(latitude, dtype=np.float64)
+        self.longitude = np.asarray(longitude, dtype=np.float64)
+        self.names = list(names) if names is not None else [str(i) for i in range(len(self.latitude))]
+        self.k = k
+        self.extent = extent
+
+        # --- Local projection and scaling to model units ---
+        self.lat0 = self.latitude.mean()
+        self.lon0 = self.longitude.mean()
+        xy_km = self.to_km(self.latitude, self.longitude)
+        self.km_min = xy_km.min(axis=0)
+        self.km_span = max((xy_km.max(axis=0) - self.km_min).max(), 1e-9)
+        pos = self.km_to_model(xy_km).astype(np.float32)
+
+        # --- Static edges and edge features ---
+        n = len(pos)
+        _, src, dst = knn_edges(pos[None], np.array([n]), k)
+        delta = pos[dst] - pos[src]
+        self.pos = torch.from_numpy(pos)
+        self.edge_index = torch.from_numpy(np.stack([src, dst]).astype(np.int64))
+        self.edge_weight = torch.from_numpy((1 / (np.linalg.norm(delta, axis=1) + 1)).astype(np.float32))
+        self.edge_attr = torch.from_numpy(delta.astype(np.float32))
+        self._batch = None
+
+    @classmethod
+    def from_station_file(cls, path, **kwargs):
+        """
+        Build a station graph from a station file.
+
+        Args:
+            path (str): Path to a "Station, Latitude, Longitude, Elevation" file
+            **kwargs: Passed to `StationGraph`
+
+        Returns:
+            StationGraph: Station graph in file order
+        """
+        df = read_station_file(path)
+        return cls(df["Latitude"].values, df["Longitude"].values, names=df["Station"].values, **kwargs)
+
+    @property
+    def num_nodes(self):
+        return len(self.pos)
+
+    def to_km(self, latitude, longitude):
+        x = (np.asarray(longitude) - self.lon0) * KM_PER_DEG * np.cos(np.radians(self.lat0))
+        y = (np.asarray(latitude) - self.lat0) * KM_PER_DEG
+        return np.stack([x, y], axis=-1)
+
+    def km_to_model(self, xy_km):
+        return (np.asarray(xy_km) - self.km_min) / self.km_span * self.extent
+
+    def model_to_latlon(self, xy_model):
+        """
+        Convert model-unit coordinates (e.g., denormalized origin predictions) to latitude/longitude.
+
+        Args:
+            xy_model (array-like): Coordinates [..., 2] in model units
+
+        Returns:
+            tuple: (latitude, longitude) arrays
+        """
+        xy_km = np.asarray(xy_model) / self.extent * self.km_span + self.km_min
+        lat = self.lat0 + xy_km[..., 1] / KM_PER_DEG
+        lon = self.lon0 + xy_km[..., 0] / (KM_PER_DEG * np.cos(np.radians(self.lat0)))
+        return lat, lon
+
+    def batch(self, nb_windows, device="cpu"):
+        """
+        Disjoint batch of `nb_windows` copies of the station graph.
+
+        Node order is window-major: node `w * num_nodes + i` is station `i` in window `w`,
+        so smaller batches are views into the largest one built so far. Only that batch
+        (on the last requested device) is cached.
+
+        Args:
+            nb_windows (int): Number of copies
+            device (str or torch.device): Target device
+
+        Returns:
+            dict: pos, edge_index, edge_weight, edge_attr and batch tensors
+        """
+        device = torch.device(device)
+        n, e = self.num_nodes, self.edge_index.shape[1]
+        if self._batch is None or self._batch["pos"].device != device or len(self._batch["pos"]) < nb_windows * n:
+            offsets = torch.arange(nb_windows).repeat_interleave(e) * n
+            self._batch = {
+                "pos": self.pos.repeat(nb_windows, 1).to(device),
+                "edge_index": (self.edge_index.repeat(1, nb_windows) + offsets).to(device),
+                "edge_weight": self.edge_weight.repeat(nb_windows).to(device),
+                "edge_attr": self.edge_attr.repeat(nb_windows, 1).to(device),
+                "batch": torch.arange(nb_windows).repeat_interleave(n).to(device),
+            }
+        b = self._batch
+        return {
+            "pos": b["pos"][:nb_windows * n],
+            "edge_index": b["edge_index"][:, :nb_windows * e],
+            "edge_weight": b["edge_weight"][:nb_windows * e],
+            "edge_attr": b["edge_attr"][:nb_windows * e],
+            "batch": b["batch"][:nb_windows * n],
+        }
+
+
+def features_from_stream(st, graph, starttime, endtime, sampling_rate, channel="*"):
+    """
+    Align per-station traces (e.g., U-Net probability traces written as a Stream)
+    onto a common time base, one row per graph station.
+
+    Args:
+        st (obspy.Stream): Traces with station codes matching `graph.names`
+            ("STA" or "STA.NET" names are both accepted)
+        graph (StationGraph): Station graph defining row order
+        starttime (obspy.UTCDateTime): Start of the common time base
+        endtime (obspy.UTCDateTime): End of the common time base
+        sampling_rate (float): Sampling rate of the features [Hz]
+        channel (str): Channel pattern selecting the feature traces
+
+    Returns:
+        np.ndarray: Features [num_stations, npts]; stations without data are NaN
+    """
+    npts = int(round((endtime - starttime) * sampling_rate))
+    features = np.full((graph.num_nodes, npts), np.nan, dtype=np.float32)
+    for i, name in enumerate(graph.names):
+        sta, _, net = name.partition(".")
+        _st = st.select(station=sta, network=net or "*", channel=channel).copy()
+        if len(_st) == 0:
+            continue
+        _st.merge(fill_value=0)
+        tr = _st[0]
+        tr.trim(starttime, endtime, pad=True, fill_value=0)
+        tr.interpolate(sampling_rate, starttime=starttime, npts=npts)
+        features[i] = tr.data
+    return features
+
+
+class SlidingWindowPredictor:
+    """
+    Run a graph model over sliding windows of continuous station features.
+
+    Args:
+        model (torch.nn.Module): Trained model. For `mode="origin"` it is called as
+            `model(pos, signal, edge_index, edge_weight, batch)` (`MLPNet`); for
+            `mode="node"` as `model(pos, signal, edge_index, edge_attr, mask)` (`BasicNet`).
+        graph (StationGraph): Static station graph
+        window (int): Window length in samples (the model's signal size)
+        step (int): Samples between consecutive windows
+        batch_size (int): Windows per forward pass
+        mode (str): "origin" (graph-level origin regression) or "node" (node-level regression)
+        denormalize (callable, optional): Maps model outputs to model-unit coordinates
+            (e.g., `NormalizeTargetsWrapper.denormalize`); defaults to [-1, 1] -> [0, extent]
+        device (str or torch.device): Inference device
+    """
+    def __init__(self, model, graph, window, step=1, batch_size=256, mode="origin",
+                 denormalize=None, device="cpu"):
+        if mode not in ["origin", "node"]:
+            raise ValueError(f"unknown mode '{mode}'")
+        self.model = model.to(device).eval()
+        self.graph = graph
+        self.window = window
+        self.step = step
+        self.batch_size = batch_size
+        self.mode = mode
+        if denormalize is None:
+            denormalize = lambda y: 0.5 * (y + 1) * graph.extent
+        self.denormalize = denormalize
+        self.device = device
+        # Samples carried over between `update` calls, the sample index they start at, and
+        # samples still to be dropped before the next window (when `step` > `window`)
+        self._buffer = np.empty((graph.num_nodes, 0), dtype=np.float32)
+        self._buffer_start = 0
+        self._skip = 0
+
+    @torch.inference_mode()
+    def _forward(self, windows):
+        """Run the model on windows [nb_windows, num_stations, window] in one disjoint batch."""
+        nb = len(windows)
+        g = self.graph.batch(nb, self.device)
+        missing = np.isnan(windows).any(axis=-1).reshape(-1)
+        signal = torch.from_numpy(np.nan_to_num(windows).reshape(nb * self.graph.num_nodes, self.window))
+        signal = signal.to(self.device, torch.float32)
+        if self.mode == "origin":
+            out = self.model(g["pos"], signal, g["edge_index"], g["edge_weight"], g["batch"])
+            return self.denormalize(out).cpu().numpy()
+        # Stations without data are masked, so the model reconstructs them from their neighbours
+        mask = torch.from_numpy(missing).to(self.device)
+        out = self.model(g["pos"], signal, g["edge_index"], g["edge_attr"], mask)
+        return out.reshape(nb, self.graph.num_nodes, self.window).cpu().numpy()
+
+    def predict(self, features):
+        """
+        Predict on every window of a block of continuous features.
+
+        Args:
+            features (np.ndarray): Features [num_stations, npts] in graph station order
+
+        Returns:
+            tuple: (window start sample indices, outputs). Outputs are origins [nb_windows, 2]
+                in model units for `mode="origin"`, or node signals
+                [nb_windows, num_stations, window] for `mode="node"`
+        """
+        features = np.asarray(features, dtype=np.float32)
+        if features.shape[1] < self.window:
+            return np.empty(0, dtype=np.int64), None
+        # Strided view: no copy until a chunk of windows is sent to the model
+        windows = sliding_window_view(features, self.window, axis=1)[:, ::self.step].transpose(1, 0, 2)
+        outputs = [self._forward(np.ascontiguousarray(windows[b:b + self.batch_size]))
+                   for b in range(0, len(windows), self.batch_size)]
+        starts = np.arange(len(windows)) * self.step
+        return starts, np.concatenate(outputs)
+
+    def update(self, new_features):
+        """
+        Append newly arrived samples and predict on every window completed by them.
+
+        Args:
+            new_features (np.ndarray): New samples [num_stations, n_new] in graph station order
+
+        Returns:
+            tuple: (window start sample indices since the first `update`, outputs)
+        """
+        self._buffer = np.concatenate([self._buffer, np.asarray(new_features, dtype=np.float32)], axis=1)
+        self._drop(self._skip)
+        starts, out = self.predict(self._buffer)
+        if len(starts) == 0:
+            return starts, out
+        starts = starts + self._buffer_start
+        # Keep only the samples needed by the next window, which may start past the buffer end
+        self._drop(len(starts) * self.step)
+        return starts, out
+
+    def _drop(self, n):
+        """Drop up to `n` samples from the front of the buffer; the rest are dropped on arrival."""
+        dropped = min(n, self._buffer.shape[1])
+        self._buffer = self._buffer[:, dropped:]
+        self._buffer_start += dropped
+        self._skip = n - dropped
+
+    def predict_origins(self, features, starttime=None, sampling_rate=1.0):
+        """
+        Predict origins on every window and tabulate them with times and geographic coordinates.
+
+        Args:
+            features (np.ndarray): Features [num_stations, npts] in graph station order
+            starttime (obspy.UTCDateTime, optional): Time of the first feature sample
+            sampling_rate (float): Sampling rate of the features [Hz]
+
+        Returns:
+            pd.DataFrame: One row per window with start sample, (optional) window start time,
+                model-unit coordinates, and latitude/longitude
+        """
+        if self.mode != "origin":
+            raise ValueError("predict_origins requires mode='origin'")
+        starts, xy = self.predict(features)
+        if len(starts) == 0:
+            xy = np.empty((0, 2))
+        lat, lon = self.graph.model_to_latlon(xy)
+        df = pd.DataFrame({"start_sample": starts, "x": xy[:, 0], "y": xy[:, 1],
+                           "latitude": lat, "longitude": lon})
+        if starttime is not None:
+            df.insert(1, "time", [starttime + s / sampling_rate for s in starts])
+        return df
@@ -0,0 +1,289 @@
+"""
+Vectorized synthetic graph generation and sharded, memory-mapped graph datasets
+for the GNN notebooks (`GNN_pred_origin_2d_annotated`, `GNN_node_regression_annotated`).
+
+Instead of building one `Data` object at a time (per-node `distance.euclidean`,
+per-graph `KNNGraph`, per-edge weights), `generate_graphs` builds thousands of
+graphs per call with batched array operations:
+- pairwise station distances for all graphs at once
+- travel times and delayed sine arrivals for all stations at once
+- kNN edges (loop=False, force_undirected=True, like `KNNGraph`) for all graphs at once
+
+`write_sharded_dataset` streams generated graphs to disk in shards of flat `.npy`
+arrays (CSR-style node and edge pointers), and `ShardedGraphDataset` reads them back
+through memory maps, so dataset size is limited by disk rather than RAM.
+"""
+import json
+import os
+
+import numpy as np
+import torch
+from torch_geometric.data import Batch, Data, Dataset
+
+
+def knn_edges(pos, n_nodes, k):
+    """
+    Build undirected kNN edges for a batch of padded graphs.
+
+    Equivalent to `KNNGraph(k=k, loop=False, force_undirected=True)` applied to each graph:
+    each node is connected to its k nearest neighbours, reverse edges are added,
+    and duplicates removed. Edges are sorted by (graph, source, target).
+
+    Args:
+        pos (np.ndarray): Node positions [nb_graph, max_nodes, dim], padded past `n_nodes`
+        n_nodes (np.ndarray): Number of valid nodes per graph [nb_graph]
+        k (int): Number of neighbours
+
+    Returns:
+        tuple: (graph, src, dst) arrays of graph index and local source/target node indices
+    """
+    nb_graph, max_nodes, _ = pos.shape
+    valid = np.arange(max_nodes)[None, :] < n_nodes[:, None]
+    # Batched pairwise distances [nb_graph, max_nodes, max_nodes]
+    diff = pos[:, :, None, :] - pos[:, None, :, :]
+    dist = np.sqrt((diff ** 2).sum(-1))
+    dist[~(valid[:, :, None] & valid[:, None, :])] = np.inf
+    dist[:, np.arange(max_nodes), np.arange(max_nodes)] = np.inf
+    kk = min(k, max_nodes - 1)
+    nbr = np.argpartition(dist, kk - 1, axis=-1)[..., :kk]
+    # Drop neighbours that fall on padding (graphs with fewer than k+1 nodes)
+    ok = np.take_along_axis(dist, nbr, axis=-1) < np.inf
+    adj = np.zeros((nb_graph, max_nodes, max_nodes), dtype=bool)
+    g_idx, i_idx, _ = np.nonzero(ok)
+    adj[g_idx, nbr[ok], i_idx] = True
+    adj |= adj.transpose(0, 2, 1)
+    return np.nonzero(adj)
+
+
+def generate_graphs(
+    nb_graph,
+    signal_size=20,
+    nb_nodes=(10, 15),
+    positions=None,
+    extent=6.0,
+    velocity=0.5,
+    sampling_rate=1.0,
+    noise_std=0.1,
+    k=5,
+    edge_features="weight",
+    integer_origin=True,
+    rng=None,
+):
+    """
+    Generate a batch of synthetic origin graphs with batched array operations.
+
+    Reproduces the synthesis in `SinOriginDataset` / `SinDataset`: noisy signals with a
+    sine wave starting at the travel time from a hidden origin to each station.
+
+    Args:
+        nb_graph (int): Number of graphs to generate
+        signal_size (int): Number of samples per node signal
+        nb_nodes (int or tuple): Nodes per graph, or a [low, high) range to sample from.
+            Ignored if `positions` is given.
+        positions (np.ndarray, optional): Fixed station positions [nb_stations, 2] shared by all graphs
+        extent (float): Stations and origins are sampled in [0, extent]^2
+        velocity (float): Wave speed (units per second)
+        sampling_rate (float): Sampling rate (Hz)
+        noise_std (float): Standard deviation of the Gaussian noise
+        k (int): Number of nearest neighbours for edge construction
+        edge_features (str): "weight" for 1 / (distance + 1) edge weights (origin notebook)
+            or "delta" for (dx, dy) edge attributes (node regression notebook)
+        integer_origin (bool): Sample integer origin coordinates, as the notebooks do
+        rng (np.random.Generator, optional): Random generator
+
+    Returns:
+        dict: Flat, CSR-style arrays:
+            - pos [total_nodes, 2], signal [total_nodes, signal_size], node_ptr [nb_graph + 1]
+            - edge_index [2, total_edges] (local node indices), edge_ptr [nb_graph + 1]
+            - edge_weight [total_edges] or edge_attr [total_edges, 2]
+            - origin [nb_graph, 2]
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+
+    # --- Station layout, padded to the largest graph ---
+    if positions is not None:
+        positions = np.asarray(positions, dtype=np.float32)
+        n_nodes = np.full(nb_graph, len(positions))
+        pos = np.broadcast_to(positions, (nb_graph,) + positions.shape).copy()
+    else:
+        if np.ndim(nb_nodes) == 0:
+            n_nodes = np.full(nb_graph, int(nb_nodes))
+        else:
+            n_nodes = rng.integers(nb_nodes[0], nb_nodes[1], size=nb_graph)
+        pos = rng.uniform(0, extent, size=(nb_graph, n_nodes.max(), 2)).astype(np.float32)
+    max_nodes = pos.shape[1]
+    valid = np.arange(max_nodes)[None, :] < n_nodes[:, None]
+
+    # --- Hidden origins and travel times ---
+    if integer_origin:
+        origin = rng.integers(0, int(extent), size=(nb_graph, 2)).astype(np.float32)
+    else:
+        origin = rng.uniform(0, extent, size=(nb_graph, 2)).astype(np.float32)
+    dist = np.sqrt(((pos - origin[:, None, :]) ** 2).sum(-1))
+    delay_samples = (dist / velocity * sampling_rate).astype(np.int64)
+
+    # --- Delayed sine arrivals on top of noise ---
+    lag = np.arange(signal_size)[None, None, :] - delay_samples[..., None]
+    signal = rng.normal(0, noise_std, size=(nb_graph, max_nodes, signal_size))
+    signal += np.where(lag >= 0, np.sin(np.maximum(lag, 0)), 0.0)
+
+    # --- kNN edges and edge features ---
+    e_graph, src, dst = knn_edges(pos, n_nodes, k)
+    out = {
+        "pos": pos[valid].astype(np.float32),
+        "signal": signal[valid].astype(np.float32),
+        "node_ptr": np.concatenate([[0], np.cumsum(n_nodes)]).astype(np.int64),
+        "edge_index": np.stack([src, dst]).astype(np.int32),
+        "edge_ptr": np.concatenate([[0], np.cumsum(np.bincount(e_graph, minlength=nb_graph))]).astype(np.int64),
+        "origin": origin,
+    }
+    delta = pos[e_graph, dst] - pos[e_graph, src]
+    if edge_features == "weight":
+        out["edge_weight"] = (1 / (np.sqrt((delta ** 2).sum(-1)) + 1)).astype(np.float32)
+    elif edge_features == "delta":
+        out["edge_attr"] = delta.astype(np.float32)
+    else:
+        raise ValueError(f"unknown edge_features '{edge_features}'")
+    return out
+
+
+def write_sharded_dataset(root, nb_graph, shard_size=10000, seed=None, **kwargs):
+    """
+    Generate a synthetic dataset and write it to disk as memory-mappable shards.
+
+    Each shard is a directory of `.npy` files (one per array returned by `generate_graphs`),
+    so only one shard needs to be held in memory while writing.
+
+    Args:
+        root (str): Output directory
+        nb_graph (int): Total number of graphs
+        shard_size (int): Graphs per shard
+        seed (int, optional): Seed for reproducible datasets
+        **kwargs: Passed to `generate_graphs`
+
+    Returns:
+        dict: Dataset metadata (also written to `root/meta.json`)
+    """
+    os.makedirs(root, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    if kwargs.get("positions") is not None:
+        kwargs["positions"] = np.asarray(kwargs["positions"], dtype=np.float32).tolist()
+    shards = []
+    for start in range(0, nb_graph, shard_size):
+        n = min(shard_size, nb_graph - start)
+        arrays = generate_graphs(n, rng=rng, **kwargs)
+        name = f"shard_{len(shards):05d}"
+        os.makedirs(os.path.join(root, name), exist_ok=True)
+        for key, value in arrays.items():
+            np.save(os.path.join(root, name, f"{key}.npy"), value)
+        shards.append({"name": name, "nb_graph": n})
+    meta = {"nb_graph": nb_graph, "shards": shards, "params": kwargs}
+    with open(os.path.join(root, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=1)
+    return meta
+
+
+class ShardedGraphDataset(Dataset):
+    """
+    PyG dataset streaming graphs from shards written by `write_sharded_dataset`.
+
+    Arrays are opened with `np.load(mmap_mode="r")`, so only the graphs being accessed
+    are read from disk. Works with `torch_geometric.loader.DataLoader` as a drop-in
+    replacement for the notebooks' `InMemoryDataset`s; `iter_batches` additionally
+    collates whole batches with array slicing instead of per-graph `Data` objects.
+
+    Args:
+        root (str): Dataset directory
+        target (str): Attribute name for the origin: "y" (shape [1, 2], origin notebook)
+            or "origin" (shape [2], node regression notebook)
+        transform (callable, optional): Transform applied to each graph on access
+    """
+    def __init__(self, root, target="y", transform=None):
+        self.target = target
+        with open(os.path.join(root, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.shards = []
+        for shard in self.meta["shards"]:
+            path = os.path.join(root, shard["name"])
+            self.shards.append({
+                key[:-4]: np.load(os.path.join(path, key), mmap_mode="r")
+                for key in os.listdir(path) if key.endswith(".npy")
+            })
+        self.offsets = np.concatenate([[0], np.cumsum([s["nb_graph"] for s in self.meta["shards"]])])
+        super().__init__(None, transform)
+
+    def len(self):
+        return int(self.offsets[-1])
+
+    def _locate(self, idx):
+        shard = int(np.searchsorted(self.offsets, idx, side="right") - 1)
+        return self.shards[shard], idx - int(self.offsets[shard])
+
+    def _edge_key(self, arrays):
+        return "edge_weight" if "edge_weight" in arrays else "edge_attr"
+
+    def get(self, idx):
+        arrays, i = self._locate(idx)
+        n0, n1 = arrays["node_ptr"][i], arrays["node_ptr"][i + 1]
+        e0, e1 = arrays["edge_ptr"][i], arrays["edge_ptr"][i + 1]
+        ekey = self._edge_key(arrays)
+        origin = torch.from_numpy(np.array(arrays["origin"][i]))
+        data = Data(
+            pos=torch.from_numpy(np.array(arrays["pos"][n0:n1])),
+            signal=torch.from_numpy(np.array(arrays["signal"][n0:n1])),
+            edge_index=torch.from_numpy(np.array(arrays["edge_index"][:, e0:e1], dtype=np.int64)),
+        )
+        data[ekey] = torch.from_numpy(np.array(arrays[ekey][e0:e1]))
+        data[self.target] = origin.unsqueeze(0) if self.target == "y" else origin
+        return data
+
+    def iter_batches(self, batch_size=64, shuffle=False, seed=None):
+        """
+        Yield collated batches, gathered per shard with vectorized slicing.
+
+        Batches never span shards, so each batch only touches one set of memory maps.
+        With `shuffle`, shard order and graph order within each shard are randomized.
+
+        Args:
+            batch_size (int): Graphs per batch
+            shuffle (bool): Shuffle shards and graphs
+            seed (int, optional): Seed for shuffling
+
+        Yields:
+            Batch: Batched graphs with `pos`, `signal`, `edge_index`, edge features,
+                the target, and `batch`/`ptr` vectors, as produced by PyG's `DataLoader`
+        """
+        rng = np.random.default_rng(seed)
+        order = rng.permutation(len(self.shards)) if shuffle else np.arange(len(self.shards))
+        for s in order:
+            arrays = self.shards[s]
+            n_graph = len(arrays["origin"])
+            idx_all = rng.permutation(n_graph) if shuffle else np.arange(n_graph)
+            for b in range(0, n_graph, batch_size):
+                yield self._collate(arrays, np.sort(idx_all[b:b + batch_size]))
+
+    def _collate(self, arrays, idx):
+        node_ptr, edge_ptr = arrays["node_ptr"], arrays["edge_ptr"]
+        n_counts = node_ptr[idx + 1] - node_ptr[idx]
+        e_counts = edge_ptr[idx + 1] - edge_ptr[idx]
+        # Flat indices of every node / edge of the selected graphs
+        node_idx = np.repeat(node_ptr[idx] - np.cumsum(n_counts) + n_counts, n_counts) + np.arange(n_counts.sum())
+        edge_idx = np.repeat(edge_ptr[idx] - np.cumsum(e_counts) + e_counts, e_counts) + np.arange(e_counts.sum())
+        ptr = np.concatenate([[0], np.cumsum(n_counts)])
+        # Shift local edge indices by each graph's node offset within the batch
+        edge_index = np.asarray(arrays["edge_index"][:, edge_idx], dtype=np.int64)
+        edge_index += np.repeat(ptr[:-1], e_counts)[None, :]
+        ekey = self._edge_key(arrays)
+        origin = torch.from_numpy(np.asarray(arrays["origin"][idx]))
+        batch = Batch(
+            pos=torch.from_numpy(np.asarray(arrays["pos"][node_idx])),
+            signal=torch.from_numpy(np.asarray(arrays["signal"][node_idx])),
+            edge_index=torch.from_numpy(edge_index),
+            batch=torch.from_numpy(np.repeat(np.arange(len(idx)), n_counts)),
+            ptr=torch.from_numpy(ptr),
+        )
+        batch[ekey] = torch.from_numpy(np.asarray(arrays[ekey][edge_idx]))
+        # Match PyG collation: "y" graphs stack to [batch, 2], "origin" graphs concatenate to [2 * batch]
+        batch[self.target] = origin if self.target == "y" else origin.reshape(-1)
+        return batch
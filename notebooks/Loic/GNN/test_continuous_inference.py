@@ -0,0 +1,57 @@
+"""
+Tests for `continuous_inference`: incremental `update` calls must give the same
+windows and outputs as one `predict` over all samples.
+"""
+import numpy as np
+import pytest
+import torch
+
+from continuous_inference import SlidingWindowPredictor, StationGraph
+
+
+class WindowSum(torch.nn.Module):
+    """Stand-in origin model: per-window sum and first sample of the signal."""
+    def forward(self, pos, signal, edge_index, edge_weight, batch):
+        nb = int(batch.max()) + 1
+        total = torch.zeros(nb).index_add_(0, batch, signal.sum(dim=1))
+        first = torch.zeros(nb).index_add_(0, batch, signal[:, 0])
+        return torch.stack([total, first], dim=1)
+
+
+@pytest.fixture
+def graph():
+    rng = np.random.default_rng(0)
+    return StationGraph(46 + rng.random(8), -122 + rng.random(8), k=3)
+
+
+@pytest.mark.parametrize("window, step", [(3, 1), (3, 2), (3, 3), (3, 5), (4, 9)])
+def test_update_matches_predict(graph, window, step):
+    rng = np.random.default_rng(1)
+    features = rng.random((graph.num_nodes, 40)).astype(np.float32)
+    model = WindowSum()
+    starts, out = SlidingWindowPredictor(model, graph, window, step=step, batch_size=4).predict(features)
+
+    predictor = SlidingWindowPredictor(model, graph, window, step=step, batch_size=4)
+    chunks = [predictor.update(chunk) for chunk in np.array_split(features, 5, axis=1)]
+    chunk_starts = np.concatenate([s for s, _ in chunks])
+    chunk_out = np.concatenate([o for s, o in chunks if len(s)])
+    np.testing.assert_array_equal(chunk_starts, starts)
+    np.testing.assert_allclose(chunk_out, out, rtol=1e-6)
+
+
+def test_update_single_samples(graph):
+    features = np.random.default_rng(2).random((graph.num_nodes, 30)).astype(np.float32)
+    predictor = SlidingWindowPredictor(WindowSum(), graph, 3, step=7)
+    chunk_starts = np.concatenate([predictor.update(features[:, i:i + 1])[0] for i in range(30)])
+    np.testing.assert_array_equal(chunk_starts, np.arange(0, 28, 7))
+
+
+def test_batch_slices_single_cached_batch(graph):
+    for nb in [5, 2, 7, 1]:
+        g = graph.batch(nb)
+        expected = StationGraph(graph.latitude, graph.longitude, k=3).batch(nb)
+        for key in expected:
+            torch.testing.assert_close(g[key], expected[key], rtol=0, atol=0)
+        assert int(g["batch"].max()) == nb - 1
+    # Only the largest batch requested so far is kept
+    assert len(graph._batch["pos"]) == 7 * graph.num_nodes
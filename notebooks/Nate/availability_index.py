@@ -0,0 +1,245 @@
+"""
+:module: availability_index.py
+:org: Pacific Northwest Seismic Network
+:license: GPLv3
+:purpose: A sorted-array interval index over data availability segments (e.g., the output
+    of `ws_client.AvailabilityClient.availability_request`) for fast coverage queries,
+    overlap queries, and planning of merged, de-duplicated `get_waveforms_bulk` requests.
+
+    Segments are grouped by NSLC and stored as sorted numpy arrays, so every query
+    is a handful of `numpy.searchsorted` calls per NSLC (O(log n) per window) rather
+    than boolean filtering and `iterrows()` over the whole availability table.
+"""
+import fnmatch
+
+import numpy as np
+import pandas as pd
+from obspy import UTCDateTime
+
+
+def _to_seconds(times):
+    """Convert time-likes (UTCDateTime, pandas.Timestamp, datetime64, str, float) to
+    an array of epoch seconds
+
+    :param times: one or more times
+    :type times: time-like or list-like of time-likes
+    :return: epoch seconds
+    :rtype: numpy.ndarray
+    """
+    scalar = np.ndim(times) == 0 and not isinstance(times, (list, tuple))
+    if scalar:
+        times = [times]
+    # Vectorized paths for numeric and datetime64 arrays/Series
+    if not isinstance(times, (list, tuple)):
+        kind = np.asarray(times).dtype.kind
+        if kind in 'iuf':
+            return np.asarray(times, dtype=np.float64)
+        if kind == 'M' or isinstance(getattr(times, 'dtype', None), pd.DatetimeTZDtype):
+            times = pd.to_datetime(pd.Series(times), utc=True)
+            return ((times - pd.Timestamp(0, tz='UTC')) / pd.Timedelta(seconds=1)).values
+    out = np.empty(len(times), dtype=np.float64)
+    for _e, _t in enumerate(times):
+        if isinstance(_t, UTCDateTime):
+            out[_e] = _t.timestamp
+        elif isinstance(_t, (int, float, np.integer, np.floating)):
+            out[_e] = float(_t)
+        else:
+            _t = pd.Timestamp(_t)
+            if _t.tzinfo is None:
+                _t = _t.tz_localize('UTC')
+            out[_e] = (_t - pd.Timestamp(0, tz='UTC')) / pd.Timedelta(seconds=1)
+    return out
+
+
+def _merge_intervals(starts, ends, gap=0.):
+    """Merge overlapping (or nearly touching) intervals
+
+    :param starts: interval starts
+    :type starts: numpy.ndarray
+    :param ends: interval ends
+    :type ends: numpy.ndarray
+    :param gap: merge intervals separated by up to this many seconds, defaults to 0.
+    :type gap: float, optional
+    :return: sorted, non-overlapping interval starts and ends
+    :rtype: tuple of numpy.ndarray
+    """
+    if len(starts) == 0:
+        return starts, ends
+    order = np.argsort(starts, kind='stable')
+    starts = starts[order]
+    ends = ends[order]
+    run_end = np.maximum.accumulate(ends)
+    # A new interval starts wherever the start is beyond everything seen so far
+    new = np.ones(len(starts), dtype=bool)
+    new[1:] = starts[1:] > run_end[:-1] + gap
+    first = np.flatnonzero(new)
+    last = np.append(first[1:], len(starts)) - 1
+    return starts[first], run_end[last]
+
+
+def _intersect(a_start, a_end, w_start, w_end):
+    """Intersect sorted, non-overlapping intervals `a` with sorted, non-overlapping
+    windows `w`
+
+    :return: starts and ends of the intersections
+    :rtype: tuple of numpy.ndarray
+    """
+    i0 = np.searchsorted(a_end, w_start, side='right')
+    i1 = np.searchsorted(a_start, w_end, side='left')
+    counts = np.maximum(i1 - i0, 0)
+    if counts.sum() == 0:
+        return np.empty(0), np.empty(0)
+    wi = np.repeat(np.arange(len(w_start)), counts)
+    # Index of each overlapping interval: i0 of its window plus its rank within the window
+    ai = i0[wi] + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.maximum(a_start[ai], w_start[wi]), np.minimum(a_end[ai], w_end[wi])
+
+
+class AvailabilityIndex(object):
+    """
+    An interval index over data availability segments
+
+    :param df: availability table with columns Network, Station, Location, Channel,
+        Earliest and Latest, as returned by `AvailabilityClient.availability_request`
+        (or read back from its CSV output)
+    :type df: pandas.DataFrame
+    """
+    NSLC_COLUMNS = ['Network', 'Station', 'Location', 'Channel']
+
+    def __init__(self, df):
+        """Initialize an AvailabilityIndex object
+
+        :param df: availability table with columns Network, Station, Location, Channel,
+            Earliest and Latest
+        :type df: pandas.DataFrame
+        """
+        df = df.copy()
+        for _c in self.NSLC_COLUMNS:
+            df[_c] = df[_c].fillna('').astype(str)
+        df = df.assign(_t0=_to_seconds(df.Earliest), _t1=_to_seconds(df.Latest))
+        df = df.sort_values(self.NSLC_COLUMNS + ['_t0']).reset_index(drop=True)
+        self.segments = df
+        self._raw = {}
+        self._merged = {}
+        for _k, _df in df.groupby(self.NSLC_COLUMNS, sort=True):
+            t0 = _df._t0.values
+            t1 = _df._t1.values
+            # Raw segments sorted by start with the running maximum end for overlap queries
+            self._raw[_k] = (t0, t1, np.maximum.accumulate(t1), _df.index.values)
+            # Merged coverage with the cumulative covered duration for coverage queries
+            m0, m1 = _merge_intervals(t0, t1)
+            cum = np.concatenate([[0.], np.cumsum(m1 - m0)])
+            self._merged[_k] = (m0, m1, cum)
+
+    def __repr__(self):
+        """String representation of this AvailabilityIndex object's contents"""
+        rstr = f'{self.__class__.__name__}\n'
+        rstr += f'{len(self.segments):d} segment(s) across {len(self._raw):d} NSLC(s)'
+        return rstr
+
+    @property
+    def nslcs(self):
+        """Indexed (network, station, location, channel) tuples"""
+        return list(self._raw.keys())
+
+    def select(self, network='*', station='*', location='*', channel='*'):
+        """Get indexed NSLC tuples matching (comma-delimited) wildcard patterns
+
+        :return: matching NSLC tuples
+        :rtype: list of tuple
+        """
+        pats = [str(_p).split(',') for _p in [network, station, location, channel]]
+        pats[2] = ['' if _p == '--' else _p for _p in pats[2]]
+        out = []
+        for _k in self._raw.keys():
+            if all(any(fnmatch.fnmatchcase(_c, _p) for _p in _ps) for _c, _ps in zip(_k, pats)):
+                out.append(_k)
+        return out
+
+    def _covered(self, key, times):
+        """Total covered duration before each time for one NSLC"""
+        m0, m1, cum = self._merged[key]
+        i = np.searchsorted(m0, times, side='right') - 1
+        _i = np.maximum(i, 0)
+        partial = np.clip(times - m0[_i], 0., m1[_i] - m0[_i])
+        return np.where(i >= 0, cum[_i] + partial, 0.)
+
+    def coverage(self, starttime, endtime, network='*', station='*', location='*', channel='*'):
+        """Fraction of each window [starttime, endtime] covered by available data
+
+        :param starttime: window start(s)
+        :type starttime: time-like or list-like of time-likes
+        :param endtime: window end(s)
+        :type endtime: time-like or list-like of time-likes
+        :return: coverage fractions with one row per window and one column per NSLC
+        :rtype: pandas.DataFrame
+        """
+        t0 = _to_seconds(starttime)
+        t1 = _to_seconds(endtime)
+        dt = t1 - t0
+        out = {}
+        for _k in self.select(network, station, location, channel):
+            covered = self._covered(_k, t1) - self._covered(_k, t0)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                out['.'.join(_k)] = np.where(dt > 0, covered / dt, 0.)
+        return pd.DataFrame(out)
+
+    def overlapping(self, starttime, endtime, network='*', station='*', location='*', channel='*'):
+        """Get the availability segments that overlap each window
+
+        :param starttime: window start(s)
+        :type starttime: time-like or list-like of time-likes
+        :param endtime: window end(s)
+        :type endtime: time-like or list-like of time-likes
+        :return: overlapping rows of the availability table with a 'window' column
+            holding the position of the window each row overlaps
+        :rtype: pandas.DataFrame
+        """
+        t0 = _to_seconds(starttime)
+        t1 = _to_seconds(endtime)
+        wins, rows = [], []
+        for _k in self.select(network, station, location, channel):
+            s0, s1, run_end, idx = self._raw[_k]
+            # Candidates start before the window ends and follow the first segment whose
+            # running maximum end passes the window start
+            lo = np.searchsorted(run_end, t0, side='right')
+            hi = np.searchsorted(s0, t1, side='left')
+            for _w in np.flatnonzero(hi > lo):
+                _r = np.arange(lo[_w], hi[_w])
+                _r = _r[s1[_r] > t0[_w]]
+                wins.append(np.full(len(_r), _w))
+                rows.append(idx[_r])
+        if len(rows) == 0:
+            return self.segments.iloc[:0].drop(columns=['_t0', '_t1']).assign(window=[])
+        out = self.segments.loc[np.concatenate(rows)].drop(columns=['_t0', '_t1'])
+        out = out.assign(window=np.concatenate(wins))
+        return out.sort_values(['window'] + self.NSLC_COLUMNS, kind='stable')
+
+    def bulk_request(self, starttime, endtime, network='*', station='*', location='*',
+                     channel='*', merge_gap=0., min_length=0.):
+        """Compose a merged, de-duplicated `get_waveforms_bulk` request for a set of
+        windows, clipped to available data so no request line spans a data gap
+
+        Overlapping windows (e.g., event windows close in time) are merged per NSLC
+        before clipping, so each sample is requested at most once.
+
+        :param starttime: window start(s)
+        :type starttime: time-like or list-like of time-likes
+        :param endtime: window end(s)
+        :type endtime: time-like or list-like of time-likes
+        :param merge_gap: merge windows separated by up to this many seconds, defaults to 0.
+        :type merge_gap: float, optional
+        :param min_length: drop request lines shorter than this many seconds, defaults to 0.
+        :type min_length: float, optional
+        :return: bulk request lines (net, sta, loc, cha, starttime, endtime)
+        :rtype: list of tuple
+        """
+        w0, w1 = _merge_intervals(_to_seconds(starttime), _to_seconds(endtime), gap=merge_gap)
+        bulk = []
+        for _k in self.select(network, station, location, channel):
+            m0, m1, _ = self._merged[_k]
+            b0, b1 = _intersect(m0, m1, w0, w1)
+            for _t0, _t1 in zip(b0, b1):
+                if _t1 - _t0 > min_length:
+                    bulk.append(_k + (UTCDateTime(_t0), UTCDateTime(_t1)))
+        return bulk
@@ -0,0 +1,339 @@
+"""
+:module: catalog_match.py
+:org: Pacific Northwest Seismic Network
+:license: GPLv3
+:purpose: One-to-one cross-matching of earthquake catalogs (e.g., NCEDC `ncedc.eqs`
+    exports, HypoDD `hypoDD.loc`/`hypoDD.reloc` outputs, and ObsPlus EventBank
+    indices) within origin-time and hypocentral-distance tolerances, reporting
+    matched, missed, and new events with origin time, location, and magnitude deltas.
+
+    Catalogs are first reduced to a common table (event_id, time [epoch s], latitude,
+    longitude, depth [km], magnitude). Hypocenters are placed in Earth-centered
+    Cartesian coordinates [km] and origin times are scaled into a fourth coordinate
+    (`max_dist / max_dt` km per second), so a single KD-tree query returns every
+    candidate pair close in both time and space without any row-wise comparison.
+    Candidates are then resolved one-to-one, closest pair first, so each event in
+    either catalog is matched at most once.
+"""
+import logging
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+logger = logging.getLogger('catalog_match')
+
+EARTH_RADIUS_KM = 6371.
+COLUMNS = ['event_id', 'time', 'latitude', 'longitude', 'depth', 'magnitude']
+HYPODD_LOC_COLUMNS = ['ID', 'LAT', 'LON', 'DEPTH', 'X', 'Y', 'Z', 'EX', 'EY', 'EZ',
+                      'YR', 'MO', 'DY', 'HR', 'MI', 'SC', 'MAG', 'CID']
+HYPODD_RELOC_COLUMNS = ['ID', 'LAT', 'LON', 'DEPTH', 'X', 'Y', 'Z', 'EX', 'EY', 'EZ',
+                        'YR', 'MO', 'DY', 'HR', 'MI', 'SC', 'MAG', 'NCCP', 'NCCS',
+                        'NCTP', 'NCTS', 'RCC', 'RCT', 'CID']
+NCEDC_COLUMNS = ['Date', 'Time', 'Lat', 'Lon', 'Depth', 'Mag', 'Magt', 'Nst', 'Gap',
+                 'Clo', 'RMS', 'SRC', 'Event ID']
+
+
+def _to_epoch(times):
+    """Convert datetime-like values (naive values are taken as UTC) to epoch seconds"""
+    times = pd.to_datetime(pd.Series(times), utc=True)
+    return ((times - pd.Timestamp(0, tz='UTC'))/pd.Timedelta(seconds=1)).values
+
+
+def read_ncedc_eqs(path):
+    """Read an NCEDC catalog search result in `ncread` format (e.g., `Amanda/ncedc.eqs`)
+
+    :param path: path to the catalog file
+    :type path: str
+    :return: standardized catalog table
+    :rtype: pandas.DataFrame
+    """
+    # Skip the search-parameter preamble and column header, ending with a dashed line
+    with open(path, 'r') as _f:
+        for skiprows, line in enumerate(_f, start=1):
+            if line.startswith('---'):
+                break
+        else:
+            skiprows = 0
+    df = pd.read_csv(path, sep=r'\s+', skiprows=skiprows, names=NCEDC_COLUMNS,
+                     dtype={'Event ID': str})
+    times = pd.to_datetime(df.Date + ' ' + df.Time, format='%Y/%m/%d %H:%M:%S.%f', utc=True)
+    return pd.DataFrame({'event_id': df['Event ID'].values,
+                         'time': _to_epoch(times),
+                         'latitude': df.Lat.values.astype(float),
+                         'longitude': df.Lon.values.astype(float),
+                         'depth': df.Depth.values.astype(float),
+                         'magnitude': df.Mag.values.astype(float)})
+
+
+def read_hypodd(path):
+    """Read a HypoDD initial (`hypoDD.loc`) or relocated (`hypoDD.reloc`) catalog
+
+    :param path: path to the HypoDD output file
+    :type path: str
+    :return: standardized catalog table, event IDs are HypoDD event IDs
+    :rtype: pandas.DataFrame
+    """
+    df = pd.read_csv(path, sep=r'\s+', header=None)
+    if df.shape[1] == len(HYPODD_RELOC_COLUMNS):
+        df.columns = HYPODD_RELOC_COLUMNS
+    elif df.shape[1] == len(HYPODD_LOC_COLUMNS):
+        df.columns = HYPODD_LOC_COLUMNS
+    else:
+        raise ValueError(f'{path} has {df.shape[1]} columns, expected '
+                         f'{len(HYPODD_LOC_COLUMNS)} (.loc) or {len(HYPODD_RELOC_COLUMNS)} (.reloc)')
+    # Seconds are added as an offset since HypoDD can write SC = 60.00
+    times = pd.to_datetime(pd.DataFrame({'year': df.YR, 'month': df.MO, 'day': df.DY,
+                                         'hour': df.HR, 'minute': df.MI}), utc=True)
+    times += pd.to_timedelta(df.SC, unit='s')
+    return pd.DataFrame({'event_id': df.ID.astype(str).values,
+                         'time': _to_epoch(times),
+                         'latitude': df.LAT.values.astype(float),
+                         'longitude': df.LON.values.astype(float),
+                         'depth': df.DEPTH.values.astype(float),
+                         'magnitude': df.MAG.values.astype(float)})
+
+
+def from_obsplus(df):
+    """Standardize an ObsPlus event table, i.e., `obsplus.EventBank.read_index()`
+    or `Catalog.to_df()` output (datetime `time`, depth in meters)
+
+    :param df: ObsPlus event table
+    :type df: pandas.DataFrame
+    :return: standardized catalog table
+    :rtype: pandas.DataFrame
+    """
+    magnitude = df.magnitude.values if 'magnitude' in df.columns else np.nan
+    return pd.DataFrame({'event_id': df.event_id.astype(str).values,
+                         'time': _to_epoch(df.time),
+                         'latitude': df.latitude.values.astype(float),
+                         'longitude': df.longitude.values.astype(float),
+                         'depth': df.depth.values.astype(float)/1e3,
+                         'magnitude': np.asarray(magnitude, dtype=float)})
+
+
+def read_eventbank(bank, **kwargs):
+    """Read the index of an ObsPlus EventBank into a standardized catalog table
+
+    :param bank: event bank to read
+    :type bank: obsplus.EventBank
+    :param kwargs: query parameters passed to `bank.read_index` (e.g., starttime, endtime)
+    :return: standardized catalog table
+    :rtype: pandas.DataFrame
+    """
+    return from_obsplus(bank.read_index(**kwargs))
+
+
+def _haversine(lat1, lon1, lat2, lon2):
+    """Great-circle distance [km] between coordinate arrays [deg]"""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1)/2)**2 + np.cos(lat1)*np.cos(lat2)*np.sin((lon2 - lon1)/2)**2
+    return 2*EARTH_RADIUS_KM*np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def _one_to_one(i, j, dist, n_i, n_j):
+    """Resolve candidate pairs into a one-to-one matching, closest pair first
+
+    Equivalent to walking the pairs in order of increasing distance and keeping each
+    pair whose events are both still unmatched, but done in a few vectorized rounds:
+    every round keeps all pairs that are each other's closest remaining candidate.
+
+    :return: indices of the kept pairs
+    :rtype: numpy.ndarray
+    """
+    # Sort by distance, ties broken by index so the result is deterministic
+    order = np.lexsort((j, i, dist))
+    keep = []
+    used_i = np.zeros(n_i, dtype=bool)
+    used_j = np.zeros(n_j, dtype=bool)
+    while len(order) > 0:
+        # Pairs are distance-sorted, so the first pair per event is its closest candidate
+        _, first_i = np.unique(i[order], return_index=True)
+        _, first_j = np.unique(j[order], return_index=True)
+        mutual = np.intersect1d(first_i, first_j, assume_unique=True)
+        kept = order[mutual]
+        keep.append(kept)
+        used_i[i[kept]] = True
+        used_j[j[kept]] = True
+        order = order[~(used_i[i[order]] | used_j[j[order]])]
+    if len(keep) == 0:
+        return np.empty(0, dtype=np.int64)
+    return np.concatenate(keep)
+
+
+class CatalogMatch(object):
+    """Result of a one-to-one catalog cross-match
+
+    :param matched: matched event pairs, reference columns suffixed by the reference
+        name and other catalog columns by the other name, with origin time (dt [s]),
+        east/north/epicentral/depth (dx, dy, dh, dz [km]), hypocentral (dist [km]),
+        and magnitude (dmag) deltas taken as other minus reference
+    :type matched: pandas.DataFrame
+    :param missed: reference events without a match in the other catalog
+    :type missed: pandas.DataFrame
+    :param new: other catalog events without a match in the reference catalog
+    :type new: pandas.DataFrame
+    :param names: reference & other catalog names
+    :type names: tuple of str
+    """
+    def __init__(self, matched, missed, new, names):
+        self.matched = matched
+        self.missed = missed
+        self.new = new
+        self.names = names
+
+    def __repr__(self):
+        ref, other = self.names
+        rstr = f'{self.__class__.__name__} ({ref} vs {other}: '
+        rstr += f'{len(self.matched):d} matched, {len(self.missed):d} missed, '
+        rstr += f'{len(self.new):d} new)'
+        return rstr
+
+    def summary(self):
+        """Summarize the match counts and delta statistics
+
+        :return: one row per delta (dt, dx, dy, dh, dz, dist, dmag) with count, mean,
+            median, standard deviation, and maximum absolute value
+        :rtype: pandas.DataFrame
+        """
+        deltas = self.matched[['dt', 'dx', 'dy', 'dh', 'dz', 'dist', 'dmag']]
+        df = pd.DataFrame({'count': deltas.count(),
+                           'mean': deltas.mean(),
+                           'median': deltas.median(),
+                           'std': deltas.std(),
+                           'max_abs': deltas.abs().max()})
+        return df
+
+
+class CatalogMatcher(object):
+    """Index a reference catalog by origin time and hypocenter and match other
+    catalogs against it one-to-one
+
+    :param reference: standardized reference catalog table (see `read_ncedc_eqs`,
+        `read_hypodd`, `read_eventbank`)
+    :type reference: pandas.DataFrame
+    :param max_dt: maximum origin time difference [s], defaults to 5.
+    :type max_dt: float, optional
+    :param max_dist: maximum hypocentral distance [km], defaults to 15.
+    :type max_dist: float, optional
+    :param use_depth: include depth in distances, defaults to True
+        If False (or where a depth is missing) events are placed at the surface
+    :type use_depth: bool, optional
+    :param name: reference catalog name used in match results, defaults to 'ref'
+    :type name: str, optional
+    """
+    def __init__(self, reference, max_dt=5., max_dist=15., use_depth=True, name='ref'):
+        if max_dt <= 0 or max_dist <= 0:
+            raise ValueError('max_dt and max_dist must be positive')
+        self.max_dt = float(max_dt)
+        self.max_dist = float(max_dist)
+        self.use_depth = use_depth
+        self.name = name
+        self.reference = reference[COLUMNS].reset_index(drop=True)
+        # Origin times are scaled so that max_dt spans as much as max_dist
+        self.velocity = self.max_dist/self.max_dt
+        self.t0 = self.reference.time.min() if len(self.reference) > 0 else 0.
+        self.tree = cKDTree(self._coordinates(self.reference))
+
+    def __repr__(self):
+        rstr = f'{self.__class__.__name__} ({self.name}: {len(self.reference):d} events, '
+        rstr += f'max_dt {self.max_dt:.1f} s, max_dist {self.max_dist:.1f} km)'
+        return rstr
+
+    def _xyz(self, df):
+        """Earth-centered Cartesian hypocenter coordinates [km]"""
+        depth = df.depth.values if self.use_depth else np.zeros(len(df))
+        radius = EARTH_RADIUS_KM - np.nan_to_num(depth)
+        lat = np.radians(df.latitude.values)
+        lon = np.radians(df.longitude.values)
+        return np.stack([radius*np.cos(lat)*np.cos(lon),
+                         radius*np.cos(lat)*np.sin(lon),
+                         radius*np.sin(lat)], axis=1)
+
+    def _coordinates(self, df):
+        """Space-time tree coordinates: hypocenter [km] and scaled origin time [km]"""
+        t = (df.time.values - self.t0)*self.velocity
+        return np.column_stack([self._xyz(df), t])
+
+    def _candidates(self, other, chunk):
+        """Pairs of (reference, other) rows within tolerance, with their space-time distance"""
+        ii, jj, dd = [], [], []
+        # A pair within both tolerances is at most sqrt(2) * max_dist apart in space-time
+        radius = np.sqrt(2)*self.max_dist
+        xyz_ref = self._xyz(self.reference)
+        for _s in range(0, len(other), chunk):
+            _other = other.iloc[_s:_s + chunk]
+            _tree = cKDTree(self._coordinates(_other))
+            pairs = self.tree.sparse_distance_matrix(_tree, radius, output_type='ndarray')
+            if len(pairs) == 0:
+                continue
+            i, j = pairs['i'], pairs['j']
+            dt = _other.time.values[j] - self.reference.time.values[i]
+            dist = np.linalg.norm(self._xyz(_other)[j] - xyz_ref[i], axis=1)
+            ok = (np.abs(dt) <= self.max_dt) & (dist <= self.max_dist)
+            ii.append(i[ok])
+            jj.append(j[ok] + _s)
+            dd.append(pairs['v'][ok])
+        if len(ii) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+        return np.concatenate(ii), np.concatenate(jj), np.concatenate(dd)
+
+    def match(self, other, name='other', chunk=500000):
+        """Match another catalog against the reference catalog one-to-one
+
+        :param other: standardized catalog table
+        :type other: pandas.DataFrame
+        :param name: other catalog name used in match results, defaults to 'other'
+        :type name: str, optional
+        :param chunk: number of other catalog events queried at once, bounding
+            memory use for very large catalogs, defaults to 500000
+        :type chunk: int, optional
+        :return: matched, missed, and new events
+        :rtype: catalog_match.CatalogMatch
+        """
+        if name == self.name:
+            raise ValueError(f'catalog names must differ, both are "{name}"')
+        other = other[COLUMNS].reset_index(drop=True)
+        i, j, dist = self._candidates(other, chunk)
+        kept = _one_to_one(i, j, dist, len(self.reference), len(other))
+        i, j = i[kept], j[kept]
+        order = np.argsort(i, kind='stable')
+        i, j = i[order], j[order]
+        logger.info(f'{len(i)} matches from {len(kept)} of {len(dist)} candidate pairs')
+
+        ref = self.reference.iloc[i].reset_index(drop=True)
+        oth = other.iloc[j].reset_index(drop=True)
+        matched = pd.concat([ref.add_suffix(f'_{self.name}'), oth.add_suffix(f'_{name}')], axis=1)
+        coslat = np.cos(np.radians(ref.latitude.values))
+        matched['dt'] = oth.time.values - ref.time.values
+        matched['dx'] = (oth.longitude.values - ref.longitude.values)*coslat*np.pi/180*EARTH_RADIUS_KM
+        matched['dy'] = (oth.latitude.values - ref.latitude.values)*np.pi/180*EARTH_RADIUS_KM
+        matched['dh'] = _haversine(ref.latitude.values, ref.longitude.values,
+                                   oth.latitude.values, oth.longitude.values)
+        matched['dz'] = oth.depth.values - ref.depth.values
+        matched['dist'] = np.hypot(matched.dh.values, np.nan_to_num(matched.dz.values))
+        matched['dmag'] = oth.magnitude.values - ref.magnitude.values
+
+        is_matched = np.zeros(len(self.reference), dtype=bool)
+        is_matched[i] = True
+        missed = self.reference[~is_matched].reset_index(drop=True)
+        is_matched = np.zeros(len(other), dtype=bool)
+        is_matched[j] = True
+        new = other[~is_matched].reset_index(drop=True)
+        return CatalogMatch(matched, missed, new, (self.name, name))
+
+
+def match_catalogs(reference, other, names=('ref', 'other'), **kwargs):
+    """Match two standardized catalog tables one-to-one
+
+    :param reference: standardized reference catalog table
+    :type reference: pandas.DataFrame
+    :param other: standardized catalog table to match against the reference
+    :type other: pandas.DataFrame
+    :param names: reference & other catalog names, defaults to ('ref', 'other')
+    :type names: tuple of str, optional
+    :param kwargs: passed to `CatalogMatcher` (max_dt, max_dist, use_depth)
+    :return: matched, missed, and new events
+    :rtype: catalog_match.CatalogMatch
+    """
+    return CatalogMatcher(reference, name=names[0], **kwargs).match(other, name=names[1])
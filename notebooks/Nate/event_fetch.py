@@ -0,0 +1,343 @@
+"""
+:module: event_fetch.py
+:org: Pacific Northwest Seismic Network
+:license: GPLv3
+:purpose: Resolve pick waveform IDs against a persistent channel index and fetch
+    event-window waveforms and station metadata with one bulk request per event,
+    caching the results on disk keyed by event ID.
+
+    This replaces the per-pick band/instrument guessing in `new_event_check.ipynb`
+    (up to four `get_waveforms` calls plus a `get_stations` call per pick) with
+    one `get_stations_bulk` call to build the index and one `get_waveforms_bulk`
+    + `get_stations_bulk` pair per event.
+"""
+import logging
+import re
+from pathlib import Path
+
+import pandas as pd
+from obspy import UTCDateTime, Stream, Inventory, read, read_inventory
+from obspy.clients.fdsn.header import FDSNNoDataException
+
+logger = logging.getLogger('event_fetch')
+
+
+class ChannelIndex(object):
+    """A network/station/location/channel (NSLC) availability index built from
+    FDSN station metadata and persisted to a CSV file so that pick waveform IDs
+    can be resolved to full NSLC codes without querying a webservice per pick.
+
+    :param client: FDSN client used to populate the index
+    :type client: obspy.clients.fdsn.Client
+    :param cache_file: path to the CSV file used to persist the index, defaults to None
+        If None, the index only lives in memory
+    :type cache_file: str or pathlib.Path, optional
+    :param band_priority: band codes to try, highest priority first, defaults to 'HE'
+    :type band_priority: str, optional
+    :param instrument_priority: instrument codes to try, highest priority first, defaults to 'HN'
+    :type instrument_priority: str, optional
+    """
+    COLUMNS = ['network', 'station', 'location', 'channel',
+               'starttime', 'endtime', 'sampling_rate']
+
+    def __init__(self, client, cache_file=None, band_priority='HE', instrument_priority='HN'):
+        """Initialize a ChannelIndex object, loading the cached index if present
+
+        :param client: FDSN client used to populate the index
+        :type client: obspy.clients.fdsn.Client
+        :param cache_file: path to the CSV file used to persist the index, defaults to None
+        :type cache_file: str or pathlib.Path, optional
+        :param band_priority: band codes to try, highest priority first, defaults to 'HE'
+        :type band_priority: str, optional
+        :param instrument_priority: instrument codes to try, highest priority first, defaults to 'HN'
+        :type instrument_priority: str, optional
+        """
+        self.client = client
+        self.band_priority = band_priority
+        self.instrument_priority = instrument_priority
+        if cache_file is not None:
+            cache_file = Path(cache_file)
+        self.cache_file = cache_file
+        if cache_file is not None and cache_file.exists():
+            df = pd.read_csv(cache_file, dtype={'network': str, 'station': str,
+                                                'location': str, 'channel': str},
+                             keep_default_na=False, na_values={'endtime': ['']})
+            df.starttime = pd.to_datetime(df.starttime, utc=True)
+            df.endtime = pd.to_datetime(df.endtime, utc=True)
+        else:
+            df = pd.DataFrame(columns=self.COLUMNS)
+        self._set_table(df)
+
+    def __repr__(self):
+        """String representation of this ChannelIndex object's contents"""
+        rstr = f'{self.__class__.__name__} ({self.cache_file})\n'
+        rstr += f'{len(self.table):d} channel epoch(s) for {len(self._groups):d} station(s)'
+        return rstr
+
+    def _set_table(self, df):
+        """Set the index table and regroup it by (network, station) for fast lookups
+
+        :param df: channel epoch table with columns matching COLUMNS
+        :type df: pandas.DataFrame
+        """
+        self.table = df[self.COLUMNS].reset_index(drop=True)
+        self._groups = {_k: _df for _k, _df in self.table.groupby(['network', 'station'])}
+
+    def update(self, catalog, pad=86400., refresh=False):
+        """Add any stations referenced by picks in a catalog that are not yet in the
+        index using a single `get_stations_bulk` request, then persist the index
+
+        :param catalog: catalog whose picks reference the stations to index
+        :type catalog: obspy.core.event.Catalog
+        :param pad: time padding in seconds applied to the catalog's pick time span, defaults to 86400.
+        :type pad: float, optional
+        :param refresh: re-query every station in the catalog, defaults to False
+        :type refresh: bool, optional
+        :return: number of channel epochs added to the index
+        :rtype: int
+        """
+        stations = set()
+        times = []
+        for event in catalog:
+            for pick in event.picks:
+                wfid = pick.waveform_id
+                stations.add((wfid.network_code, wfid.station_code))
+                times.append(pick.time)
+        if refresh:
+            missing = sorted(stations)
+        else:
+            missing = sorted(stations.difference(self._groups.keys()))
+        if len(missing) == 0:
+            return 0
+        t0 = min(times) - pad
+        t1 = max(times) + pad
+        bulk = [(_n, _s, '*', '*', t0, t1) for _n, _s in missing]
+        logger.info(f'requesting channel metadata for {len(bulk):d} station(s)')
+        try:
+            inv = self.client.get_stations_bulk(bulk, level='channel')
+        except FDSNNoDataException:
+            logger.warning('no channel metadata returned for requested stations')
+            return 0
+        df_new = self.inventory_to_table(inv)
+        df = self.table
+        if refresh:
+            keep = ~df.set_index(['network', 'station']).index.isin(missing)
+            df = df[keep]
+        df = pd.concat([df, df_new], ignore_index=True)
+        df = df.drop_duplicates(subset=['network', 'station', 'location', 'channel', 'starttime'])
+        self._set_table(df)
+        self.save()
+        return len(df_new)
+
+    def save(self):
+        """Write the index to `cache_file`, if one was provided"""
+        if self.cache_file is None:
+            return
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        self.table.to_csv(self.cache_file, header=True, index=False)
+
+    @classmethod
+    def inventory_to_table(cls, inventory):
+        """Flatten a channel-level inventory into a channel epoch table
+
+        :param inventory: station metadata at level='channel' or finer
+        :type inventory: obspy.core.inventory.Inventory
+        :return: channel epoch table
+        :rtype: pandas.DataFrame
+        """
+        rows = []
+        for network in inventory:
+            for station in network:
+                for channel in station:
+                    if channel.end_date is None:
+                        t1 = pd.NaT
+                    else:
+                        t1 = pd.Timestamp(channel.end_date.datetime, tz='UTC')
+                    rows.append([network.code, station.code, channel.location_code, channel.code,
+                                 pd.Timestamp(channel.start_date.datetime, tz='UTC'),
+                                 t1, channel.sample_rate])
+        df = pd.DataFrame(rows, columns=cls.COLUMNS)
+        df.starttime = pd.to_datetime(df.starttime, utc=True)
+        df.endtime = pd.to_datetime(df.endtime, utc=True)
+        return df
+
+    def resolve(self, waveform_id, time):
+        """Resolve a (possibly partial) waveform ID to the highest priority
+        sensor that was operating at a given time
+
+        Partial channel codes (e.g., the single component code 'Z' in picks
+        read from HypoDD phase files) are matched against the band/instrument
+        priorities. Fully specified channel codes present in the index are
+        returned as-is.
+
+        :param waveform_id: waveform ID of a pick
+        :type waveform_id: obspy.core.event.WaveformStreamID
+        :param time: reference time for selecting active channel epochs
+        :type time: obspy.UTCDateTime
+        :return: network, station, location, and channel codes of the matched channel
+            and the channel codes of all components of the same sensor, or None if no match
+        :rtype: tuple of (tuple of str, list of str) or None
+        """
+        key = (waveform_id.network_code, waveform_id.station_code)
+        if key not in self._groups:
+            return None
+        df = self._groups[key]
+        ts = pd.Timestamp(UTCDateTime(time).datetime, tz='UTC')
+        df = df[(df.starttime <= ts) & (df.endtime.isna() | (df.endtime >= ts))]
+        if len(df) == 0:
+            return None
+        cha = waveform_id.channel_code or ''
+        loc = waveform_id.location_code
+        if len(cha) == 3 and cha in df.channel.values:
+            candidates = [cha[:2]]
+        else:
+            candidates = [_b + _i for _b in self.band_priority for _i in self.instrument_priority]
+        comp = cha[-1] if len(cha) > 0 else 'Z'
+        for prefix in candidates:
+            _df = df[df.channel.str.startswith(prefix)]
+            _dfc = _df[_df.channel.str[-1] == comp]
+            if len(_dfc) == 0:
+                continue
+            # Prefer the pick's location code if it is available, else the first in sort order
+            if loc is not None and loc in _dfc.location.values:
+                _loc = loc
+            else:
+                _loc = sorted(_dfc.location.unique())[0]
+            channel = _dfc[_dfc.location == _loc].channel.values[0]
+            components = sorted(_df[_df.location == _loc].channel.unique())
+            return (key[0], key[1], _loc, channel), components
+        return None
+
+
+class EventWindowFetcher(object):
+    """Fetch waveforms and station metadata around the picks of an event
+    in a single bulk request each, caching results on disk by event ID
+
+    :param client: FDSN client used to fetch waveforms and station metadata
+    :type client: obspy.clients.fdsn.Client
+    :param index: channel index used to resolve pick waveform IDs
+    :type index: ChannelIndex
+    :param cache_dir: directory for cached event windows, defaults to None
+        If None, nothing is cached
+    :type cache_dir: str or pathlib.Path, optional
+    :param front_pad: seconds of data to fetch before each pick, defaults to 10.
+    :type front_pad: float, optional
+    :param back_pad: seconds of data to fetch after each pick, defaults to 30.
+    :type back_pad: float, optional
+    """
+    def __init__(self, client, index, cache_dir=None, front_pad=10., back_pad=30.):
+        """Initialize an EventWindowFetcher object
+
+        :param client: FDSN client used to fetch waveforms and station metadata
+        :type client: obspy.clients.fdsn.Client
+        :param index: channel index used to resolve pick waveform IDs
+        :type index: ChannelIndex
+        :param cache_dir: directory for cached event windows, defaults to None
+        :type cache_dir: str or pathlib.Path, optional
+        :param front_pad: seconds of data to fetch before each pick, defaults to 10.
+        :type front_pad: float, optional
+        :param back_pad: seconds of data to fetch after each pick, defaults to 30.
+        :type back_pad: float, optional
+        """
+        self.client = client
+        self.index = index
+        if cache_dir is not None:
+            cache_dir = Path(cache_dir)
+            cache_dir.mkdir(parents=True, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.front_pad = front_pad
+        self.back_pad = back_pad
+
+    def form_bulk(self, event, update_picks=True):
+        """Resolve each pick in an event against the channel index and compose
+        a bulk request with one line per sensor spanning all of its picks
+
+        :param event: event whose picks define the request
+        :type event: obspy.core.event.Event
+        :param update_picks: write resolved location and channel codes
+            back into pick waveform IDs, defaults to True
+        :type update_picks: bool, optional
+        :return: bulk request lines (net, sta, loc, cha, starttime, endtime)
+        :rtype: list of tuple
+        """
+        windows = {}
+        for pick in event.picks:
+            resolved = self.index.resolve(pick.waveform_id, pick.time)
+            if resolved is None:
+                logger.warning(f'could not resolve {pick.waveform_id.id} at {pick.time}')
+                continue
+            (net, sta, loc, cha), _ = resolved
+            if update_picks:
+                pick.waveform_id.location_code = loc
+                pick.waveform_id.channel_code = cha
+            key = (net, sta, loc, f'{cha[:2]}?')
+            t0 = pick.time - self.front_pad
+            t1 = pick.time + self.back_pad
+            if key in windows:
+                _t0, _t1 = windows[key]
+                windows[key] = (min(t0, _t0), max(t1, _t1))
+            else:
+                windows[key] = (t0, t1)
+        return [_k + _v for _k, _v in windows.items()]
+
+    def get_event_window(self, event, event_id=None, update_picks=True, refresh=False):
+        """Get waveforms and station metadata around the picks of an event,
+        reading from the local cache if this event was fetched before
+
+        :param event: event to fetch data for
+        :type event: obspy.core.event.Event
+        :param event_id: cache key, defaults to None
+            If None, the event's resource ID is used
+        :type event_id: str, optional
+        :param update_picks: write resolved location and channel codes
+            back into pick waveform IDs, defaults to True
+        :type update_picks: bool, optional
+        :param refresh: ignore and overwrite cached data, defaults to False
+        :type refresh: bool, optional
+        :return: merged waveforms and channel-level station metadata
+        :rtype: tuple of (obspy.Stream, obspy.Inventory)
+        """
+        # Always resolve so picks are updated, even when reading from cache
+        bulk = self.form_bulk(event, update_picks=update_picks)
+        wf_file, inv_file = self._cache_files(event, event_id)
+        if not refresh and wf_file is not None and wf_file.exists() and inv_file.exists():
+            logger.info(f'reading cached event window {wf_file.stem}')
+            st = read(str(wf_file))
+            st.merge()
+            return st, read_inventory(str(inv_file))
+        if len(bulk) == 0:
+            return Stream(), Inventory()
+        logger.info(f'requesting {len(bulk):d} sensor window(s)')
+        try:
+            st = self.client.get_waveforms_bulk(bulk)
+        except FDSNNoDataException:
+            st = Stream()
+        try:
+            inv = self.client.get_stations_bulk(bulk, level='channel')
+        except FDSNNoDataException:
+            inv = Inventory()
+        # Merge traces to deduplicate samples
+        st.merge()
+        if wf_file is not None and len(st) > 0:
+            # Masked (gappy) traces cannot be written to MiniSEED as-is
+            st.split().write(str(wf_file), format='MSEED')
+            inv.write(str(inv_file), format='STATIONXML')
+        return st, inv
+
+    def _cache_files(self, event, event_id=None):
+        """Get the cached waveform and inventory file paths for an event
+
+        :param event: event to get cache paths for
+        :type event: obspy.core.event.Event
+        :param event_id: cache key, defaults to None
+        :type event_id: str, optional
+        :return: MiniSEED and StationXML paths, or (None, None) if not caching
+        :rtype: tuple of pathlib.Path
+        """
+        if self.cache_dir is None:
+            return None, None
+        if event_id is None:
+            event_id = str(event.resource_id)
+        # Make resource IDs (e.g., smi:local/...) safe to use as file names
+        key = re.sub(r'[^A-Za-z0-9_.-]+', '_', str(event_id))
+        return self.cache_dir/f'{key}.mseed', self.cache_dir/f'{key}.xml'
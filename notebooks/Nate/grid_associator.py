@@ -0,0 +1,492 @@
+"""
+:module: grid_associator.py
+:org: Pacific Northwest Seismic Network
+:license: GPLv3
+:purpose: A travel-time-grid phase associator that turns per-station pick files
+    (e.g., `detections_*.csv` and `seisbench_detections_*.csv` with phase, time, and
+    confidence columns) into an ObsPy Catalog of events with associated picks, ready
+    for `obsplus.EventBank.put_events` or `obspy_compat2.to_pyrocko_events_and_picks`.
+
+    P & S travel times from a layered 1-D velocity model are tabulated once for every
+    (source grid node, station) pair. Time-sorted picks from all stations are then
+    streamed through sliding origin-time windows: picks in each window are
+    back-projected to every grid node at once, origin times are binned, and the
+    best-supported (node, origin time) bin is declared an event if enough stations
+    have picks within tolerance of its predicted arrival times. Windows with too
+    few stations picked are skipped without back-projection.
+"""
+import logging
+import os
+import re
+
+import numpy as np
+import pandas as pd
+from obspy import UTCDateTime
+from obspy.core.event import (Arrival, Catalog, Comment, Event, Origin, OriginQuality,
+                              Pick, QuantityError, ResourceIdentifier, WaveformStreamID)
+
+logger = logging.getLogger('grid_associator')
+
+KM_PER_DEG = 111.19
+
+# A generic layered crustal model (layer top depth [km], Vp [km/s], Vs [km/s]).
+# Replace with a regional model (e.g., one used for HypoDD relocations) where available.
+DEFAULT_MODEL = pd.DataFrame({'depth': [0., 2., 5., 10., 18., 25., 35.],
+                              'vp': [4.5, 5.4, 5.9, 6.2, 6.6, 7.0, 7.9],
+                              'vs': [2.6, 3.1, 3.4, 3.6, 3.8, 4.0, 4.5]})
+
+
+def layered_travel_times(distance, depth, tops, velocity, n_rays=2000):
+    """First-arrival travel times from a source at depth to receivers at the surface
+    of a flat, layered velocity model (direct upgoing rays and head waves)
+
+    :param distance: epicentral distances [km]
+    :type distance: numpy.ndarray
+    :param depth: source depth [km]
+    :type depth: float
+    :param tops: layer top depths [km], starting at 0
+    :type tops: numpy.ndarray
+    :param velocity: layer velocities [km/s]
+    :type velocity: numpy.ndarray
+    :param n_rays: number of ray parameters sampled for direct rays, defaults to 2000
+    :type n_rays: int, optional
+    :return: travel times [s]
+    :rtype: numpy.ndarray
+    """
+    distance = np.asarray(distance, dtype=np.float64)
+    bottoms = np.append(tops[1:], np.inf)
+    # Thickness of each layer above the source, and of each layer between the source
+    # and the top of each deeper layer
+    h_above = np.clip(np.minimum(bottoms, depth) - tops, 0., None)
+    ilay = np.searchsorted(tops, depth, side='right') - 1
+    if depth <= 0:
+        tt = distance/velocity[0]
+    else:
+        # Direct upgoing rays, sampled by ray parameter
+        used = h_above > 0
+        h, v = h_above[used], velocity[used]
+        p = np.linspace(0., (1. - 1e-9)/v.max(), n_rays)
+        eta = np.sqrt(1. - (p[:, None]*v[None, :])**2)
+        x_p = (h[None, :]*p[:, None]*v[None, :]/eta).sum(axis=1)
+        t_p = (h[None, :]/(v[None, :]*eta)).sum(axis=1)
+        tt = np.interp(distance, x_p, t_p, right=np.inf)
+    # Head waves along the top of each layer below the source that is faster
+    # than everything above it
+    for _k in range(ilay + 1, len(tops)):
+        vmax = velocity[:_k].max()
+        if velocity[_k] <= vmax:
+            continue
+        p = 1./velocity[_k]
+        h_below = np.clip(np.minimum(bottoms[:_k], tops[_k]) - np.maximum(tops[:_k], depth), 0., None)
+        h_total = h_above[:_k] + 2*h_below
+        eta = np.sqrt(1. - (p*velocity[:_k])**2)
+        x_crit = (h_total*p*velocity[:_k]/eta).sum()
+        t_head = distance*p + (h_total*eta/velocity[:_k]).sum()
+        tt = np.where(distance >= x_crit, np.minimum(tt, t_head), tt)
+    return tt
+
+
+def read_station_file(path):
+    """Read a station file with "Station, Latitude, Longitude, Elevation" columns
+    and STA.NET station names (e.g., `Amanda/station_file.txt`)
+
+    :param path: path to the station file
+    :type path: str
+    :return: station table with network, station, latitude, longitude, and elevation columns
+    :rtype: pandas.DataFrame
+    """
+    df = pd.read_csv(path, sep=r',\s*', engine='python')
+    df.columns = [_c.strip() for _c in df.columns]
+    sta_net = df.Station.str.strip().str.split('.', expand=True)
+    return pd.DataFrame({'network': sta_net[1], 'station': sta_net[0],
+                         'latitude': df.Latitude.astype(float),
+                         'longitude': df.Longitude.astype(float),
+                         'elevation': df.Elevation.astype(float)})
+
+
+def read_pick_files(files):
+    """Read per-station pick files named like `*_NET.STA.YEAR.JDAY.csv`
+    (phase, time, confidence columns; `pickdb_detections_*.csv` files name the time
+    column peak_time) into one time-sorted table. Picks without a valid time are dropped.
+
+    :param files: pick file paths
+    :type files: list of str
+    :return: picks with network, station, phase, time (epoch seconds), and confidence columns
+    :rtype: pandas.DataFrame
+    """
+    dfs = []
+    for _f in files:
+        match = re.search(r'([A-Z0-9]+)\.([A-Z0-9]+)\.\d{4}\.\d{1,3}\.csv$', os.path.basename(_f))
+        if match is None:
+            logger.warning(f'could not parse network & station from {_f}, skipping')
+            continue
+        _df = pd.read_csv(_f)
+        if 'time' not in _df.columns and 'peak_time' in _df.columns:
+            _df = _df.rename(columns={'peak_time': 'time'})
+        if 'time' not in _df.columns:
+            logger.warning(f'no time or peak_time column in {_f}, skipping')
+            continue
+        _df = _df.assign(network=match.group(1), station=match.group(2))
+        dfs.append(_df)
+    if len(dfs) == 0:
+        return pd.DataFrame(columns=['network', 'station', 'phase', 'time', 'confidence'])
+    df = pd.concat(dfs, ignore_index=True)
+    times = pd.to_datetime(df.time, utc=True, format='ISO8601', errors='coerce')
+    df['time'] = (times - pd.Timestamp(0, tz='UTC'))/pd.Timedelta(seconds=1)
+    if df.time.isna().any():
+        logger.warning(f'dropping {int(df.time.isna().sum()):d} pick(s) with missing or invalid times')
+        df = df[df.time.notna()]
+    df = df[['network', 'station', 'phase', 'time', 'confidence']]
+    return df.sort_values('time', kind='stable').reset_index(drop=True)
+
+
+class GridAssociator(object):
+    """
+    Travel-time-grid phase associator
+
+    :param stations: station table with network, station, latitude, longitude, and
+        elevation [m] columns (see :func:`read_station_file`)
+    :type stations: pandas.DataFrame
+    :param model: layered velocity model with depth (layer top) [km], vp, and vs [km/s]
+        columns, defaults to None (:data:`DEFAULT_MODEL`)
+    :type model: pandas.DataFrame, optional
+    :param spacing: horizontal grid spacing [km], defaults to 5.
+    :type spacing: float, optional
+    :param depths: source grid depths [km], defaults to None (0 to 30 km every 3 km)
+    :type depths: array-like, optional
+    :param pad: padding of the source grid around the network [km], defaults to 20.
+    :type pad: float, optional
+    :param coarsen: horizontal & vertical coarsening factors of the grid used to score
+        candidate origins, which are then refined on the full grid, defaults to (2, 2)
+    :type coarsen: tuple, optional
+    :param step: origin-time window length [s], defaults to 120.
+    :type step: float, optional
+    :param dt: origin-time bin width [s], defaults to 1.
+    :type dt: float, optional
+    :param tolerance: maximum absolute P & S residuals for association [s], defaults to (1.5, 2.5)
+    :type tolerance: tuple, optional
+    :param min_stations: minimum number of stations with associated picks, defaults to 4
+    :type min_stations: int, optional
+    :param min_picks: minimum number of associated picks, defaults to 5
+    :type min_picks: int, optional
+    :param min_score: minimum summed pick confidence supporting a candidate origin, defaults to 3.
+    :type min_score: float, optional
+    """
+    def __init__(self, stations, model=None, spacing=5., depths=None, pad=20., coarsen=(2, 2),
+                 step=120., dt=1., tolerance=(1.5, 2.5), min_stations=4, min_picks=5, min_score=3.):
+        """Initialize a GridAssociator object and tabulate travel times
+
+        :param stations: station table with network, station, latitude, longitude, and elevation columns
+        :type stations: pandas.DataFrame
+        """
+        if model is None:
+            model = DEFAULT_MODEL
+        if depths is None:
+            depths = np.arange(0., 30.1, 3.)
+        self.stations = stations.reset_index(drop=True)
+        self.model = model
+        self.spacing = spacing
+        self.coarsen = coarsen
+        self.depths = np.asarray(depths, dtype=np.float64)
+        self.step = step
+        self.dt = dt
+        self.tolerance = np.asarray(tolerance, dtype=np.float64)
+        self.min_stations = min_stations
+        self.min_picks = min_picks
+        self.min_score = min_score
+        self._sta_index = {(_n, _s): _e for _e, (_n, _s) in
+                           enumerate(zip(self.stations.network, self.stations.station))}
+
+        # Local flat-earth projection [km] of stations and source grid
+        self.lat0 = self.stations.latitude.mean()
+        self.lon0 = self.stations.longitude.mean()
+        sxy = self.to_km(self.stations.latitude.values, self.stations.longitude.values)
+        xs = np.arange(sxy[:, 0].min() - pad, sxy[:, 0].max() + pad + spacing, spacing)
+        ys = np.arange(sxy[:, 1].min() - pad, sxy[:, 1].max() + pad + spacing, spacing)
+        gx, gy, gz = np.meshgrid(xs, ys, self.depths, indexing='ij')
+        self.grid = np.column_stack([gx.ravel(), gy.ravel(), gz.ravel()])
+        self.tt = self._tabulate(sxy)
+        self.max_tt = float(self.tt.max())
+
+        # Coarse scoring grid: the center node of each coarsen[0] x coarsen[0] x coarsen[1] block
+        ix, iy, iz = np.meshgrid(np.arange(len(xs)), np.arange(len(ys)), np.arange(len(self.depths)),
+                                 indexing='ij')
+        self._ijk = np.column_stack([ix.ravel(), iy.ravel(), iz.ravel()])
+        self._shape = ix.shape
+        ch, cz = coarsen
+        self._coarse = np.flatnonzero((self._ijk[:, 0] % ch == ch//2) & (self._ijk[:, 1] % ch == ch//2)
+                                      & (self._ijk[:, 2] % cz == min(cz//2, len(self.depths) - 1)))
+        self._tt_coarse = np.ascontiguousarray(self.tt[:, self._coarse])
+
+    def __repr__(self):
+        """String representation of this GridAssociator object's contents"""
+        rstr = f'{self.__class__.__name__} ({len(self.stations):d} stations, '
+        rstr += f'{len(self.grid):d} grid nodes ({len(self._coarse):d} coarse), '
+        rstr += f'max travel time {self.max_tt:.1f} s)'
+        return rstr
+
+    @classmethod
+    def from_station_file(cls, path, **kwargs):
+        """Initialize a GridAssociator from a station file (see :func:`read_station_file`)
+
+        :param path: path to the station file
+        :type path: str
+        :return: associator for the stations in the file
+        :rtype: GridAssociator
+        """
+        return cls(read_station_file(path), **kwargs)
+
+    def to_km(self, latitude, longitude):
+        """Project latitude & longitude onto the local plane [km]"""
+        x = (np.asarray(longitude) - self.lon0)*KM_PER_DEG*np.cos(np.radians(self.lat0))
+        y = (np.asarray(latitude) - self.lat0)*KM_PER_DEG
+        return np.column_stack([x, y])
+
+    def to_latlon(self, xy):
+        """Project local plane coordinates [km] back to latitude & longitude"""
+        xy = np.atleast_2d(xy)
+        lat = self.lat0 + xy[:, 1]/KM_PER_DEG
+        lon = self.lon0 + xy[:, 0]/(KM_PER_DEG*np.cos(np.radians(self.lat0)))
+        return lat, lon
+
+    def _tabulate(self, sxy):
+        """Tabulate P & S travel times [phase, node, station] from the 1-D model to the grid"""
+        tops = self.model.depth.values.astype(np.float64)
+        elev = self.stations.elevation.values*1e-3
+        dist = np.hypot(self.grid[:, None, 0] - sxy[None, :, 0], self.grid[:, None, 1] - sxy[None, :, 1])
+        # 1-D tables on a distance axis fine enough for linear interpolation
+        dx = min(self.spacing, 1.)/2.
+        axis = np.arange(0., dist.max() + 2*dx, dx)
+        tt = np.empty((2,) + dist.shape, dtype=np.float32)
+        for _p, _c in enumerate(['vp', 'vs']):
+            vel = self.model[_c].values.astype(np.float64)
+            for _z in self.depths:
+                nodes = self.grid[:, 2] == _z
+                table = layered_travel_times(axis, _z, tops, vel)
+                tt[_p, nodes] = np.interp(dist[nodes], axis, table)
+            # Elevation correction with the top layer velocity
+            tt[_p] += (elev/vel[0]).astype(np.float32)[None, :]
+        return tt
+
+    def _prepare(self, picks):
+        """Map a pick table onto station & phase indices, dropping unknown stations"""
+        df = picks.copy()
+        if not np.issubdtype(df.time.dtype, np.number):
+            df['time'] = [UTCDateTime(_t).timestamp if pd.notna(_t) else np.nan for _t in df.time]
+        valid = np.isfinite(df.time.values.astype(np.float64))
+        if (~valid).any():
+            logger.warning(f'dropping {int((~valid).sum()):d} pick(s) with missing times')
+            df = df[valid]
+        sta = np.array([self._sta_index.get((_n, _s), -1) for _n, _s in zip(df.network, df.station)])
+        phase = df.phase.str.upper().map({'P': 0, 'S': 1}).fillna(-1).astype(int).values
+        keep = (sta >= 0) & (phase >= 0)
+        if (~keep).any():
+            logger.info(f'dropping {int((~keep).sum()):d} pick(s) from unknown stations or phases')
+        df = df[keep].assign(sta=sta[keep], phase_idx=phase[keep])
+        if 'confidence' not in df.columns:
+            df['confidence'] = 1.
+        return df.sort_values('time', kind='stable').reset_index(drop=True)
+
+    def _score(self, t, sta, phase, weight, w0, nbins, chunk=256):
+        """Back-project picks to every coarse grid node and sum pick weights in origin-time bins
+
+        :return: scores [coarse node, bin]
+        :rtype: numpy.ndarray
+        """
+        n_nodes = len(self._coarse)
+        scores = np.zeros(n_nodes*nbins)
+        node_offset = np.arange(n_nodes)*nbins
+        for _i in range(0, len(t), chunk):
+            _s = slice(_i, _i + chunk)
+            ot = t[_s, None] - w0 - self._tt_coarse[phase[_s], :, sta[_s]]
+            bins = np.floor(ot/self.dt).astype(np.int64)
+            valid = (bins >= 0) & (bins < nbins)
+            keys = (bins + node_offset[None, :])[valid]
+            w = np.broadcast_to(weight[_s, None], bins.shape)[valid]
+            scores += np.bincount(keys, weights=w, minlength=n_nodes*nbins)
+        return scores.reshape(n_nodes, nbins)
+
+    def _associate(self, node, t_origin, t, sta, phase):
+        """Select the pick closest to each predicted arrival within tolerance, then
+        refine the origin time from the median residual
+
+        :return: positions of associated picks, their residuals, and the origin time
+        :rtype: tuple
+        """
+        for _ in range(2):
+            res = t - (t_origin + self.tt[phase, node, sta])
+            ok = np.flatnonzero(np.abs(res) <= self.tolerance[phase])
+            # One pick per station & phase (the smallest absolute residual)
+            ok = ok[np.lexsort((np.abs(res[ok]), phase[ok], sta[ok]))]
+            key = sta[ok]*2 + phase[ok]
+            ok = ok[np.r_[True, key[1:] != key[:-1]]] if len(ok) else ok
+            if len(ok) == 0:
+                break
+            t_origin += np.median(res[ok])
+        res = t - (t_origin + self.tt[phase, node, sta])
+        return ok, res[ok], t_origin
+
+    def _misfit(self, nodes, t0, t, sta, phase, weight):
+        """Truncated weighted misfit of picks to the predicted arrivals at each node:
+        squared residuals (after removing each node's origin time shift) normalized by
+        the phase tolerance and capped at 1, so picks outside tolerance count as
+        outliers and nodes with equal numbers of inliers are ranked by how well those
+        inliers fit
+
+        :return: misfit and origin time of each node
+        :rtype: tuple
+        """
+        tol = self.tolerance[phase][:, None]
+        w = weight[:, None]
+        # Residuals [pick, node] relative to the starting origin times
+        res = t[:, None] - t0[None, :] - self.tt[phase[:, None], nodes[None, :], sta[:, None]]
+        # Origin time shift per node: median of the residuals within twice the tolerance,
+        # then the weighted mean of the residuals within tolerance of that median
+        inside = np.abs(res) <= 2*tol
+        has = inside.any(axis=0)
+        shift = np.zeros(len(nodes))
+        shift[has] = np.nanmedian(np.where(inside, res, np.nan)[:, has], axis=0)
+        inside = np.abs(res - shift) <= tol
+        w_in = (inside*w).sum(axis=0)
+        has = w_in > 0
+        shift[has] = (np.where(inside, res, 0.)*w).sum(axis=0)[has]/w_in[has]
+        misfit = (np.minimum(((res - shift)/tol)**2, 1.)*w).sum(axis=0)
+        return misfit, t0 + shift
+
+    def _refine(self, coarse_nodes, coarse_times, t, sta, phase, weight, n_best=3):
+        """Rank candidate coarse nodes by misfit (see :meth:`_misfit`), then pick the
+        full-grid node with the smallest misfit around the best candidates
+
+        :param coarse_nodes: candidate coarse nodes
+        :type coarse_nodes: numpy.ndarray
+        :param coarse_times: origin times of the candidate coarse nodes
+        :type coarse_times: numpy.ndarray
+        :param n_best: number of best candidates to refine around, defaults to 3
+        :type n_best: int, optional
+        :return: full-grid node and its origin time
+        :rtype: tuple
+        """
+        misfit, coarse_times = self._misfit(self._coarse[coarse_nodes], coarse_times, t, sta, phase, weight)
+        order = np.argsort(misfit, kind='stable')[:n_best][::-1]
+        # Full-grid nodes within one coarse block of a candidate start from the origin time
+        # of that candidate (of the better one where blocks overlap)
+        ch, cz = self.coarsen
+        t0 = np.full(self._shape, np.nan)
+        for (_i, _j, _k), _t in zip(self._ijk[self._coarse[coarse_nodes[order]]], coarse_times[order]):
+            t0[max(_i - ch, 0):_i + ch + 1, max(_j - ch, 0):_j + ch + 1, max(_k - cz, 0):_k + cz + 1] = _t
+        t0 = t0.ravel()
+        nodes = np.flatnonzero(~np.isnan(t0))
+        misfit, t_origin = self._misfit(nodes, t0[nodes], t, sta, phase, weight)
+        best = np.argmin(misfit)
+        return nodes[best], t_origin[best]
+
+    def associate(self, picks):
+        """Associate picks into events
+
+        :param picks: picks with network, station, phase ('P' or 'S'), time (epoch seconds,
+            UTCDateTime, or ISO string), and (optional) confidence columns, e.g., from
+            :func:`read_pick_files`
+        :type picks: pandas.DataFrame
+        :return: events with one origin each, their associated picks, and arrivals
+        :rtype: obspy.core.event.Catalog
+        """
+        df = self._prepare(picks)
+        catalog = Catalog(resource_id=ResourceIdentifier(prefix='smi:local/grid_associator/catalog'))
+        if len(df) == 0:
+            return catalog
+        t = df.time.values.astype(np.float64)
+        sta = df.sta.values
+        phase = df.phase_idx.values
+        weight = df.confidence.values.astype(np.float64)
+        free = np.ones(len(df), dtype=bool)
+        # Origins are scored up to one maximum travel time past the end of each window, so
+        # the best-supported origin among those sharing picks with the window is found first
+        # (plus one bin so origins at the end are scored over two bins)
+        nbins = int(np.ceil((self.step + self.max_tt)/self.dt)) + 1
+        # Candidate origins are searched for within 10 s of the best-scoring origin time
+        nsearch = int(np.ceil(10./self.dt))
+
+        w0 = t[0] - self.max_tt
+        n_skipped = 0
+        while w0 <= t[-1]:
+            i0, i1 = np.searchsorted(t, [w0, w0 + self.step + 2*self.max_tt + self.dt])
+            held = np.zeros(i1 - i0, dtype=bool)
+            while True:
+                idx = np.arange(i0, i1)[free[i0:i1] & ~held]
+                if len(np.unique(sta[idx])) < self.min_stations:
+                    n_skipped += 1
+                    break
+                scores = self._score(t[idx], sta[idx], phase[idx], weight[idx], w0, nbins)
+                # Allow for origins near bin edges by summing adjacent bins
+                scores = scores[:, :-1] + scores[:, 1:]
+                while True:
+                    cnode, b = np.unravel_index(np.argmax(scores), scores.shape)
+                    if scores[cnode, b] < self.min_score:
+                        break
+                    # Coarse scores tie or nearly tie over a range of nodes and origin times (e.g.,
+                    # along the azimuth of events outside the network), so refine around the nodes
+                    # scoring within 80% of the best near its origin time, using only the picks
+                    # such origins could explain
+                    span = slice(max(b - nsearch, 0), b + nsearch + 1)
+                    best = scores[:, span].max(axis=1)
+                    cnodes = np.flatnonzero(best >= 0.8*scores[cnode, b])
+                    ctimes = w0 + (span.start + np.argmax(scores[cnodes, span], axis=1) + 1)*self.dt
+                    near = idx[(t[idx] >= ctimes.min() - self.tolerance.max())
+                               & (t[idx] <= ctimes.max() + self.max_tt + self.tolerance.max())]
+                    node, t_origin = self._refine(cnodes, ctimes, t[near], sta[near], phase[near], weight[near])
+                    ok, res, t_origin = self._associate(node, t_origin, t[idx], sta[idx], phase[idx])
+                    if (len(ok) >= self.min_picks) and (len(np.unique(sta[idx][ok])) >= self.min_stations):
+                        break
+                    # Rejected: suppress this origin-time bin and try the next best candidate
+                    scores[:, b] = 0.
+                if scores[cnode, b] < self.min_score:
+                    break
+                if t_origin >= w0 + self.step:
+                    # Past this window, where its own origin may not have been scored: leave it
+                    # (and its picks) to the next window
+                    held[idx[ok] - i0] = True
+                    continue
+                catalog.events.append(self._make_event(df, idx[ok], node, t_origin, res))
+                free[idx[ok]] = False
+            w0 += self.step
+        logger.info(f'associated {len(catalog):d} event(s) from {int((~free).sum()):d} of '
+                    f'{len(df):d} pick(s), skipped {n_skipped:d} sparse window(s)')
+        return catalog
+
+    def _make_event(self, df, rows, node, t_origin, residuals):
+        """Build an Event with picks and an origin with arrivals"""
+        lat, lon = self.to_latlon(self.grid[node, :2])
+        sxy = self.to_km(self.stations.latitude.values, self.stations.longitude.values)
+        origin = Origin(resource_id=ResourceIdentifier(prefix='smi:local/grid_associator/origin'),
+                        time=UTCDateTime(t_origin), latitude=float(lat[0]), longitude=float(lon[0]),
+                        depth=float(self.grid[node, 2]*1e3),
+                        method_id=ResourceIdentifier('smi:local/grid_associator'),
+                        evaluation_mode='automatic')
+        event = Event(resource_id=ResourceIdentifier(prefix='smi:local/grid_associator/event'),
+                      event_type='earthquake', event_type_certainty='suspected')
+        azimuths = []
+        for _r, res in zip(rows, residuals):
+            _p = df.loc[_r]
+            pick = Pick(resource_id=ResourceIdentifier(prefix='smi:local/grid_associator/pick'),
+                        time=UTCDateTime(_p.time),
+                        time_errors=QuantityError(uncertainty=float(self.tolerance[_p.phase_idx])),
+                        waveform_id=WaveformStreamID(network_code=_p.network, station_code=_p.station),
+                        phase_hint=_p.phase.upper(), evaluation_mode='automatic',
+                        comments=[Comment(text=f'confidence={_p.confidence:.3f}')])
+            dxy = sxy[_p.sta] - self.grid[node, :2]
+            azimuth = float(np.degrees(np.arctan2(dxy[0], dxy[1])) % 360.)
+            azimuths.append(azimuth)
+            origin.arrivals.append(Arrival(pick_id=pick.resource_id, phase=pick.phase_hint,
+                                           time_residual=float(res), azimuth=azimuth,
+                                           distance=float(np.hypot(*dxy)/KM_PER_DEG)))
+            event.picks.append(pick)
+        stas = set(df.loc[rows, 'sta'])
+        az = np.sort(azimuths)
+        gap = np.max(np.diff(np.r_[az, az[0] + 360.]))
+        origin.quality = OriginQuality(associated_phase_count=len(rows), used_phase_count=len(rows),
+                                       associated_station_count=len(stas), used_station_count=len(stas),
+                                       standard_error=float(np.sqrt(np.mean(np.square(residuals)))),
+                                       azimuthal_gap=float(gap))
+        event.origins.append(origin)
+        event.preferred_origin_id = origin.resource_id
+        return event
@@ -0,0 +1,535 @@
+"""
+:module: local_client.py
+:org: Pacific Northwest Seismic Network
+:license: GPLv3
+:purpose: An offline, indexed waveform & station metadata client for a directory of
+    MiniSEED and StationXML files that mirrors the `get_waveforms`, `get_waveforms_bulk`,
+    `get_stations`, and `get_stations_bulk` methods of `obspy.clients.fdsn.Client`.
+
+    MiniSEED record headers are scanned once and stored in a persistent CSV index
+    of (NSLC, time range, file, byte offset, byte length) blocks, so window reads
+    only seek into the records that overlap the requested window instead of
+    parsing whole day files.
+"""
+import copy
+import logging
+import os
+import re
+from io import BytesIO
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from obspy import UTCDateTime, Stream, Inventory, read, read_inventory
+from obspy.clients.fdsn.header import FDSNNoDataException
+
+logger = logging.getLogger('local_client')
+
+# Fixed section of data header fields used for indexing (SEED v2.4 manual, chapter 8)
+_HEADER_NAMES = ['quality', 'station', 'location', 'channel', 'network',
+                 'year', 'jday', 'hour', 'minute', 'second', 'fract',
+                 'nsamp', 'factor', 'multiplier', 'activity', 'tcorr']
+_HEADER_OFFSETS = [6, 8, 13, 15, 18, 20, 22, 24, 25, 26, 28, 30, 32, 34, 36, 40]
+_HEADER_LENGTH = 48
+
+
+def _header_dtype(byteorder):
+    """Get a numpy dtype for the fixed section of data header
+
+    :param byteorder: '>' for big-endian or '<' for little-endian
+    :type byteorder: str
+    :return: structured dtype
+    :rtype: numpy.dtype
+    """
+    bo = byteorder
+    formats = ['S1', 'S5', 'S2', 'S3', 'S2',
+               bo + 'u2', bo + 'u2', 'u1', 'u1', 'u1', bo + 'u2',
+               bo + 'u2', bo + 'i2', bo + 'i2', 'u1', bo + 'i4']
+    return np.dtype({'names': _HEADER_NAMES, 'formats': formats,
+                     'offsets': _HEADER_OFFSETS, 'itemsize': _HEADER_LENGTH})
+
+
+def _byteorder(raw, offset=0):
+    """Infer the byte order of a record from its BTIME year field"""
+    year = int.from_bytes(raw[offset + 20:offset + 22].tobytes(), 'big')
+    if 1900 <= year <= 2100:
+        return '>'
+    return '<'
+
+
+def _record_length(raw, offset, byteorder):
+    """Get the record length of a record from its blockette 1000
+
+    :param raw: file contents
+    :type raw: numpy.ndarray of uint8
+    :param offset: byte offset of the record
+    :type offset: int
+    :param byteorder: '>' or '<'
+    :type byteorder: str
+    :return: record length in bytes, or None if no blockette 1000 is found
+    :rtype: int or None
+    """
+    bo = 'big' if byteorder == '>' else 'little'
+    nxt = int.from_bytes(raw[offset + 46:offset + 48].tobytes(), bo)
+    # Follow the blockette chain, guarding against malformed loops
+    for _ in range(16):
+        if nxt == 0 or offset + nxt + 7 > len(raw):
+            return None
+        btype = int.from_bytes(raw[offset + nxt:offset + nxt + 2].tobytes(), bo)
+        if btype == 1000:
+            return 2 ** int(raw[offset + nxt + 6])
+        nxt = int.from_bytes(raw[offset + nxt + 2:offset + nxt + 4].tobytes(), bo)
+    return None
+
+
+def scan_mseed_records(path):
+    """Scan the fixed headers of every record in a MiniSEED file
+
+    Files with a constant record length (the norm for archived day files) are
+    parsed in a single vectorized pass; otherwise records are walked one at a time.
+
+    :param path: path to a MiniSEED file
+    :type path: str or pathlib.Path
+    :return: one row per record with NSLC codes, start/end times [epoch seconds],
+        sampling rate, byte offset and byte length, or None if not MiniSEED
+    :rtype: pandas.DataFrame or None
+    """
+    raw = np.fromfile(path, dtype=np.uint8)
+    if len(raw) < _HEADER_LENGTH or raw[6:7].tobytes() not in b'DRQM':
+        return None
+    byteorder = _byteorder(raw)
+    reclen = _record_length(raw, 0, byteorder)
+    if reclen is None or reclen < _HEADER_LENGTH:
+        return None
+    offsets = np.arange(0, len(raw), reclen)
+    if len(raw) % reclen != 0 or not np.isin(raw[offsets + 6], list(b'DRQM')).all():
+        # Variable record lengths: walk the file
+        offsets, lengths = [], []
+        offset = 0
+        while offset + _HEADER_LENGTH <= len(raw):
+            _rl = _record_length(raw, offset, byteorder)
+            if _rl is None:
+                break
+            offsets.append(offset)
+            lengths.append(_rl)
+            offset += _rl
+        offsets = np.array(offsets, dtype=np.int64)
+        lengths = np.array(lengths, dtype=np.int64)
+    else:
+        lengths = np.full(len(offsets), reclen, dtype=np.int64)
+    if len(offsets) == 0:
+        return None
+    hdr = raw[offsets[:, None] + np.arange(_HEADER_LENGTH)]
+    hdr = np.ascontiguousarray(hdr).view(_header_dtype(byteorder)).ravel()
+
+    # BTIME to epoch seconds
+    days = (hdr['year'].astype(np.int64) - 1970).astype('datetime64[Y]').astype('datetime64[D]')
+    days = days.astype(np.int64) + hdr['jday'].astype(np.int64) - 1
+    t0 = (days*86400 + hdr['hour'].astype(np.int64)*3600 + hdr['minute'].astype(np.int64)*60
+          + hdr['second'].astype(np.int64)).astype(np.float64) + hdr['fract']*1e-4
+    # Apply time corrections that have not already been applied (activity flag bit 1)
+    apply = (hdr['activity'] & 0x02) == 0
+    t0 = t0 + np.where(apply, hdr['tcorr']*1e-4, 0.)
+    # Sample rate from factor & multiplier
+    f = hdr['factor'].astype(np.float64)
+    m = hdr['multiplier'].astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sr = np.select([(f > 0) & (m > 0), (f > 0) & (m < 0), (f < 0) & (m > 0), (f < 0) & (m < 0)],
+                       [f*m, -f/m, -m/f, 1./(f*m)], default=0.)
+    nsamp = hdr['nsamp'].astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t1 = t0 + np.where((sr > 0) & (nsamp > 0), (nsamp - 1)/sr, 0.)
+
+    def _decode(field):
+        return np.char.strip(np.char.decode(hdr[field], 'ascii', errors='replace'))
+
+    return pd.DataFrame({'network': _decode('network'),
+                         'station': _decode('station'),
+                         'location': _decode('location'),
+                         'channel': _decode('channel'),
+                         'starttime': t0,
+                         'endtime': t1,
+                         'sampling_rate': sr,
+                         'offset': offsets,
+                         'length': lengths})
+
+
+def _pattern_to_regex(pattern):
+    """Convert an FDSN-style code pattern (wildcards `*` and `?`, comma-delimited
+    lists, `--` for empty location codes) into a compiled regular expression
+
+    :param pattern: code pattern, or None to match everything
+    :type pattern: str or None
+    :return: compiled regex
+    :rtype: re.Pattern
+    """
+    if pattern is None:
+        return re.compile('.*')
+    if isinstance(pattern, (list, tuple)):
+        pattern = ','.join(pattern)
+    parts = []
+    for _p in str(pattern).split(','):
+        _p = _p.strip()
+        if _p == '--':
+            _p = ''
+        parts.append(re.escape(_p).replace(r'\*', '.*').replace(r'\?', '.'))
+    return re.compile('^(?:' + '|'.join(parts) + ')$')
+
+
+def _to_timestamp(time):
+    """Convert time-like inputs (UTCDateTime, str, None) to epoch seconds"""
+    if time is None:
+        return None
+    return UTCDateTime(time).timestamp
+
+
+class LocalClient(object):
+    """
+    An offline client for a directory of MiniSEED and StationXML files with the same
+    `get_waveforms`, `get_waveforms_bulk`, `get_stations` and `get_stations_bulk`
+    surface as `obspy.clients.fdsn.Client`
+
+    :param base_path: root directory to (recursively) search for MiniSEED and StationXML files
+    :type base_path: str or pathlib.Path
+    :param index_file: path of the persisted waveform index, defaults to None
+        If None, '{base_path}/.local_client_index.csv' is used
+    :type index_file: str or pathlib.Path, optional
+    :param block_size: maximum number of bytes of contiguous records of one channel
+        to combine into a single index entry, defaults to 65536
+        Use 0 to index every record individually
+    :type block_size: int, optional
+    :param xml_suffixes: file suffixes treated as StationXML, defaults to ('.xml',)
+    :type xml_suffixes: tuple of str, optional
+    :param update: scan for new or modified files on initialization, defaults to True
+    :type update: bool, optional
+    """
+    INDEX_COLUMNS = ['network', 'station', 'location', 'channel', 'starttime', 'endtime',
+                     'sampling_rate', 'file', 'offset', 'length', 'mtime', 'size']
+
+    def __init__(self, base_path, index_file=None, block_size=65536,
+                 xml_suffixes=('.xml',), update=True):
+        """Initialize a LocalClient object
+
+        :param base_path: root directory to (recursively) search for MiniSEED and StationXML files
+        :type base_path: str or pathlib.Path
+        :param index_file: path of the persisted waveform index, defaults to None
+        :type index_file: str or pathlib.Path, optional
+        :param block_size: maximum number of bytes of contiguous records of one channel
+            to combine into a single index entry, defaults to 65536
+        :type block_size: int, optional
+        :param xml_suffixes: file suffixes treated as StationXML, defaults to ('.xml',)
+        :type xml_suffixes: tuple of str, optional
+        :param update: scan for new or modified files on initialization, defaults to True
+        :type update: bool, optional
+        """
+        self.base_path = Path(base_path)
+        if index_file is None:
+            index_file = self.base_path/'.local_client_index.csv'
+        self.index_file = Path(index_file)
+        self.block_size = int(block_size)
+        self.xml_suffixes = tuple(xml_suffixes)
+        self._inventory = None
+        if self.index_file.exists():
+            df = pd.read_csv(self.index_file, dtype={'network': str, 'station': str,
+                                                     'location': str, 'channel': str},
+                             keep_default_na=False)
+        else:
+            df = pd.DataFrame(columns=self.INDEX_COLUMNS)
+        self._set_index(df)
+        if update:
+            self.update_index()
+
+    def __repr__(self):
+        """String representation of this LocalClient object's contents"""
+        rstr = f'{self.__class__.__name__} ({self.base_path})\n'
+        rstr += f'{len(self.index):d} indexed block(s) across {len(self._groups):d} channel(s)'
+        return rstr
+
+    def _set_index(self, df):
+        """Set the waveform index and regroup it by NSLC, sorted by starttime"""
+        df = df[self.INDEX_COLUMNS].sort_values(['network', 'station', 'location',
+                                                 'channel', 'starttime'])
+        self.index = df.reset_index(drop=True)
+        self._groups = {_k: _df for _k, _df in
+                        self.index.groupby(['network', 'station', 'location', 'channel'])}
+
+    def _iter_files(self):
+        """Iterate across candidate data files below base_path"""
+        for root, _, files in os.walk(self.base_path):
+            for _f in files:
+                path = Path(root)/_f
+                if path == self.index_file or _f.startswith('.'):
+                    continue
+                yield path
+
+    def update_index(self):
+        """Scan base_path for new, modified, or removed MiniSEED files and update
+        (and persist) the waveform index. Unchanged files are not re-read.
+
+        :return: number of (re-)indexed files
+        :rtype: int
+        """
+        known = self.index.groupby('file')[['mtime', 'size']].first()
+        seen = set()
+        new = []
+        for path in self._iter_files():
+            if path.suffix.lower() in self.xml_suffixes or path.suffix.lower() == '.csv':
+                continue
+            rel = str(path.relative_to(self.base_path))
+            stat = path.stat()
+            seen.add(rel)
+            if rel in known.index:
+                _k = known.loc[rel]
+                if _k.mtime == stat.st_mtime and _k['size'] == stat.st_size:
+                    continue
+            df = scan_mseed_records(path)
+            if df is None:
+                continue
+            df = self._coalesce(df)
+            df = df.assign(file=rel, mtime=stat.st_mtime, size=stat.st_size)
+            new.append(df)
+        stale = set(known.index).difference(seen)
+        if len(new) == 0 and len(stale) == 0:
+            return 0
+        refreshed = set(_df.file.iloc[0] for _df in new)
+        keep = ~self.index.file.isin(stale.union(refreshed))
+        self._set_index(pd.concat([self.index[keep]] + new, ignore_index=True))
+        self.index.to_csv(self.index_file, header=True, index=False)
+        logger.info(f'indexed {len(new):d} file(s), dropped {len(stale):d} missing file(s)')
+        return len(new)
+
+    def _coalesce(self, df):
+        """Combine runs of byte- and time-contiguous records of the same channel into
+        blocks of at most `block_size` bytes
+
+        :param df: record table from :meth:`scan_mseed_records`
+        :type df: pandas.DataFrame
+        :return: block table
+        :rtype: pandas.DataFrame
+        """
+        if self.block_size <= 0 or len(df) < 2:
+            return df
+        nslc = df.network + '.' + df.station + '.' + df.location + '.' + df.channel
+        same = (nslc.values[1:] == nslc.values[:-1])
+        same &= (df.offset.values[1:] == (df.offset + df.length).values[:-1])
+        dt = np.where(df.sampling_rate.values[:-1] > 0, 1./np.maximum(df.sampling_rate.values[:-1], 1e-12), 0.)
+        same &= np.abs(df.starttime.values[1:] - df.endtime.values[:-1] - dt) <= 0.5*dt + 1e-6
+        # Start a new block on a break in continuity or when the block would overflow
+        block = np.zeros(len(df), dtype=np.int64)
+        nbytes = df.length.values[0]
+        for _e in range(1, len(df)):
+            if same[_e - 1] and nbytes + df.length.values[_e] <= self.block_size:
+                block[_e] = block[_e - 1]
+                nbytes += df.length.values[_e]
+            else:
+                block[_e] = block[_e - 1] + 1
+                nbytes = df.length.values[_e]
+        out = df.groupby(block).agg({'network': 'first', 'station': 'first', 'location': 'first',
+                                     'channel': 'first', 'starttime': 'min', 'endtime': 'max',
+                                     'sampling_rate': 'first', 'offset': 'min', 'length': 'sum'})
+        return out.reset_index(drop=True)
+
+    def _select_blocks(self, network, station, location, channel, starttime, endtime):
+        """Get index entries matching NSLC patterns that overlap a time window"""
+        regs = [_pattern_to_regex(_p) for _p in [network, station, location, channel]]
+        t0 = _to_timestamp(starttime)
+        t1 = _to_timestamp(endtime)
+        out = []
+        for _k, _df in self._groups.items():
+            if not all(_r.match(_c) for _r, _c in zip(regs, _k)):
+                continue
+            # Blocks are sorted by start time, so bisect to the last block starting before t1
+            if t1 is not None:
+                _df = _df.iloc[:np.searchsorted(_df.starttime.values, t1, side='right')]
+            if t0 is not None:
+                _df = _df[_df.endtime.values >= t0]
+            if len(_df) > 0:
+                out.append(_df)
+        if len(out) == 0:
+            return self.index.iloc[:0]
+        return pd.concat(out)
+
+    def _read_blocks(self, df):
+        """Read the records listed in index entries, one seek & read per contiguous byte range"""
+        st = Stream()
+        for file, _df in df.groupby('file'):
+            _df = _df.sort_values('offset').drop_duplicates('offset')
+            buf = BytesIO()
+            with open(self.base_path/file, 'rb') as fh:
+                start = _df.offset.values[0]
+                stop = start
+                for _o, _l in zip(_df.offset.values, _df.length.values):
+                    if _o != stop:
+                        fh.seek(start)
+                        buf.write(fh.read(stop - start))
+                        start = _o
+                    stop = _o + _l
+                fh.seek(start)
+                buf.write(fh.read(stop - start))
+            buf.seek(0)
+            st += read(buf, format='MSEED')
+        return st
+
+    def get_waveforms(self, network, station, location, channel, starttime, endtime, **kwargs):
+        """Get waveforms from the local archive
+
+        Mirrors :meth:`obspy.clients.fdsn.Client.get_waveforms`: codes may contain
+        `*` and `?` wildcards or comma-delimited lists, and `--` or '' selects empty
+        location codes. Additional FDSN keyword arguments are accepted and ignored.
+
+        :param network: network code(s)
+        :type network: str
+        :param station: station code(s)
+        :type station: str
+        :param location: location code(s)
+        :type location: str
+        :param channel: channel code(s)
+        :type channel: str
+        :param starttime: start of the requested window
+        :type starttime: obspy.UTCDateTime
+        :param endtime: end of the requested window
+        :type endtime: obspy.UTCDateTime
+        :raises FDSNNoDataException: if no data match the request
+        :return: waveforms trimmed to the requested window
+        :rtype: obspy.Stream
+        """
+        st = self._get_waveforms(network, station, location, channel, starttime, endtime)
+        if len(st) == 0:
+            raise FDSNNoDataException('No data available for request.')
+        return st
+
+    def _get_waveforms(self, network, station, location, channel, starttime, endtime):
+        """Get waveforms without raising on empty results"""
+        df = self._select_blocks(network, station, location, channel, starttime, endtime)
+        if len(df) == 0:
+            return Stream()
+        st = self._read_blocks(df)
+        st.trim(UTCDateTime(starttime), UTCDateTime(endtime))
+        # Stitch traces that were split across read ranges, without altering gaps/overlaps
+        st.merge(method=-1)
+        return st
+
+    def get_waveforms_bulk(self, bulk, **kwargs):
+        """Get waveforms for a list of (network, station, location, channel,
+        starttime, endtime) requests, mirroring :meth:`obspy.clients.fdsn.Client.get_waveforms_bulk`
+
+        :param bulk: bulk request lines
+        :type bulk: list of tuple
+        :raises FDSNNoDataException: if no data match any request line
+        :return: waveforms
+        :rtype: obspy.Stream
+        """
+        st = Stream()
+        for line in bulk:
+            st += self._get_waveforms(*line[:6])
+        if len(st) == 0:
+            raise FDSNNoDataException('No data available for request.')
+        st.merge(method=-1)
+        return st
+
+    @property
+    def inventory(self):
+        """All StationXML below base_path, read on first access"""
+        if self._inventory is None:
+            inv = Inventory()
+            for path in self._iter_files():
+                if path.suffix.lower() in self.xml_suffixes:
+                    try:
+                        inv += read_inventory(str(path), format='STATIONXML')
+                    except Exception:
+                        logger.warning(f'could not read {path} as StationXML - skipping')
+            self._inventory = inv
+        return self._inventory
+
+    def get_stations(self, network=None, station=None, location=None, channel=None,
+                     starttime=None, endtime=None, level='station', **kwargs):
+        """Get station metadata from the local archive, mirroring
+        :meth:`obspy.clients.fdsn.Client.get_stations`
+
+        :param network: network code(s), defaults to None (all)
+        :type network: str, optional
+        :param station: station code(s), defaults to None (all)
+        :type station: str, optional
+        :param location: location code(s), defaults to None (all)
+        :type location: str, optional
+        :param channel: channel code(s), defaults to None (all)
+        :type channel: str, optional
+        :param starttime: only return epochs active at or after this time, defaults to None
+        :type starttime: obspy.UTCDateTime, optional
+        :param endtime: only return epochs active at or before this time, defaults to None
+        :type endtime: obspy.UTCDateTime, optional
+        :param level: one of 'network', 'station', 'channel', 'response', defaults to 'station'
+        :type level: str, optional
+        :raises FDSNNoDataException: if no metadata match the request
+        :return: station metadata
+        :rtype: obspy.Inventory
+        """
+        inv = self._get_stations(network, station, location, channel, starttime, endtime, level)
+        if len(inv) == 0:
+            raise FDSNNoDataException('No data available for request.')
+        return inv
+
+    def get_stations_bulk(self, bulk, level='station', **kwargs):
+        """Get station metadata for a list of (network, station, location, channel,
+        starttime, endtime) requests, mirroring :meth:`obspy.clients.fdsn.Client.get_stations_bulk`
+
+        :param bulk: bulk request lines
+        :type bulk: list of tuple
+        :param level: one of 'network', 'station', 'channel', 'response', defaults to 'station'
+        :type level: str, optional
+        :raises FDSNNoDataException: if no metadata match any request line
+        :return: station metadata
+        :rtype: obspy.Inventory
+        """
+        inv = Inventory()
+        for line in bulk:
+            inv += self._get_stations(*line[:6], level=level)
+        if len(inv) == 0:
+            raise FDSNNoDataException('No data available for request.')
+        return inv
+
+    def _get_stations(self, network, station, location, channel, starttime, endtime, level='station'):
+        """Select a copy of matching metadata, pruned to the requested level"""
+        if level not in ['network', 'station', 'channel', 'response']:
+            raise ValueError(f'level "{level}" not supported')
+        regs = [_pattern_to_regex(_p) for _p in [network, station, location, channel]]
+        t0 = UTCDateTime(starttime) if starttime is not None else None
+        t1 = UTCDateTime(endtime) if endtime is not None else None
+        # Only apply channel-level constraints if they were given or the level requires them
+        filter_channels = level in ['channel', 'response'] or location is not None or channel is not None
+
+        def _active(obj):
+            if t0 is not None and obj.end_date is not None and obj.end_date < t0:
+                return False
+            if t1 is not None and obj.start_date is not None and obj.start_date > t1:
+                return False
+            return True
+
+        out = Inventory(networks=[], source=self.inventory.source)
+        for net in self.inventory:
+            if not regs[0].match(net.code) or not _active(net):
+                continue
+            stations = []
+            for sta in net:
+                if not regs[1].match(sta.code) or not _active(sta):
+                    continue
+                channels = [_c for _c in sta if regs[2].match(_c.location_code)
+                            and regs[3].match(_c.code) and _active(_c)]
+                if filter_channels and len(channels) == 0:
+                    continue
+                # Shallow copies, so pruning never modifies the cached inventory
+                _sta = copy.copy(sta)
+                if level in ['channel', 'response']:
+                    _sta.channels = [copy.copy(_c) for _c in channels]
+                    if level == 'channel':
+                        for _c in _sta.channels:
+                            _c.response = None
+                else:
+                    _sta.channels = []
+                stations.append(_sta)
+            if len(stations) == 0:
+                continue
+            _net = copy.copy(net)
+            _net.stations = stations if level != 'network' else []
+            out.networks.append(_net)
+        return out
@@ -0,0 +1,275 @@
+"""
+:module: qc_screen.py
+:org: Pacific Northwest Seismic Network
+:license: GPLv3
+:purpose: Incremental, network-wide screening of MUSTANG data quality metrics.
+
+    `MetricScreener` consumes the output of `ws_client.MustangClient.measurements_request`
+    (a DataFrame indexed by (start, target) with one column per metric) and keeps rolling
+    baselines (windowed median/MAD and an EWMA mean/variance) for every target & metric.
+    Each update only touches rows newer than the last one seen for that target & metric,
+    so daily updates cost O(new rows) rather than recomputing history. The baseline state
+    can be saved to and loaded from a JSON file between sessions.
+"""
+import json
+import logging
+from collections import deque
+
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+logger = logging.getLogger('qc_screen')
+
+# Which direction of departure from baseline is a problem for commonly used metrics
+DEFAULT_DIRECTIONS = {'sample_min': 'both',
+                      'max_range': 'both',
+                      'num_gaps': 'high',
+                      'sample_unique': 'low',
+                      'percent_availability': 'low'}
+
+
+class _Baseline(object):
+    """Rolling baseline state for a single target & metric"""
+    __slots__ = ('last', 'n', 'window', 'mean', 'var')
+
+    def __init__(self, window, last=None, n=0, values=(), mean=0., var=0.):
+        self.last = last
+        self.n = n
+        self.window = deque(values, maxlen=window)
+        self.mean = mean
+        self.var = var
+
+    def to_dict(self):
+        return {'last': self.last, 'n': self.n, 'values': list(self.window),
+                'mean': self.mean, 'var': self.var}
+
+
+class MetricScreener(object):
+    """
+    Incremental rolling-statistics screening of MUSTANG metric time series
+
+    :param window: number of most recent values used for the median/MAD baseline, defaults to 30
+    :type window: int, optional
+    :param span: EWMA span in samples (alpha = 2 / (span + 1)), defaults to 30
+    :type span: int, optional
+    :param min_periods: number of values required before a baseline is scored against, defaults to 7
+    :type min_periods: int, optional
+    :param threshold: absolute score above which a value breaks its baseline, defaults to 5.
+    :type threshold: float, optional
+    :param min_scale: floor on the baseline scale (MAD-based or EWMA standard deviation)
+        to keep near-constant metrics from producing infinite scores, defaults to 1.
+    :type min_scale: float, optional
+    :param directions: mapping of metric name to 'high', 'low', or 'both', defaults to None
+        If None, :data:`DEFAULT_DIRECTIONS` is used. Unlisted metrics are screened in both directions.
+    :type directions: dict, optional
+    """
+    def __init__(self, window=30, span=30, min_periods=7, threshold=5., min_scale=1.,
+                 directions=None):
+        """Initialize a MetricScreener object
+
+        :param window: number of most recent values used for the median/MAD baseline, defaults to 30
+        :type window: int, optional
+        :param span: EWMA span in samples (alpha = 2 / (span + 1)), defaults to 30
+        :type span: int, optional
+        :param min_periods: number of values required before a baseline is scored against, defaults to 7
+        :type min_periods: int, optional
+        :param threshold: absolute score above which a value breaks its baseline, defaults to 5.
+        :type threshold: float, optional
+        :param min_scale: floor on the baseline scale, defaults to 1.
+        :type min_scale: float, optional
+        :param directions: mapping of metric name to 'high', 'low', or 'both', defaults to None
+        :type directions: dict, optional
+        """
+        self.window = int(window)
+        self.span = span
+        self.alpha = 2./(span + 1.)
+        self.min_periods = int(min_periods)
+        self.threshold = threshold
+        self.min_scale = min_scale
+        if directions is None:
+            directions = DEFAULT_DIRECTIONS
+        self.directions = dict(directions)
+        self.baselines = {}
+
+    def __repr__(self):
+        """String representation of this MetricScreener object's contents"""
+        rstr = f'{self.__class__.__name__} (window={self.window}, span={self.span}, '
+        rstr += f'threshold={self.threshold})\n'
+        targets = set(_k[0] for _k in self.baselines.keys())
+        rstr += f'{len(self.baselines):d} baseline(s) across {len(targets):d} target(s)'
+        return rstr
+
+    def update(self, df):
+        """Score new metric values against their baselines, then fold them into the baselines
+
+        Rows at or before the latest start time already seen for a target & metric are skipped,
+        so overlapping MUSTANG queries can be passed in without double counting.
+
+        :param df: MUSTANG measurements indexed by (start, target) with one column per metric
+        :type df: pandas.DataFrame
+        :return: one row per new (start, target, metric) value with its baseline statistics,
+            scores, and whether it broke the baseline
+        :rtype: pandas.DataFrame
+        """
+        long = self._to_long(df)
+        rows = []
+        for (target, metric), _df in long.groupby(['target', 'metric'], sort=False):
+            key = (target, metric)
+            if key not in self.baselines:
+                self.baselines[key] = _Baseline(self.window)
+            bl = self.baselines[key]
+            if bl.last is not None:
+                _df = _df[_df.start > pd.Timestamp(bl.last)]
+            if len(_df) == 0:
+                continue
+            direction = self.directions.get(metric, 'both')
+            stats = self._score_and_fold(bl, _df.value.values.astype(np.float64), direction)
+            bl.last = _df.start.iloc[-1].isoformat()
+            stats.insert(0, 'metric', metric)
+            stats.insert(0, 'target', target)
+            stats.insert(0, 'start', _df.start.values)
+            rows.append(stats)
+        if len(rows) == 0:
+            out = pd.DataFrame(columns=['start', 'target', 'metric', 'value', 'median', 'mad',
+                                        'robust_z', 'ewma', 'ewma_z', 'score', 'breach'])
+        else:
+            out = pd.concat(rows, ignore_index=True)
+        logger.info(f'scored {len(out):d} new value(s), {int(out.breach.sum()):d} breach(es)')
+        return out
+
+    def _to_long(self, df):
+        """Convert a (start, target)-indexed wide table into sorted long format"""
+        if not isinstance(df.index, pd.MultiIndex):
+            df = df.set_index(['start', 'target'])
+        long = df.stack().rename('value').reset_index()
+        long.columns = ['start', 'target', 'metric', 'value']
+        long['start'] = pd.to_datetime(long.start)
+        long['value'] = pd.to_numeric(long.value, errors='coerce')
+        long = long.dropna(subset=['value'])
+        return long.sort_values(['target', 'metric', 'start'], kind='stable')
+
+    def _score_and_fold(self, bl, values, direction):
+        """Score new values against a baseline (each against the baseline as it stood
+        before that value), then fold them into the baseline
+
+        Median/MAD baselines for all values are computed in one vectorized pass over
+        sliding windows; only the EWMA recursion is evaluated value-by-value.
+
+        :param bl: baseline state, updated in place
+        :type bl: _Baseline
+        :param values: new values in time order
+        :type values: numpy.ndarray
+        :param direction: 'high', 'low', or 'both'
+        :type direction: str
+        :return: baseline statistics and scores for each value
+        :rtype: pandas.DataFrame
+        """
+        nv = len(values)
+        hist = np.fromiter(bl.window, dtype=np.float64, count=len(bl.window))
+        arr = np.concatenate([hist, values])
+        # Position of each new value in arr; its baseline is arr[max(0, pos - window):pos]
+        pos = np.arange(len(hist), len(arr))
+        med = np.full(nv, np.nan)
+        mad = np.full(nv, np.nan)
+        full = pos >= self.window
+        if full.any():
+            win = sliding_window_view(arr[:-1], self.window)[pos[full] - self.window]
+            med[full] = np.median(win, axis=1)
+            mad[full] = np.median(np.abs(win - med[full, None]), axis=1)
+        for _e in np.flatnonzero(~full & (pos > 0)):
+            win = arr[:pos[_e]]
+            med[_e] = np.median(win)
+            mad[_e] = np.median(np.abs(win - med[_e]))
+        # EWMA mean & variance as they stood before each value
+        ewma = np.empty(nv)
+        ewvar = np.empty(nv)
+        mean, var, n = bl.mean, bl.var, bl.n
+        for _e, value in enumerate(values):
+            ewma[_e] = mean
+            ewvar[_e] = var
+            if n == 0:
+                mean, var = value, 0.
+            else:
+                diff = value - mean
+                incr = self.alpha*diff
+                mean += incr
+                var = (1. - self.alpha)*(var + diff*incr)
+            n += 1
+        counts = bl.n + np.arange(nv)
+        bl.mean, bl.var, bl.n = mean, var, n
+        bl.window.extend(values)
+
+        rz = (values - med)/np.maximum(1.4826*mad, self.min_scale)
+        ez = (values - ewma)/np.maximum(np.sqrt(ewvar), self.min_scale)
+        if direction == 'high':
+            score = np.maximum(np.maximum(rz, ez), 0.)
+        elif direction == 'low':
+            score = np.maximum(np.maximum(-rz, -ez), 0.)
+        else:
+            score = np.maximum(np.abs(rz), np.abs(ez))
+        # Too few values to trust the baseline yet
+        early = counts < self.min_periods
+        for _a in [med, mad, rz, ewma, ez, score]:
+            _a[early] = np.nan
+        return pd.DataFrame({'value': values, 'median': med, 'mad': mad, 'robust_z': rz,
+                             'ewma': ewma, 'ewma_z': ez, 'score': score,
+                             'breach': score > self.threshold})
+
+    def rank(self, scores, breaches_only=True):
+        """Rank targets by how strongly their metrics broke baseline
+
+        :param scores: output of :meth:`update`
+        :type scores: pandas.DataFrame
+        :param breaches_only: only include targets with at least one breach, defaults to True
+        :type breaches_only: bool, optional
+        :return: one row per target with the number of breaching values & metrics,
+            the maximum score, the metric and time of that maximum, and the latest breach time
+        :rtype: pandas.DataFrame
+        """
+        _s = scores.dropna(subset=['score'])
+        if breaches_only:
+            _s = _s[_s.breach]
+        if len(_s) == 0:
+            return pd.DataFrame(columns=['n_breaches', 'n_metrics', 'max_score', 'worst_metric',
+                                         'worst_start', 'last_breach'])
+        worst = _s.loc[_s.groupby('target').score.idxmax()].set_index('target')
+        grp = _s.groupby('target')
+        out = pd.DataFrame({'n_breaches': grp.breach.sum().astype(int),
+                            'n_metrics': grp.metric.nunique(),
+                            'max_score': grp.score.max(),
+                            'worst_metric': worst.metric,
+                            'worst_start': worst.start,
+                            'last_breach': _s[_s.breach].groupby('target').start.max()})
+        return out.sort_values(['max_score', 'n_breaches'], ascending=False)
+
+    def save(self, path):
+        """Save screener settings and baselines to a JSON file
+
+        :param path: output file path
+        :type path: str or pathlib.Path
+        """
+        state = {'settings': {'window': self.window, 'span': self.span,
+                              'min_periods': self.min_periods, 'threshold': self.threshold,
+                              'min_scale': self.min_scale, 'directions': self.directions},
+                 'baselines': [[_k[0], _k[1], _v.to_dict()] for _k, _v in self.baselines.items()]}
+        with open(path, 'w') as _f:
+            json.dump(state, _f)
+
+    @classmethod
+    def load(cls, path):
+        """Load a MetricScreener saved with :meth:`save`
+
+        :param path: input file path
+        :type path: str or pathlib.Path
+        :return: screener with restored baselines
+        :rtype: MetricScreener
+        """
+        with open(path, 'r') as _f:
+            state = json.load(_f)
+        screener = cls(**state['settings'])
+        for target, metric, _d in state['baselines']:
+            screener.baselines[(target, metric)] = _Baseline(
+                screener.window, last=_d['last'], n=_d['n'], values=_d['values'],
+                mean=_d['mean'], var=_d['var'])
+        return screener
@@ -0,0 +1,64 @@
+"""
+:module: test_event_fetch.py
+:org: Pacific Northwest Seismic Network
+:license: GPLv3
+:purpose: Tests for event_fetch.py: a ChannelIndex persisted to its CSV cache must
+    reload with the same (string) codes, including all-digit station codes.
+"""
+from obspy import UTCDateTime
+from obspy.core.event import Catalog, Event, Pick, WaveformStreamID
+from obspy.core.inventory import Channel, Inventory, Network, Station
+
+from event_fetch import ChannelIndex
+
+T0 = UTCDateTime('2022-12-20T10:34:24')
+
+
+class FakeClient(object):
+    """Stand-in FDSN client serving a fixed channel-level inventory"""
+    def __init__(self, inventory):
+        self.inventory = inventory
+        self.calls = 0
+
+    def get_stations_bulk(self, bulk, level='channel'):
+        self.calls += 1
+        return self.inventory
+
+
+def make_inventory():
+    stations = []
+    for _s in ['1023', '89255']:
+        channels = [Channel(_c, '00', 40., -124., 0., 0., sample_rate=100.,
+                            start_date=UTCDateTime('2020-01-01'))
+                    for _c in ['HNZ', 'HNN', 'HNE']]
+        stations.append(Station(_s, 40., -124., 0., channels=channels,
+                                creation_date=UTCDateTime('2020-01-01')))
+    return Inventory(networks=[Network('NP', stations=stations)], source='test')
+
+
+def make_catalog():
+    picks = [Pick(time=T0, phase_hint='P',
+                  waveform_id=WaveformStreamID('NP', _s, channel_code='Z'))
+             for _s in ['1023', '89255']]
+    return Catalog(events=[Event(picks=picks)])
+
+
+def test_numeric_station_codes_round_trip(tmp_path):
+    cache_file = tmp_path / 'channel_index.csv'
+    client = FakeClient(make_inventory())
+    index = ChannelIndex(client, cache_file=cache_file)
+    assert index.update(make_catalog()) == 6
+
+    reloaded = ChannelIndex(client, cache_file=cache_file)
+    assert len(reloaded.table) == 6
+    for _col in ['network', 'station', 'location', 'channel']:
+        assert all(isinstance(_v, str) for _v in reloaded.table[_col])
+    for _s in ['1023', '89255']:
+        nslc, components = reloaded.resolve(WaveformStreamID('NP', _s, channel_code='Z'), T0)
+        assert nslc == ('NP', _s, '00', 'HNZ')
+        assert components == ['HNE', 'HNN', 'HNZ']
+
+    # Every station is already indexed: no new request and no duplicate rows
+    assert reloaded.update(make_catalog()) == 0
+    assert client.calls == 1
+    assert len(ChannelIndex(client, cache_file=cache_file).table) == 6
@@ -0,0 +1,99 @@
+"""
+:module: test_grid_associator.py
+:org: Pacific Northwest Seismic Network
+:license: GPLv3
+:purpose: Tests for grid_associator.py: noise-free picks generated from a grid node's
+    travel times must relocate to that node and origin time.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from grid_associator import GridAssociator, read_pick_files
+
+STATION_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Amanda', 'station_file.txt')
+T0 = 1671494400.  # 2022-12-20
+
+
+@pytest.fixture(scope='module')
+def associator():
+    return GridAssociator.from_station_file(STATION_FILE)
+
+
+def synthetic_picks(ga, n_events, n_stations=15, n_noise=0, seed=0):
+    """Noise-free P & S picks for events at random grid nodes, plus random noise picks"""
+    rng = np.random.default_rng(seed)
+    sta = ga.stations
+    rows, truth = [], []
+    # Events 10 minutes apart so they do not share picks
+    for _e in range(n_events):
+        node = rng.integers(len(ga.grid))
+        t_origin = T0 + 600.*_e + rng.uniform(0, 60)
+        truth.append((t_origin, node))
+        for _s in rng.choice(len(sta), n_stations, replace=False):
+            for _p, phase in enumerate('PS'):
+                rows.append((sta.network[_s], sta.station[_s], phase,
+                             t_origin + float(ga.tt[_p, node, _s]), 1.))
+    for _ in range(n_noise):
+        _s = rng.integers(len(sta))
+        rows.append((sta.network[_s], sta.station[_s], 'PS'[rng.integers(2)],
+                     T0 + rng.uniform(0, 600.*n_events), rng.uniform(0.1, 0.6)))
+    picks = pd.DataFrame(rows, columns=['network', 'station', 'phase', 'time', 'confidence'])
+    return picks.sort_values('time').reset_index(drop=True), truth
+
+
+def nearest_events(ga, catalog, truth):
+    """(origin time error, node of each matched truth event, located node) per truth event"""
+    origins = [_e.preferred_origin() for _e in catalog]
+    times = np.array([_o.time.timestamp for _o in origins])
+    out = []
+    for t_origin, node in truth:
+        _i = np.argmin(np.abs(times - t_origin))
+        _o = origins[_i]
+        xy = ga.to_km([_o.latitude], [_o.longitude])[0]
+        located = np.argmin(np.abs(ga.grid[:, :2] - xy).sum(axis=1) + np.abs(ga.grid[:, 2] - _o.depth*1e-3))
+        out.append((times[_i] - t_origin, node, located, _o))
+    return out
+
+
+def test_noise_free_picks_relocate_to_source_node(associator):
+    picks, truth = synthetic_picks(associator, 20)
+    catalog = associator.associate(picks)
+    assert len(catalog) == len(truth)
+    for dt, node, located, origin in nearest_events(associator, catalog, truth):
+        assert located == node
+        assert abs(dt) < 1e-3
+        assert origin.quality.standard_error < 1e-3
+
+
+def test_noise_free_picks_with_noise_picks(associator):
+    picks, truth = synthetic_picks(associator, 30, n_noise=3000, seed=1)
+    catalog = associator.associate(picks)
+    matches = nearest_events(associator, catalog, truth)
+    recovered = [_m for _m in matches if abs(_m[0]) < 1. and _m[1] == _m[2]]
+    assert len(recovered) == len(truth)
+    assert len(catalog) <= len(truth) + 3
+
+
+def test_read_pick_files_peak_time_and_missing_times(tmp_path):
+    pickdb = tmp_path / 'pickdb_detections_PB.B047.2022.354.csv'
+    pickdb.write_text('phase,peak_time,confidence\n'
+                      'P,2022-12-20 00:09:53.850,0.3\n'
+                      'S,,0.4\n')
+    seisbench = tmp_path / 'detections_PB.B046.2022.354.csv'
+    seisbench.write_text('phase,time,confidence\n'
+                         'P,2022-12-20T00:01:40.038400Z,0.327\n')
+    picks = read_pick_files([str(pickdb), str(seisbench)])
+    assert list(picks.station) == ['B046', 'B047']
+    np.testing.assert_allclose(picks.time, [T0 + 100.0384, T0 + 593.85])
+    assert picks.time.notna().all()
+
+
+def test_picks_with_missing_times_are_dropped(associator):
+    picks, truth = synthetic_picks(associator, 5)
+    catalog = associator.associate(picks)
+    picks.loc[picks.index[::7], 'time'] = np.nan
+    catalog_nan = associator.associate(picks)
+    assert len(catalog_nan) == len(catalog) == len(truth)